@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+import argparse
+import os
+from synthetic import simulate, write_frames, write_trackmate_outputs, write_trackmate_xml
+
+parser = argparse.ArgumentParser(
+                    description='Generates a synthetic timelapse of the inputs to each stage of the pipeline, for benchmarking'
+)
+parser.add_argument('output_dir', help="Directory to save the timelapse to")
+parser.add_argument('--frames', help="Number of frames", default=50, type=int)
+parser.add_argument('--cells', help="Number of cells in the first frame", default=100, type=int)
+parser.add_argument('--image-size', help="Number of rows and columns of each frame", default=512, type=int)
+parser.add_argument('--split-rate', help="Probability of a cell dividing between frames", default=0.005, type=float)
+parser.add_argument('--merge-rate', help="Probability of a cell merging into its nearest neighbour between frames", default=0.005, type=float)
+parser.add_argument('--seed', help="Random seed", default=0, type=int)
+parser.add_argument('--workers', help="Number of frames to draw in parallel", default=1, type=int)
+args = parser.parse_args()
+
+timelapse = simulate(args.frames, args.cells, args.image_size, args.split_rate, args.merge_rate, args.seed)
+os.makedirs(args.output_dir, exist_ok=True)
+write_frames(
+    timelapse,
+    os.path.join(args.output_dir, "frames"),
+    os.path.join(args.output_dir, "masks"),
+    args.seed,
+    args.workers,
+)
+write_trackmate_xml(timelapse, os.path.join(args.output_dir, "trackmate.xml"))
+write_trackmate_outputs(
+    timelapse,
+    os.path.join(args.output_dir, "trackmate_features.csv"),
+    os.path.join(args.output_dir, "rois.zip"),
+    os.path.join(args.output_dir, "roi_frames"),
+)
+print(f"Generated {timelapse.spots.shape[0]} Spots and {timelapse.edge_sources.shape[0]} Edges across {args.frames} frames")
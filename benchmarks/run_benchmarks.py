@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+import argparse
+import datetime
+import glob
+import itertools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import numpy as np
+import pandas as pd
+from synthetic import simulate, write_frames, write_trackmate_outputs, write_trackmate_xml
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin")
+STAGES = [
+    "track_masks",
+    "parse_xml",
+    "frame_features_image",
+    "combine_frame_features",
+    "create_frame_summary_features",
+    "time_series_features",
+]
+# The stage whose outputs each stage reads, if not the generated timelapse
+STAGE_INPUTS = {
+    "track_masks": None,
+    "parse_xml": None,
+    "frame_features_image": None,
+    "combine_frame_features": "frame_features_image",
+    "create_frame_summary_features": "combine_frame_features",
+    "time_series_features": "create_frame_summary_features",
+}
+SIZE_PARAMETERS = ["frames", "cells", "image_size"]
+# Runs a command given after the log filename, printing its resource usage as
+# JSON. wait4 gives the usage of just that child, including any of its own
+# children that it waited for, and ru_maxrss is in KB on Linux and bytes on macOS
+MEASURE_SCRIPT = """
+import json, os, sys, time
+with open(sys.argv[1], "a") as log:
+    start = time.perf_counter()
+    pid = os.posix_spawn(sys.argv[2], sys.argv[2:], os.environ, file_actions=[
+        (os.POSIX_SPAWN_DUP2, log.fileno(), 1), (os.POSIX_SPAWN_DUP2, log.fileno(), 2)
+    ])
+    _, status, usage = os.wait4(pid, 0)
+    wall = time.perf_counter() - start
+rss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+print(json.dumps({
+    "wall_seconds": wall,
+    "cpu_seconds": usage.ru_utime + usage.ru_stime,
+    "peak_rss_mb": rss / 1e6,
+    "returncode": os.waitstatus_to_exitcode(status),
+}))
+"""
+# Tracking settings for track_masks.py, with splitting and merging allowed so
+# that the synthetic splits and merges are linked
+TRACKING_CONFIG = {
+    "algorithm": "SparseLAP",
+    "settings": {
+        "LINKING_MAX_DISTANCE": 15.0,
+        "GAP_CLOSING_MAX_DISTANCE": 15.0,
+        "MAX_FRAME_GAP": 2,
+        "ALLOW_TRACK_SPLITTING": True,
+        "SPLITTING_MAX_DISTANCE": 15.0,
+        "ALLOW_TRACK_MERGING": True,
+        "MERGING_MAX_DISTANCE": 15.0,
+    },
+}
+
+def generate_dataset(directory: str, frames: int, cells: int, image_size: int, args: argparse.Namespace) -> None:
+    """
+    Generates a synthetic timelapse, unless it has already been generated.
+
+    :param directory: Directory to save the timelapse to.
+    :param frames: Number of frames.
+    :param cells: Number of cells in the first frame.
+    :param image_size: Number of rows and columns of each frame.
+    :param args: The command line arguments, for the split and merge rates,
+        seed and workers.
+    :return: None, writes to disk as a side-effect.
+    """
+    done_fn = os.path.join(directory, ".complete")
+    if not os.path.exists(done_fn):
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+        timelapse = simulate(frames, cells, image_size, args.split_rate, args.merge_rate, args.seed)
+        write_frames(timelapse, os.path.join(directory, "frames"), os.path.join(directory, "masks"), args.seed, args.workers)
+        write_trackmate_xml(timelapse, os.path.join(directory, "trackmate.xml"))
+        write_trackmate_outputs(
+            timelapse,
+            os.path.join(directory, "trackmate_features.csv"),
+            os.path.join(directory, "rois.zip"),
+            os.path.join(directory, "roi_frames"),
+        )
+        open(done_fn, "w").close()
+    parquet_fn = os.path.join(directory, "trackmate_features.parquet")
+    if args.format == "parquet" and not os.path.exists(parquet_fn):
+        # Same schema as parse_xml.py --filtered-parquet-path
+        trackmate = pd.read_csv(os.path.join(directory, "trackmate_features.csv"))
+        for col in trackmate.columns.drop(["LABEL", "ROI_FILENAME"]):
+            trackmate[col] = trackmate[col].astype("int64" if col in ["ID", "TRACK_ID", "FRAME"] else "float64")
+        trackmate.to_parquet(parquet_fn, index=False)
+
+def stage_commands(dataset_dir: str, run_dir: str, args: argparse.Namespace) -> dict[str, list[str]]:
+    """
+    The command to run each stage with, using the same options as main.nf.
+
+    Every stage reads the generated data, apart from those that read the
+    frame features, which are chained from frame_features_image.py.
+
+    :param dataset_dir: Directory of the generated timelapse.
+    :param run_dir: Directory the stages are run from, where their outputs
+        are saved.
+    :param args: The command line arguments.
+    :return: A dict of the command for each stage, to be run from run_dir.
+    """
+    ext = args.format
+    trackmate_table = os.path.join(dataset_dir, f"trackmate_features.{ext}")
+    frames = sorted(glob.glob(os.path.join(dataset_dir, "frames", "frame_*.tiff")))
+    # As in main.nf, only frames with ROIs are processed
+    shards = [os.path.join(dataset_dir, "roi_frames", f"{os.path.basename(fn).removesuffix('.tiff')}_rois.zip") for fn in frames]
+    frames, shards = zip(*[(fn, shard) for fn, shard in zip(frames, shards) if os.path.exists(shard)])
+    workers = str(args.workers)
+    bin_script = lambda name: [sys.executable, os.path.join(BIN_DIR, f"{name}.py")]
+    parquet_args = lambda flag, fn: [flag, fn] if ext == "parquet" else []
+    combined = f"combined_frame_features.{ext}"
+    return {
+        "track_masks": bin_script("track_masks") + [
+            "--workers", workers, os.path.join(dataset_dir, "masks"), json.dumps(TRACKING_CONFIG), "trackmate.npz",
+        ],
+        "parse_xml": bin_script("parse_xml") + [
+            "--streaming", "--roi-workers", workers, "--roi-shard-dir", "roi_frames",
+            "--filtered-csv-path", "trackmate_features_filtered.csv",
+            *parquet_args("--filtered-parquet-path", "trackmate_features_filtered.parquet"),
+            os.path.join(dataset_dir, "trackmate.xml"), "rois.zip", "trackmate_features.csv",
+        ],
+        "frame_features_image": bin_script("frame_features_image") + [
+            "--crop", "--workers", workers, "--format", ext, trackmate_table, " ".join(frames), " ".join(shards),
+        ],
+        "combine_frame_features": bin_script("combine_frame_features") + [
+            combined, *sorted(os.path.basename(fn) for fn in glob.glob(os.path.join(run_dir, f"frame_features_*.{ext}"))),
+        ],
+        "create_frame_summary_features": bin_script("create_frame_summary_features") + [
+            "--workers", workers, *parquet_args("--parquet-path", "frame_features.parquet"),
+            combined, trackmate_table, "frame_features.csv",
+        ],
+        "time_series_features": bin_script("time_series_features") + [
+            "--workers", workers, f"frame_features.{ext}", "time_series_features.csv",
+        ],
+    }
+
+def combine_csv(fns: list[str], output: str) -> None:
+    """
+    Combines the per-frame CSVs of frame features sorted by cell and then
+    frame, as the combine_frame_features process does with awk and sort when
+    the tables are CSV.
+
+    :param fns: The per-frame CSVs.
+    :param output: Path to save the combined CSV to.
+    :return: None, writes to disk as a side-effect.
+    """
+    df = pd.concat([pd.read_csv(fn) for fn in fns])
+    df.sort_values(["CellID", "FrameID"], kind="stable").to_csv(output, index=False)
+
+def run_stage(command: list[str], directory: str, log_fn: str) -> dict:
+    """
+    Runs a stage and measures its resource usage.
+
+    A child process starts with its parent's peak memory, which it keeps
+    through exec, so the stage is started by a minimal Python process rather
+    than by this one, which holds the generated timelapse. That process
+    measures the stage with wait4 and passes the results back as JSON.
+
+    :param command: The command to run.
+    :param directory: Directory to run the command from.
+    :param log_fn: Path to save the command's stdout and stderr to.
+    :return: A dict with the wall time in seconds, the peak resident set size
+        in MB of the largest process (the script or any of its workers), the
+        CPU time in seconds of the script and its workers, and the return code.
+    """
+    with open(log_fn, "w") as log:
+        measured = subprocess.run(
+            [sys.executable, "-I", "-S", "-c", MEASURE_SCRIPT, log_fn, *command],
+            cwd=directory,
+            stdout=subprocess.PIPE,
+            stderr=log,
+            text=True,
+            check=True,
+        )
+    return json.loads(measured.stdout)
+
+def fit_scaling(results: list[dict]) -> list[dict]:
+    """
+    Fits how each stage's wall time and peak memory scale with the size of
+    the timelapse.
+
+    For every stage and every size parameter that was varied, the runs that
+    share the other parameters form a curve, and a line is fit to the log of
+    the resource usage against the log of the parameter. Its slope is the
+    exponent, so 1 means linear scaling and 2 quadratic.
+
+    :param results: The results of every successful run.
+    :return: A list with a dict for each curve, holding the stage, the varied
+        parameter, the fixed parameters, the points of the curve as the
+        median over the repeats, and the time and memory exponents.
+    """
+    if len(results) == 0:
+        return []
+    df = pd.DataFrame(results)
+    df = df.loc[df["returncode"] == 0]
+    medians = df.groupby(["stage"] + SIZE_PARAMETERS, as_index=False)[["wall_seconds", "peak_rss_mb"]].median()
+    curves = []
+    for parameter in SIZE_PARAMETERS:
+        fixed = [p for p in SIZE_PARAMETERS if p != parameter]
+        for keys, curve in medians.groupby(["stage"] + fixed):
+            if curve.shape[0] < 2:
+                continue
+            curve = curve.sort_values(parameter)
+            log_x = np.log(curve[parameter].values)
+            curves.append({
+                "stage": keys[0],
+                "parameter": parameter,
+                "fixed": {p: int(v) for p, v in zip(fixed, keys[1:])},
+                "points": curve[[parameter, "wall_seconds", "peak_rss_mb"]].to_dict("records"),
+                "time_exponent": float(np.polyfit(log_x, np.log(curve["wall_seconds"].values), 1)[0]),
+                "memory_exponent": float(np.polyfit(log_x, np.log(curve["peak_rss_mb"].values), 1)[0]),
+            })
+    return curves
+
+def compare(results: list[dict], baseline: dict) -> list[dict]:
+    """
+    Compares the results against those from a previous run of the
+    benchmarks, such as on another commit.
+
+    :param results: The results of every run.
+    :param baseline: The contents of the previous run's output JSON.
+    :return: A list with a dict for each stage and timelapse size present in
+        both, holding the median wall time and peak memory of each and the
+        ratio of the new to the baseline.
+    """
+    keys = ["stage", "format"] + SIZE_PARAMETERS
+    new = pd.DataFrame(results)
+    old = pd.DataFrame(baseline["results"])
+    new = new.loc[new["returncode"] == 0].groupby(keys, as_index=False)[["wall_seconds", "peak_rss_mb"]].median()
+    old = old.loc[old["returncode"] == 0].groupby(keys, as_index=False)[["wall_seconds", "peak_rss_mb"]].median()
+    merged = new.merge(old, on=keys, suffixes=("", "_baseline"))
+    merged["wall_ratio"] = merged["wall_seconds"] / merged["wall_seconds_baseline"]
+    merged["rss_ratio"] = merged["peak_rss_mb"] / merged["peak_rss_mb_baseline"]
+    return merged.to_dict("records")
+
+def git_commit() -> str | None:
+    """
+    The commit the benchmarks are being run on.
+
+    :return: The commit hash, with a -dirty suffix if there are uncommitted
+        changes, or None if it isn't a git repository.
+    """
+    repo_dir = os.path.dirname(BIN_DIR)
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=repo_dir, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=repo_dir, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f"{commit}-dirty" if dirty else commit
+
+parser = argparse.ArgumentParser(
+                    description='Benchmarks the wall time and peak memory of each stage of the pipeline on synthetic timelapses of increasing size'
+)
+parser.add_argument('output', help="Path to save the results to as JSON")
+parser.add_argument('--work-dir', help="Directory to generate the timelapses and run the stages in. Generated timelapses are reused between runs", default="benchmark_work")
+parser.add_argument('--frames', help="Numbers of frames to benchmark", nargs='+', default=[25, 50, 100], type=int)
+parser.add_argument('--cells', help="Numbers of cells in the first frame to benchmark", nargs='+', default=[100], type=int)
+parser.add_argument('--image-size', help="Numbers of rows and columns of the frames to benchmark", nargs='+', default=[512], type=int)
+parser.add_argument('--split-rate', help="Probability of a cell dividing between frames", default=0.005, type=float)
+parser.add_argument('--merge-rate', help="Probability of a cell merging into its nearest neighbour between frames", default=0.005, type=float)
+parser.add_argument('--seed', help="Random seed for the timelapses", default=0, type=int)
+parser.add_argument('--stages', help="Stages to benchmark", nargs='+', choices=STAGES, default=STAGES)
+parser.add_argument('--format', help="Format of the tables passed between the CellPhe stages, as --intermediate_format in main.nf", choices=["csv", "parquet"], default="csv")
+parser.add_argument('--workers', help="Number of processes each stage can use, as task.cpus in main.nf", default=1, type=int)
+parser.add_argument('--repeats', help="Number of times to run each stage on each timelapse", default=1, type=int)
+parser.add_argument('--baseline', help="Results JSON from a previous run, such as on another commit, to compare against", default=None)
+args = parser.parse_args()
+
+# The requested stages, along with the earlier stages whose outputs they read
+stages_to_run = set()
+for stage in args.stages:
+    while stage is not None and stage not in stages_to_run:
+        stages_to_run.add(stage)
+        stage = STAGE_INPUTS[stage]
+
+results = []
+for frames, cells, image_size in itertools.product(args.frames, args.cells, args.image_size):
+    name = f"frames{frames}_cells{cells}_size{image_size}_seed{args.seed}_split{args.split_rate}_merge{args.merge_rate}"
+    dataset_dir = os.path.abspath(os.path.join(args.work_dir, "data", name))
+    print(f"Generating {name}", flush=True)
+    generate_dataset(dataset_dir, frames, cells, image_size, args)
+    for repeat in range(args.repeats):
+        run_dir = os.path.abspath(os.path.join(args.work_dir, "runs", args.format, name))
+        shutil.rmtree(run_dir, ignore_errors=True)
+        os.makedirs(run_dir)
+        for stage in STAGES:
+            if stage not in stages_to_run:
+                continue
+            if stage == "combine_frame_features" and args.format == "csv":
+                # Combined with awk and sort in main.nf rather than by a script
+                combine_csv(sorted(glob.glob(os.path.join(run_dir, "frame_features_*.csv"))), os.path.join(run_dir, "combined_frame_features.csv"))
+                continue
+            # The commands depend on the outputs of the earlier stages
+            command = stage_commands(dataset_dir, run_dir, args)[stage]
+            usage = run_stage(command, run_dir, os.path.join(run_dir, f"{stage}.log"))
+            if usage["returncode"] != 0:
+                print(f"  {stage} failed, see {os.path.join(run_dir, stage + '.log')}. Skipping the remaining stages", flush=True)
+            if stage not in args.stages:
+                # Only run for its outputs
+                if usage["returncode"] != 0:
+                    break
+                continue
+            result = {
+                "stage": stage,
+                "format": args.format,
+                "frames": frames,
+                "cells": cells,
+                "image_size": image_size,
+                "repeat": repeat,
+                "workers": args.workers,
+                **usage,
+            }
+            results.append(result)
+            print(f"  {stage}: {usage['wall_seconds']:.2f}s, {usage['peak_rss_mb']:.0f} MB", flush=True)
+            if usage["returncode"] != 0:
+                break
+
+output = {
+    "commit": git_commit(),
+    "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    "python": sys.version.split()[0],
+    "platform": platform.platform(),
+    "cpu_count": os.cpu_count(),
+    "arguments": vars(args),
+    "results": results,
+    "scaling": fit_scaling(results),
+}
+if args.baseline is not None:
+    with open(args.baseline) as infile:
+        output["comparison"] = compare(results, json.load(infile))
+    for row in output["comparison"]:
+        print(f"{row['stage']} frames={row['frames']} cells={row['cells']} size={row['image_size']}: "
+              f"{row['wall_ratio']:.2f}x time, {row['rss_ratio']:.2f}x memory vs baseline")
+with open(args.output, "w") as outfile:
+    json.dump(output, outfile, indent=2)
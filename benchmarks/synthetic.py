@@ -0,0 +1,413 @@
+"""
+Generates synthetic timelapses for benchmarking the pipeline's scripts.
+
+Cells are simulated as disks that drift around the field of view, dividing
+and merging at random, so the data has the splits and merges that real
+tracks do. From a simulation the inputs to each stage of the pipeline can
+be written at any number of frames, cells and image size:
+
+  - the raw frames, as frame_<frameid>.tiff
+  - the labelled segmentation masks, as frame_<frameid>_mask.png
+  - a TrackMate XML file of the Spots, their ROIs and the Edges between them
+  - the TrackMate features and ROI archives that parse_xml.py creates from
+    it, so that the CellPhe stages can be run without depending on the
+    output of parse_xml.py
+
+Used by generate_data.py and run_benchmarks.py.
+"""
+from dataclasses import dataclass
+import math
+import os
+import sys
+import zipfile
+import numpy as np
+import pandas as pd
+from PIL import Image
+from roifile import ImagejRoi
+import tifffile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+from parallel import parallel_map
+
+BACKGROUND_INTENSITY = 1000
+NOISE_SD = 50
+# Minimum distance in pixels between a cell's boundary and the edge of the frame
+EDGE_MARGIN = 3
+
+@dataclass
+class SyntheticTimelapse:
+    """
+    The Spots and Edges of a simulated timelapse.
+
+    :param spots: DataFrame with 1 row per Spot, in frame order, with columns
+        ID, FRAME (0-indexed), TRACK_ID (0-indexed, with a new track after
+        every split as in parse_xml.py), LINEAGE (the TrackMate track, i.e.
+        the connected component, each Spot belongs to), POSITION_X,
+        POSITION_Y, RADIUS and INTENSITY.
+    :param edge_sources: Spot IDs of the source of every Edge.
+    :param edge_targets: Spot IDs of the target of every Edge.
+    :param image_size: Number of rows and columns of each frame.
+    :param n_frames: Number of frames.
+    """
+    spots: pd.DataFrame
+    edge_sources: np.ndarray
+    edge_targets: np.ndarray
+    image_size: int
+    n_frames: int
+
+def simulate(
+    n_frames: int,
+    n_cells: int,
+    image_size: int,
+    split_rate: float = 0.005,
+    merge_rate: float = 0.005,
+    seed: int = 0,
+) -> SyntheticTimelapse:
+    """
+    Simulates cells moving, dividing and merging.
+
+    Each cell takes a random walk with momentum, reflecting off the edges of
+    the frame so that it's always fully inside it. Between frames each cell divides with probability split_rate,
+    into 2 slightly smaller daughters that both link back to it, and merges
+    into its nearest neighbour with probability merge_rate, so the number of
+    cells stays roughly constant when the 2 rates are equal.
+
+    :param n_frames: Number of frames.
+    :param n_cells: Number of cells in the first frame.
+    :param image_size: Number of rows and columns of each frame.
+    :param split_rate: Probability of a cell dividing between frames.
+    :param merge_rate: Probability of a cell merging between frames.
+    :param seed: Random seed.
+    :return: A SyntheticTimelapse.
+    """
+    rng = np.random.default_rng(seed)
+    radius = rng.uniform(5, 12, n_cells)
+    # Limits of each cell's centre, leaving a margin so the ROIs don't touch
+    # the edges of the frame
+    low = lambda r: r + EDGE_MARGIN
+    high = lambda r: image_size - r - EDGE_MARGIN
+    x = rng.uniform(low(radius), high(radius))
+    y = rng.uniform(low(radius), high(radius))
+    vx = np.zeros(n_cells)
+    vy = np.zeros(n_cells)
+    intensity = rng.uniform(1.3, 2.0, n_cells) * BACKGROUND_INTENSITY
+    track = np.arange(n_cells)
+    lineage = np.arange(n_cells)
+    prev_spot = np.full(n_cells, -1)
+    next_track = n_cells
+    # Union-find of lineages, which are joined when cells merge
+    lineage_parent = list(range(n_cells))
+
+    def find(i):
+        while lineage_parent[i] != i:
+            lineage_parent[i] = lineage_parent[lineage_parent[i]]
+            i = lineage_parent[i]
+        return i
+
+    frames = []
+    sources = []
+    targets = []
+    # Spots from the previous frame that merge into a cell, as (spot, cell index)
+    pending_merges = []
+    next_id = 0
+    for frame in range(n_frames):
+        n = x.shape[0]
+        ids = np.arange(next_id, next_id + n)
+        next_id += n
+        frames.append(pd.DataFrame({
+            "ID": ids,
+            "FRAME": frame,
+            "TRACK_ID": track,
+            "LINEAGE": lineage,
+            "POSITION_X": x,
+            "POSITION_Y": y,
+            "RADIUS": radius,
+            "INTENSITY": intensity,
+        }))
+        linked = prev_spot >= 0
+        sources.append(prev_spot[linked])
+        targets.append(ids[linked])
+        for spot, cell in pending_merges:
+            sources.append(np.array([spot]))
+            targets.append(np.array([ids[cell]]))
+        pending_merges = []
+        prev_spot = ids
+        if n == 0:
+            continue
+
+        # Move
+        vx = 0.8 * vx + rng.normal(0, 1, n)
+        vy = 0.8 * vy + rng.normal(0, 1, n)
+        x = x + vx
+        y = y + vy
+        for pos, vel in ((x, vx), (y, vy)):
+            below = pos < low(radius)
+            above = pos > high(radius)
+            pos[below] = 2 * low(radius[below]) - pos[below]
+            pos[above] = 2 * high(radius[above]) - pos[above]
+            vel[below | above] *= -1
+            np.clip(pos, low(radius), high(radius), out=pos)
+
+        # Merge into the nearest cell that isn't itself merging
+        merging = np.flatnonzero(rng.random(n) < merge_rate) if n > 1 else np.zeros(0, dtype=int)
+        keep = np.ones(n, dtype=bool)
+        keep[merging] = False
+        merge_targets = []
+        for i in merging:
+            dist = np.hypot(x - x[i], y - y[i])
+            dist[~keep] = np.inf
+            if not np.isfinite(dist).any():
+                keep[i] = True
+                continue
+            j = int(np.argmin(dist))
+            merge_targets.append((prev_spot[i], j))
+            lineage_parent[find(int(lineage[i]))] = find(int(lineage[j]))
+        new_index = np.cumsum(keep) - 1
+        pending_merges = [(spot, new_index[j]) for spot, j in merge_targets]
+        x, y, vx, vy, radius, intensity, track, lineage, prev_spot = (
+            arr[keep] for arr in (x, y, vx, vy, radius, intensity, track, lineage, prev_spot)
+        )
+
+        # Divide, with the first daughter continuing the track and the second
+        # starting a new one
+        dividing = np.flatnonzero(rng.random(x.shape[0]) < split_rate)
+        if dividing.shape[0] > 0:
+            angle = rng.uniform(0, 2 * np.pi, dividing.shape[0])
+            offset_x = np.cos(angle) * radius[dividing] / 2
+            offset_y = np.sin(angle) * radius[dividing] / 2
+            radius[dividing] = np.maximum(radius[dividing] * 0.85, 4)
+            new_x = np.clip(x[dividing] - offset_x, low(radius[dividing]), high(radius[dividing]))
+            new_y = np.clip(y[dividing] - offset_y, low(radius[dividing]), high(radius[dividing]))
+            x[dividing] = np.clip(x[dividing] + offset_x, low(radius[dividing]), high(radius[dividing]))
+            y[dividing] = np.clip(y[dividing] + offset_y, low(radius[dividing]), high(radius[dividing]))
+            new_track = np.arange(next_track, next_track + dividing.shape[0])
+            next_track += dividing.shape[0]
+            x = np.concatenate([x, new_x])
+            y = np.concatenate([y, new_y])
+            vx = np.concatenate([vx, -vx[dividing]])
+            vy = np.concatenate([vy, -vy[dividing]])
+            radius = np.concatenate([radius, radius[dividing]])
+            intensity = np.concatenate([intensity, intensity[dividing]])
+            track = np.concatenate([track, new_track])
+            lineage = np.concatenate([lineage, lineage[dividing]])
+            prev_spot = np.concatenate([prev_spot, prev_spot[dividing]])
+
+    spots = pd.concat(frames, ignore_index=True)
+    spots["LINEAGE"] = [find(int(i)) for i in spots["LINEAGE"]]
+    return SyntheticTimelapse(
+        spots=spots,
+        edge_sources=np.concatenate(sources + [np.zeros(0, dtype=int)]).astype("int64"),
+        edge_targets=np.concatenate(targets + [np.zeros(0, dtype=int)]).astype("int64"),
+        image_size=image_size,
+        n_frames=n_frames,
+    )
+
+def disk_contour(radius: float) -> np.ndarray:
+    """
+    The boundary of a disk centred on the origin, without any gaps.
+
+    :param radius: Radius of the disk.
+    :return: A 2D array of the integer (x,y) coordinates of the boundary in
+        order, with consecutive points at most 1 pixel apart in each
+        direction.
+    """
+    angles = np.linspace(0, 2 * np.pi, max(8, math.ceil(4 * np.pi * radius)), endpoint=False)
+    coords = np.rint(np.stack([np.cos(angles), np.sin(angles)], axis=1) * radius).astype(int)
+    changed = np.any(coords != np.roll(coords, 1, axis=0), axis=1)
+    return coords[changed]
+
+def render_frame(timelapse: SyntheticTimelapse, frame: int, seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Draws a frame and its segmentation mask.
+
+    :param timelapse: The simulated timelapse.
+    :param frame: The 0-indexed frame to draw.
+    :param seed: Random seed for the background noise.
+    :return: A tuple of the uint16 image and the uint16 mask, where the cells
+        are labelled in the order they appear in the frame's Spots starting
+        from 1. Later cells are drawn over earlier ones where they overlap.
+    """
+    rng = np.random.default_rng([seed, frame])
+    size = timelapse.image_size
+    image = rng.normal(BACKGROUND_INTENSITY, NOISE_SD, (size, size)).astype(np.float32)
+    mask = np.zeros((size, size), dtype=np.uint16)
+    spots = timelapse.spots.loc[timelapse.spots["FRAME"] == frame]
+    for label, (cx, cy, r, intensity) in enumerate(
+        spots[["POSITION_X", "POSITION_Y", "RADIUS", "INTENSITY"]].itertuples(index=False), start=1
+    ):
+        x0, x1 = max(int(cx - r), 0), min(int(cx + r) + 2, size)
+        y0, y1 = max(int(cy - r), 0), min(int(cy + r) + 2, size)
+        yy, xx = np.ogrid[y0:y1, x0:x1]
+        inside = (xx - np.rint(cx)) ** 2 + (yy - np.rint(cy)) ** 2 <= r ** 2
+        image[y0:y1, x0:x1][inside] += intensity - BACKGROUND_INTENSITY
+        mask[y0:y1, x0:x1][inside] = label
+    return np.clip(image, 0, np.iinfo(np.uint16).max).astype(np.uint16), mask
+
+def _write_frame(timelapse: SyntheticTimelapse, frame: int, frame_dir: str, mask_dir: str, seed: int) -> None:
+    """
+    Draws and saves a frame and its mask.
+
+    :param timelapse: The simulated timelapse.
+    :param frame: The 0-indexed frame to draw.
+    :param frame_dir: Directory to save the frame to.
+    :param mask_dir: Directory to save the mask to.
+    :param seed: Random seed for the background noise.
+    :return: None, writes to disk as a side-effect.
+    """
+    image, mask = render_frame(timelapse, frame, seed)
+    tifffile.imwrite(os.path.join(frame_dir, f"frame_{frame + 1:05}.tiff"), image)
+    Image.fromarray(mask).save(os.path.join(mask_dir, f"frame_{frame + 1:05}_mask.png"))
+
+def write_frames(
+    timelapse: SyntheticTimelapse, frame_dir: str, mask_dir: str, seed: int = 0, n_workers: int = 1
+) -> None:
+    """
+    Saves every frame as frame_<frameid>.tiff and its mask as
+    frame_<frameid>_mask.png, with the FrameID 1-indexed and 0 padded to 5
+    digits as in the pipeline.
+
+    :param timelapse: The simulated timelapse.
+    :param frame_dir: Directory to save the frames to.
+    :param mask_dir: Directory to save the masks to.
+    :param seed: Random seed for the background noise.
+    :param n_workers: Number of frames to draw in parallel.
+    :return: None, writes to disk as a side-effect.
+    """
+    os.makedirs(frame_dir, exist_ok=True)
+    os.makedirs(mask_dir, exist_ok=True)
+    frames = range(timelapse.n_frames)
+    args = ([timelapse] * len(frames), frames, [frame_dir] * len(frames), [mask_dir] * len(frames), [seed] * len(frames))
+    list(parallel_map(_write_frame, n_workers, *args))
+
+def spot_features(timelapse: SyntheticTimelapse) -> pd.DataFrame:
+    """
+    The TrackMate Spot features of every Spot.
+
+    :param timelapse: The simulated timelapse.
+    :return: A DataFrame with 1 row per Spot and the columns that
+        parse_xml.py outputs, other than TRACK_ID and ROI_FILENAME. FRAME is
+        0-indexed as in TrackMate.
+    """
+    spots = timelapse.spots
+    radius = spots["RADIUS"].values
+    intensity = spots["INTENSITY"].values
+    area = np.pi * radius ** 2
+    perimeter = 2 * np.pi * radius
+    return pd.DataFrame({
+        "LABEL": "ID" + spots["ID"].astype(str),
+        "ID": spots["ID"].values,
+        "QUALITY": area,
+        "POSITION_X": spots["POSITION_X"].values,
+        "POSITION_Y": spots["POSITION_Y"].values,
+        "POSITION_Z": 0.0,
+        "POSITION_T": spots["FRAME"].values.astype(float),
+        "FRAME": spots["FRAME"].values,
+        "RADIUS": radius,
+        "VISIBILITY": 1.0,
+        "MEAN_INTENSITY_CH1": intensity,
+        "MEDIAN_INTENSITY_CH1": intensity,
+        "MIN_INTENSITY_CH1": intensity - 3 * NOISE_SD,
+        "MAX_INTENSITY_CH1": intensity + 3 * NOISE_SD,
+        "TOTAL_INTENSITY_CH1": intensity * area,
+        "STD_INTENSITY_CH1": float(NOISE_SD),
+        "CONTRAST_CH1": (intensity - BACKGROUND_INTENSITY) / (intensity + BACKGROUND_INTENSITY),
+        "SNR_CH1": (intensity - BACKGROUND_INTENSITY) / NOISE_SD,
+        "AREA": area,
+        "PERIMETER": perimeter,
+        "CIRCULARITY": 4 * np.pi * area / perimeter ** 2,
+        "SOLIDITY": 1.0,
+        "SHAPE_INDEX": perimeter / np.sqrt(area),
+    })
+
+def write_trackmate_xml(timelapse: SyntheticTimelapse, filename: str) -> None:
+    """
+    Saves the timelapse in TrackMate's XML format.
+
+    Only the parts of the format that parse_xml.py reads are written: the
+    Spots with their features and ROI contours relative to their centre,
+    grouped by frame, and the Edges grouped into 1 Track per lineage. The
+    file is written as it's generated so it can be larger than memory.
+
+    :param timelapse: The simulated timelapse.
+    :param filename: Path to save the XML to.
+    :return: None, writes to disk as a side-effect.
+    """
+    features = spot_features(timelapse)
+    attributes = features.columns.drop("LABEL")
+    int_columns = {"ID", "FRAME"}
+    contours = {}
+    edge_lineage = timelapse.spots.set_index("ID")["LINEAGE"].loc[timelapse.edge_sources].values
+    with open(filename, "w") as outfile:
+        outfile.write('<?xml version="1.0" encoding="UTF-8"?>\n<TrackMate version="7.11.1">\n')
+        outfile.write('  <Model spatialunits="pixel" timeunits="frame">\n')
+        outfile.write(f'    <AllSpots nspots="{features.shape[0]}">\n')
+        for frame, frame_spots in features.groupby("FRAME", sort=True):
+            outfile.write(f'      <SpotsInFrame frame="{frame}">\n')
+            for spot in frame_spots.itertuples(index=False):
+                spot = spot._asdict()
+                attrs = " ".join(
+                    f'{key}="{int(spot[key]) if key in int_columns else float(spot[key])!r}"' for key in attributes
+                )
+                # Contours are reused between Spots of the same (rounded) radius
+                radius = round(spot["RADIUS"], 1)
+                if radius not in contours:
+                    contours[radius] = " ".join(f"{v:.1f}" for v in disk_contour(radius).ravel())
+                outfile.write(f'        <Spot name="{spot["LABEL"]}" {attrs} ROI_N_POINTS="{len(contours[radius].split()) // 2}">{contours[radius]}</Spot>\n')
+            outfile.write('      </SpotsInFrame>\n')
+        outfile.write('    </AllSpots>\n    <AllTracks>\n')
+        order = np.argsort(edge_lineage, kind="stable")
+        lineages, starts = np.unique(edge_lineage[order], return_index=True)
+        ends = np.append(starts[1:], order.shape[0])
+        for track_id, (lineage, start, end) in enumerate(zip(lineages, starts, ends)):
+            outfile.write(f'      <Track name="Track_{track_id}" TRACK_ID="{track_id}">\n')
+            for edge in order[start:end]:
+                outfile.write(
+                    f'        <Edge SPOT_SOURCE_ID="{timelapse.edge_sources[edge]}" SPOT_TARGET_ID="{timelapse.edge_targets[edge]}" LINK_COST="0.0"/>\n'
+                )
+            outfile.write('      </Track>\n')
+        outfile.write('    </AllTracks>\n    <FilteredTracks>\n')
+        for track_id in range(lineages.shape[0]):
+            outfile.write(f'      <TrackID TRACK_ID="{track_id}"/>\n')
+        outfile.write('    </FilteredTracks>\n  </Model>\n</TrackMate>\n')
+
+def write_trackmate_outputs(timelapse: SyntheticTimelapse, csv_path: str, rois_path: str, shard_dir: str) -> pd.DataFrame:
+    """
+    Saves the TrackMate features and ROI archives in the format output by
+    parse_xml.py, i.e. trackmate_features.csv, rois.zip and 1 archive per
+    frame named frame_<frameid>_rois.zip.
+
+    :param timelapse: The simulated timelapse.
+    :param csv_path: Path to save the features to.
+    :param rois_path: Path to save the archive of every ROI to.
+    :param shard_dir: Directory to save the per-frame ROI archives to.
+    :return: The features.
+    """
+    df = spot_features(timelapse)
+    df.insert(2, "TRACK_ID", timelapse.spots["TRACK_ID"].values + 1)
+    df["FRAME"] = df["FRAME"] + 1
+    n_digits_track_id = len(str(df["TRACK_ID"].max()))
+    n_digits_frame_id = len(str(df["FRAME"].max()))
+    n_digits_spot_id = len(str(df["ID"].max()))
+    df["ROI_FILENAME"] = (
+        df["FRAME"].astype(str).str.pad(n_digits_frame_id, fillchar="0")
+        + "-"
+        + df["TRACK_ID"].astype(str).str.pad(n_digits_track_id, fillchar="0")
+        + "-"
+        + df["ID"].astype(str).str.pad(n_digits_spot_id, fillchar="0")
+    )
+    df.to_csv(csv_path, index=False)
+
+    os.makedirs(shard_dir, exist_ok=True)
+    centres = np.rint(df[["POSITION_X", "POSITION_Y"]].values).astype(int)
+    with zipfile.ZipFile(rois_path, "w") as zf:
+        for frame, frame_rows in df.groupby("FRAME", sort=True).indices.items():
+            with zipfile.ZipFile(os.path.join(shard_dir, f"frame_{frame:05}_rois.zip"), "w") as shard:
+                for row in frame_rows:
+                    # Same contours as write_trackmate_xml
+                    roi = ImagejRoi.frompoints(disk_contour(round(df["RADIUS"].values[row], 1)) + centres[row])
+                    roi.position = int(frame)
+                    roi.name = df["ROI_FILENAME"].values[row]
+                    roi_bytes = roi.tobytes()
+                    zf.writestr(f"{roi.name}.roi", roi_bytes)
+                    shard.writestr(f"{roi.name}.roi", roi_bytes)
+    return df
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+import argparse
+import pyarrow as pa
+import pyarrow.parquet as pq
+from profiling import Profile
+
+parser = argparse.ArgumentParser(
+                    description='Combines the static frame features from every frame into a single Parquet file, sorted by cell and then frame'
+)
+parser.add_argument('output', help="Output Parquet file")
+parser.add_argument('frame_files', nargs='+', help="Parquet files of frame features to combine")
+parser.add_argument('--row-group-size', help="Number of rows in each row group of the output, which is the unit it's read back in", default=100000, type=int)
+parser.add_argument('--profile', help="Path to save a JSON profile of the time and memory used")
+args = parser.parse_args()
+
+profile = Profile(args.profile)
+profile.add_inputs(args.frame_files)
+profile.phase("read")
+tables = [pq.read_table(fn) for fn in args.frame_files]
+# Frames without any cells don't have the column types, so only keep them if
+# there's nothing else to write
+non_empty = [table for table in tables if table.num_rows > 0]
+if len(non_empty) > 0:
+    tables = non_empty
+else:
+    tables = tables[:1]
+combined = pa.concat_tables(tables)
+profile.record(frames=len(args.frame_files), rows=combined.num_rows)
+profile.phase("sort")
+# The summary features are calculated a chunk of cells at a time so need each
+# cell's rows to be together
+combined = combined.sort_by([("CellID", "ascending"), ("FrameID", "ascending")])
+profile.phase("write")
+pq.write_table(combined, args.output, row_group_size=args.row_group_size)
+profile.save()
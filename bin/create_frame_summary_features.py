@@ -1,72 +1,248 @@
 #!/usr/bin/env python
-from cellphe.input import import_data
 from cellphe.features.frame import STATIC_FEATURE_NAMES
 import argparse
 import pandas as pd
 import numpy as np
+from scipy.spatial import cKDTree
+from parallel import parallel_map
+from profiling import Profile
+from tables import TableWriter, iter_table, read_table, read_trackmate, write_table
 
-parser = argparse.ArgumentParser(
-                    description='Creates the temporal frame features (density, velocity etc...)'
-)
-parser.add_argument('frame_features', help="The static frame features CSV")
-parser.add_argument('trackmate', help="The original Trackmate CSV")
-parser.add_argument('output', help="Where to save the resultant file with the added features")
-parser.add_argument('--framerate', help="Cell framerate", default=0.0028, type=float)
-args = parser.parse_args()
+MOVEMENT_FEATURE_NAMES = ["Dis", "Trac", "D2T", "Vel"]
 
-# Read in the combined static features
-feature_df = pd.read_csv(args.frame_features)
-trackmate_df = import_data(args.trackmate, "Trackmate_auto")
-
-# Movement features
-# Overall distance since starting point
-start_vals = feature_df.loc[feature_df.groupby("CellID")["FrameID"].idxmin(), ["CellID", "x", "y"]]
-start_vals.rename(columns={"x": "x_start", "y": "y_start"}, inplace=True)
-feature_df = feature_df.merge(start_vals, on="CellID")
-# Order in time so movement features are accurate
-feature_df.sort_values(["CellID", "FrameID"], inplace=True)
-feature_df["Dis"] = np.sqrt(
-    (feature_df["x"] - feature_df["x_start"]) ** 2 + (feature_df["y"] - feature_df["y_start"]) ** 2
-)
+def frame_density(frame_df: pd.DataFrame, radius_threshold: float = 6) -> pd.DataFrame:
+    """
+    Calculates the cellular density of every cell in a single frame.
+
+    This is the total inverse distance from a cell to every other cell that
+    lies within radius_threshold times its radius, giving the same values as
+    cellphe.features.frame.calculate_density. Rather than calculating the full
+    distance matrix, only the pairs of cells that are close enough to
+    contribute are found, using a KD-tree.
+
+    :param frame_df: DataFrame with columns CellID, x, y, and Rad for the cells
+        in one frame.
+    :param radius_threshold: Other cells are included if they are closer than
+        this multiple of a cell's radius.
+    :return: A DataFrame with columns CellID and dens, with a row for every
+        cell that has at least 1 other cell within its threshold.
+    """
+    max_radius = radius_threshold * frame_df["Rad"].max()
+    if not np.isfinite(max_radius):
+        return pd.DataFrame(columns=["CellID", "dens"])
+    coords = frame_df[["x", "y"]].values
+    pairs = cKDTree(coords).query_pairs(max_radius, output_type="ndarray")
+    # Each pair is only returned once, but contributes to both cells
+    pairs = np.concatenate([pairs, pairs[:, ::-1]])
+    cell_ids = frame_df["CellID"].values
+    pairs_df = pd.DataFrame({
+        "CellID": cell_ids[pairs[:, 0]],
+        "Cell2": cell_ids[pairs[:, 1]],
+        "dist": np.linalg.norm(coords[pairs[:, 0]] - coords[pairs[:, 1]], axis=1),
+    })
+    pairs_df = pairs_df.loc[pairs_df["CellID"] != pairs_df["Cell2"]]
+
+    # Restrict to cells within the threshold of each cell's own radius
+    pairs_df = pairs_df.merge(frame_df[["CellID", "Rad"]], on="CellID")
+    pairs_df = pairs_df.loc[pairs_df["dist"] < radius_threshold * pairs_df["Rad"]]
+
+    # Calculate density as the sum of inverse distance to each other cell
+    pairs_df["dens"] = 1 / pairs_df["dist"]
+    return pairs_df.groupby("CellID", as_index=False)["dens"].sum()
+
+def calculate_density(df: pd.DataFrame, radius_threshold: float = 6, n_workers: int = 1) -> pd.DataFrame:
+    """
+    Calculates cellular density at each frame.
+
+    Each frame is processed independently, optionally in parallel, so that
+    memory usage is bounded by the number of cells in a frame.
+
+    :param df: DataFrame with columns FrameID, CellID, x, y, and Rad.
+    :param radius_threshold: Other cells are included if they are closer than
+        this multiple of a cell's radius.
+    :param n_workers: Number of processes to spread the frames across.
+    :return: A DataFrame with columns FrameID, CellID, and dens.
+    """
+    frame_ids = []
+    frame_dfs = []
+    for frame_id, frame_df in df[["FrameID", "CellID", "x", "y", "Rad"]].groupby("FrameID"):
+        frame_ids.append(frame_id)
+        frame_dfs.append(frame_df)
+
+    results = list(parallel_map(frame_density, n_workers, frame_dfs, [radius_threshold] * len(frame_dfs)))
+
+    for frame_id, res in zip(frame_ids, results):
+        res.insert(0, "FrameID", frame_id)
+    if len(results) == 0:
+        return pd.DataFrame(columns=["FrameID", "CellID", "dens"])
+    return pd.concat(results, ignore_index=True)
+
+def add_movement_features(feature_df: pd.DataFrame, framerate: float) -> pd.DataFrame:
+    """
+    Adds the movement features Dis, Trac, D2T, and Vel.
 
-# Frame by frame distance and speed
-feature_df["x_diff"] = feature_df.groupby("CellID")["x"].transform("diff")
-feature_df["y_diff"] = feature_df.groupby("CellID")["y"].transform("diff")
-feature_df["frame_dist"] = np.sqrt(feature_df["x_diff"] ** 2 + feature_df["y_diff"] ** 2)
-feature_df.loc[pd.isna(feature_df["frame_dist"]), "frame_dist"] = 0
+    Every observation of a cell must be present in feature_df, although it can
+    be a subset of the cells, so that the features can be calculated on chunks
+    of cells at a time.
 
-# Cumulative distance moved and ratio to distance from start
-feature_df["Trac"] = feature_df.groupby("CellID")["frame_dist"].transform("cumsum")
-feature_df["D2T"] = feature_df["Dis"] / feature_df["Trac"]
-feature_df.loc[pd.isna(feature_df["D2T"]), "D2T"] = 0
+    The features are calculated in a single pass over the rows sorted by cell
+    and frame, with the differences between consecutive rows masked at the
+    boundaries between cells rather than grouping the rows by cell.
 
-# Velocity
-feature_df["FrameID_diff"] = feature_df.groupby("CellID")["FrameID"].transform("diff")
-# Doesn't matter what this is set to as it's only used for the first
-# appearance of a cell, in which case the numerator will be 0. Just need it
-# to be non-NA and non-0 (as that causes Infs)
-feature_df.loc[pd.isna(feature_df["FrameID_diff"]), "FrameID_diff"] = 1
-feature_df["Vel"] = (args.framerate * feature_df["frame_dist"]) / feature_df["FrameID_diff"]
+    :param feature_df: DataFrame with columns CellID, FrameID, x, and y.
+    :param framerate: Cell framerate, used to calculate velocity.
+    :return: feature_df sorted by CellID and FrameID, with the 4 movement
+        features added.
+    """
+    # Order in time so movement features are accurate, then find where each
+    # cell's rows start
+    feature_df = feature_df.sort_values(["CellID", "FrameID"], kind="stable")
+    cell_ids = feature_df["CellID"].values
+    x = feature_df["x"].values.astype("float64")
+    y = feature_df["y"].values.astype("float64")
+    frame_ids = feature_df["FrameID"].values
+    is_start = np.ones(cell_ids.size, dtype=bool)
+    is_start[1:] = cell_ids[1:] != cell_ids[:-1]
+    starts = np.maximum.accumulate(np.where(is_start, np.arange(cell_ids.size), 0))
 
-# Drop intermediate columns
-feature_df.drop(columns=["x_start", "y_start", "x_diff", "y_diff", "frame_dist", "FrameID_diff"], inplace=True)
+    # Overall distance since starting point
+    dis = np.sqrt((x - x[starts]) ** 2 + (y - y[starts]) ** 2)
 
-# Add on the original columns
-feature_df = feature_df.merge(trackmate_df, on=["CellID", "FrameID", "ROI_filename"])
+    # Frame by frame distance, which is 0 for the first observation of a cell
+    frame_dist = np.sqrt(np.diff(x, prepend=np.nan) ** 2 + np.diff(y, prepend=np.nan) ** 2)
+    frame_dist[is_start | np.isnan(frame_dist)] = 0
 
-# Add density
-# TODO: doesn't work with large datasets, runs out of memory
-#dens = cellphe.features.frame.calculate_density(feature_df)
-#feature_df = feature_df.merge(dens, how="left", on=["FrameID", "CellID"])
-#feature_df.loc[pd.isna(feature_df["dens"]), "dens"] = 0
-feature_df['dens'] = 0
+    # Cumulative distance moved and ratio to distance from start. The sum
+    # restarts for each cell rather than subtracting from a running total, so
+    # it doesn't pick up rounding errors from the earlier cells
+    trac = pd.Series(frame_dist).groupby(np.cumsum(is_start)).cumsum().values
+    with np.errstate(divide="ignore", invalid="ignore"):
+        d2t = dis / trac
+    d2t[np.isnan(d2t)] = 0
 
-# Reorder columns
-col_order = trackmate_df.columns.values.tolist() + ["Dis", "Trac", "D2T", "Vel"] + STATIC_FEATURE_NAMES + ["dens"]
-feature_df = feature_df[col_order]
+    # Velocity. The time since the previous observation is only used for the
+    # first appearance of a cell when the distance is 0, so just needs to be
+    # non-0 to avoid Infs
+    frame_id_diff = np.diff(frame_ids, prepend=0).astype("float64")
+    frame_id_diff[is_start] = 1
+    vel = (framerate * frame_dist) / frame_id_diff
+
+    feature_df["Dis"] = dis
+    feature_df["Trac"] = trac
+    feature_df["D2T"] = d2t
+    feature_df["Vel"] = vel
+    return feature_df
+
+def finalise_features(feature_df: pd.DataFrame, trackmate_df: pd.DataFrame, dens: pd.DataFrame) -> pd.DataFrame:
+    """
+    Combines the frame features with the original TrackMate columns and the
+    density, returning the columns in their output order.
+
+    :param feature_df: DataFrame of static and movement features.
+    :param trackmate_df: DataFrame of the TrackMate output from read_trackmate.
+    :param dens: DataFrame with columns FrameID, CellID, and dens.
+    :return: A DataFrame ready to be written out.
+    """
+    # Add on the original columns
+    feature_df = feature_df.merge(trackmate_df, on=["CellID", "FrameID", "ROI_filename"])
+
+    # Add density
+    feature_df = feature_df.merge(dens, how="left", on=["FrameID", "CellID"])
+    feature_df.loc[pd.isna(feature_df["dens"]), "dens"] = 0
+
+    # Reorder columns
+    col_order = trackmate_df.columns.values.tolist() + MOVEMENT_FEATURE_NAMES + STATIC_FEATURE_NAMES + ["dens"]
+    feature_df = feature_df[col_order]
+
+    # Set data types for anything that isn't float
+    feature_df["Area"] = feature_df["Area"].astype("int")
+    return feature_df
+
+def read_cell_chunks(filename: str, chunksize: int):
+    """
+    Reads the frame features in chunks that only contain complete cells.
+
+    The rows of a cell that may continue into the next chunk of the file are
+    held back and prepended onto it.
+
+    :param filename: Frame features CSV or Parquet file, sorted by CellID.
+    :param chunksize: Number of rows to read from the file at a time.
+    :return: A generator of DataFrames.
+    """
+    carry = None
+    for chunk in iter_table(filename, chunksize):
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index=True)
+        if chunk.shape[0] == 0:
+            continue
+        if not chunk["CellID"].is_monotonic_increasing:
+            raise ValueError(f"{filename} must be sorted by CellID to be read in chunks")
+        last_cell = chunk["CellID"].values[-1]
+        is_last = chunk["CellID"].values == last_cell
+        carry = chunk.loc[is_last]
+        if not is_last.all():
+            yield chunk.loc[~is_last]
+    if carry is not None and carry.shape[0] > 0:
+        yield carry
+
+parser = argparse.ArgumentParser(
+                    description='Creates the temporal frame features (density, velocity etc...)'
+)
+parser.add_argument('frame_features', help="The static frame features, as CSV or Parquet")
+parser.add_argument('trackmate', help="The original Trackmate features, as CSV or Parquet")
+parser.add_argument('output', help="Where to save the resultant file with the added features")
+parser.add_argument('--parquet-path', help="Path to additionally save the features to in Parquet format, which is faster for the later steps to read")
+parser.add_argument('--framerate', help="Cell framerate", default=0.0028, type=float)
+parser.add_argument('--workers', help="Number of processes to use when calculating density", default=1, type=int)
+parser.add_argument(
+    '--chunksize',
+    help="Process the frame features this many rows at a time, rather than reading them all into memory. The frame features must be sorted by CellID.",
+    default=None,
+    type=int,
+)
+parser.add_argument('--profile', help="Path to save a JSON profile of the time and memory used")
+args = parser.parse_args()
 
-# Set data types for anything that isn't float
-feature_df["Area"] = feature_df["Area"].astype("int")
+profile = Profile(args.profile, workers=args.workers)
+profile.add_inputs(args.frame_features, args.trackmate)
+profile.phase("read")
+trackmate_df = read_trackmate(args.trackmate)
+profile.record(rows=trackmate_df.shape[0], cells=trackmate_df["CellID"].nunique())
+output_fns = [args.output] if args.parquet_path is None else [args.output, args.parquet_path]
 
-feature_df.to_csv(args.output, index=False)
+if args.chunksize is None:
+    # Read in the combined static features
+    feature_df = read_table(args.frame_features)
+    profile.phase("features")
+    feature_df = add_movement_features(feature_df, args.framerate)
+    dens = calculate_density(
+        feature_df.merge(trackmate_df, on=["CellID", "FrameID", "ROI_filename"]),
+        n_workers=args.workers,
+    )
+    feature_df = finalise_features(feature_df, trackmate_df, dens)
+    profile.phase("write")
+    for output_fn in output_fns:
+        write_table(feature_df, output_fn)
+else:
+    # Density needs every cell in a frame, so it's calculated up front from
+    # just the columns it requires before streaming through the cells
+    position_df = read_table(args.frame_features, columns=["FrameID", "CellID", "ROI_filename", "x", "y", "Rad"])
+    position_df = position_df.merge(trackmate_df, on=["CellID", "FrameID", "ROI_filename"])
+    profile.phase("density")
+    dens = calculate_density(position_df, n_workers=args.workers)
+    del position_df
 
+    profile.phase("features")
+    writers = [TableWriter(output_fn) for output_fn in output_fns]
+    for feature_df in read_cell_chunks(args.frame_features, args.chunksize):
+        feature_df = add_movement_features(feature_df, args.framerate)
+        feature_df = finalise_features(feature_df, trackmate_df, dens)
+        for writer in writers:
+            writer.write(feature_df)
+    for writer in writers:
+        if writer.n_chunks == 0:
+            # No cells so just write the header
+            col_order = trackmate_df.columns.values.tolist() + MOVEMENT_FEATURE_NAMES + STATIC_FEATURE_NAMES + ["dens"]
+            write_table(pd.DataFrame(columns=col_order), writer.filename)
+        writer.close()
+profile.save()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+import argparse
+import io
+from pathlib import Path
+import zipfile
+import tifffile
+from ome_frames import is_frame_ref, open_frame
+from profiling import Profile
+
+def add_frame(archive: zipfile.ZipFile, fn: str) -> None:
+    """
+    Adds a frame to the archive as its own TIFF.
+
+    :param archive: The open archive.
+    :param fn: Path to the frame image, or to an OME-TIFF frame reference,
+        whose page is decoded and saved as frame_<frameid>.tiff.
+    :return: None, writes to the archive as a side-effect.
+    """
+    if not is_frame_ref(fn):
+        archive.write(fn, Path(fn).name)
+        return
+    buffer = io.BytesIO()
+    tifffile.imwrite(buffer, open_frame(fn))
+    archive.writestr(f"{Path(fn).stem}.tiff", buffer.getvalue())
+
+parser = argparse.ArgumentParser(
+                    description='Archives the frames of a timelapse as 1 TIFF per frame'
+)
+parser.add_argument('frames', help="Space separated list of frame images, or OME-TIFF frame references, to archive")
+parser.add_argument('output', help="Path to the zip archive to create")
+parser.add_argument('--profile', help="Path to save a JSON profile of the time and memory used")
+args = parser.parse_args()
+
+fns = args.frames.split(" ")
+profile = Profile(args.profile)
+profile.add_inputs(fns)
+profile.record(frames=len(fns))
+profile.phase("write")
+with zipfile.ZipFile(args.output, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+    for fn in fns:
+        add_frame(archive, fn)
+profile.save()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+import argparse
+from collections import defaultdict
+import glob
+import json
+import os
+import numpy as np
+from scipy.optimize import nnls
+from profiling import task_memory_mb
+
+# The measurements of a task's inputs that nextflow.config can also take
+# before submitting it
+PREDICTORS = ["input_bytes", "input_files"]
+
+def load_profiles(paths: list[str]) -> dict[str, list[dict]]:
+    """
+    Loads the profiles saved by the scripts' --profile option.
+
+    :param paths: Profile JSON files, or directories containing them.
+    :return: A dict mapping each script's name to a list of its profiles.
+    """
+    fns = []
+    for path in paths:
+        if os.path.isdir(path):
+            fns.extend(sorted(glob.glob(os.path.join(path, "*.json"))))
+        else:
+            fns.append(path)
+    profiles = defaultdict(list)
+    for fn in fns:
+        with open(fn) as infile:
+            profile = json.load(infile)
+        profiles[profile["script"]].append(profile)
+    return profiles
+
+def fit_resource(profiles: list[dict], usage: np.ndarray, margin: float, minimum: float) -> dict:
+    """
+    Fits a linear model of a resource's usage against the size of the inputs.
+
+    The coefficients are constrained to be non-negative, so larger inputs
+    never request less. The predictions are then scaled up until none of
+    the profiled tasks would have been given less than they used, and then
+    by the safety margin on top.
+
+    :param profiles: The profiles of a single script.
+    :param usage: The resource used by each profiled task.
+    :param margin: Factor to multiply every request by.
+    :param minimum: The smallest request to make.
+    :return: A dict with the intercept and the coefficient of each predictor,
+        along with the scale and minimum request, as read by model_request
+        in nextflow.config.
+    """
+    X = np.array([[1.0] + [profile[predictor] for predictor in PREDICTORS] for profile in profiles])
+    # Bytes and file counts differ by orders of magnitude, so put them on the
+    # same scale for the solver
+    col_scale = np.abs(X).max(axis=0)
+    col_scale[col_scale == 0] = 1
+    coefs, _ = nnls(X / col_scale, usage)
+    coefs = coefs / col_scale
+    predicted = X @ coefs
+    underestimate = np.max(usage / np.maximum(predicted, 1e-9))
+    return {
+        "intercept": coefs[0],
+        **dict(zip(PREDICTORS, coefs[1:])),
+        "scale": margin * max(1.0, underestimate),
+        "minimum": minimum,
+    }
+
+parser = argparse.ArgumentParser(
+                    description="Fits a model of each script's memory and time usage from the size of its inputs, for nextflow.config to request resources with"
+)
+parser.add_argument('output', help="Path to save the model JSON to")
+parser.add_argument('profiles', nargs='+', help="Profile JSON files saved by the scripts' --profile option, or directories containing them")
+parser.add_argument('--margin', help="Factor to multiply every predicted request by", default=1.2, type=float)
+parser.add_argument('--min-profiles', help="Minimum number of profiles of a script to fit a model to, scripts with fewer keep the default requests", default=3, type=int)
+parser.add_argument('--min-memory-mb', help="Smallest memory request in MB", default=512, type=float)
+parser.add_argument('--min-minutes', help="Smallest time request in minutes, which should cover starting the container", default=5, type=float)
+args = parser.parse_args()
+
+model = {"scripts": {}}
+for script, profiles in sorted(load_profiles(args.profiles).items()):
+    if len(profiles) < args.min_profiles:
+        print(f"{script}: skipped, only {len(profiles)} profiles")
+        continue
+    memory = np.array([task_memory_mb(profile) for profile in profiles])
+    minutes = np.array([profile["wall_seconds"] / 60 for profile in profiles])
+    model["scripts"][script] = {
+        "profiles": len(profiles),
+        "memory_mb": fit_resource(profiles, memory, args.margin, args.min_memory_mb),
+        "time_minutes": fit_resource(profiles, minutes, args.margin, args.min_minutes),
+    }
+    print(f"{script}: fitted to {len(profiles)} profiles, up to {memory.max():.0f} MB and {minutes.max():.1f} minutes")
+
+with open(args.output, "w") as outfile:
+    json.dump(model, outfile, indent=2)
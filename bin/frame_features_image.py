@@ -1,79 +1,293 @@
 #!/usr/bin/env python
 from cellphe.features.frame import extract_static_features, STATIC_FEATURE_NAMES
-from cellphe.input import read_rois, read_tiff, import_data
-from cellphe.processing import normalise_image
 import argparse
-import re
 import os
+import zipfile
 import numpy as np
 import pandas as pd
 from PIL import Image
+from roifile import ImagejRoi
+import tifffile
+from tables import is_parquet, write_table
+from frame_files import get_frame_id
+from ome_frames import is_frame_ref, open_frame
+from frame_store import FrameStore, FrameView
+from parallel import parallel_map
+from profiling import Profile
 
 parser = argparse.ArgumentParser(
                     description='Tracks a given image'
 )
-parser.add_argument('trackmate_file', help="Input trackmate CSV file")
-parser.add_argument('image_file', help="Input frame filepath")
-parser.add_argument('roi_file', help="Input ROIs archive")
+parser.add_argument('trackmate_file', help="Input trackmate CSV or Parquet file")
+parser.add_argument('image_file', help="Input frame filepath, or a space separated list of frames. Frames can also be OME-TIFF frame references")
+parser.add_argument('roi_file', help="Input ROIs archive(s). Either a single archive containing every frame, or a space separated list with 1 archive per frame")
+parser.add_argument('--workers', help="Number of frames to process in parallel", default=1, type=int)
+parser.add_argument('--crop', action='store_true', help="Only normalise the region around each cell rather than the whole frame, to reduce memory usage on large images")
+parser.add_argument('--crop-padding', help="Number of pixels to pad around each cell's bounding box when using --crop", default=2, type=int)
+parser.add_argument('--frame-store', help="Read the frames from this frame store rather than the frame files, which are then only used for their FrameIDs", default=None)
+parser.add_argument('--format', help="File format to save the features of each frame in", choices=["csv", "parquet"], default="csv")
+parser.add_argument('--profile', help="Path to save a JSON profile of the time and memory used")
 args = parser.parse_args()
 
+def open_pixels(source):
+    """
+    Opens a frame that isn't stored in its own image file, without reading it.
+
+    :param source: An OME-TIFF frame reference, a FrameView of a frame store,
+        or a path to an image file.
+    :return: An array-like of pixels that are read when accessed, or None if
+        source is an image file.
+    """
+    if isinstance(source, FrameView):
+        return source
+    if is_frame_ref(source):
+        return open_frame(source)
+    return None
+
 def load_image(path):
-    image = Image.open(path)
+    pixels = open_pixels(path)
+    image = Image.open(path) if pixels is None else Image.fromarray(np.asarray(pixels))
     if (image.mode == 'RGB'):
         image = image.convert('L')
     image = np.array(image)
     image = (image - image.min()) / (image.max() - image.min())
     return image.astype("float32")
 
-def get_index(fn):
-    res = re.search(r"frame_([0-9]+)\.[jpg|jpeg|tif|tiff|JPG|JPEG|TIF|TIFF]", fn)
-    if res is None:
-        return None
+def open_raw_image(path):
+    """
+    Opens a frame in its original data type without normalising it.
+
+    Uncompressed single channel TIFFs are memory-mapped so that pixels are
+    only read from disk when they are accessed, otherwise the frame is
+    decoded in the same way as load_image. Frames that are a page of an
+    OME-TIFF, or are in a frame store, are likewise only read when accessed.
+
+    :param path: Path to the frame, an OME-TIFF frame reference, or a
+        FrameView of a frame store.
+    :return: A 2D array-like of pixels.
+    """
+    pixels = open_pixels(path)
+    if pixels is not None:
+        if pixels.ndim == 2:
+            return pixels
+        image = Image.fromarray(np.asarray(pixels))
+        if (image.mode == 'RGB'):
+            image = image.convert('L')
+        return np.array(image)
+    try:
+        with tifffile.TiffFile(path) as tif:
+            page = tif.pages[0]
+            mappable = len(tif.pages) == 1 and page.is_memmappable and len(page.shape) == 2
+    except tifffile.TiffFileError:
+        mappable = False
+    if mappable:
+        return tifffile.memmap(path, mode="r")
+    image = Image.open(path)
+    if (image.mode == 'RGB'):
+        image = image.convert('L')
+    return np.array(image)
+
+class Frame:
+    """
+    A frame that has been fully loaded and normalised to 0-1 up front.
+    """
+    def __init__(self, path):
+        self.image = load_image(path)
+
+    def region(self, roi):
+        """
+        Returns the image to extract the features of a cell from.
+
+        :param roi: The cell's ROI.
+        :return: A tuple of the normalised image and the (x,y) offset of its
+            top left corner in the frame.
+        """
+        return self.image, np.zeros(2, dtype=int)
+
+class CroppedFrame(Frame):
+    """
+    A frame that is normalised to 0-1 one cell at a time.
+
+    The minimum and maximum pixel values are calculated once over the whole
+    frame, which is read in blocks of rows. Each cell is then given a padded
+    bounding box cropped from the raw frame and normalised with these global
+    statistics, so that the values are identical to those from Frame but peak
+    memory is driven by the size of the cells rather than the frame.
+    """
+    def __init__(self, path, padding=2, block_rows=1024):
+        self.pixels = open_raw_image(path)
+        self.padding = padding
+        self.min = None
+        self.max = None
+        for start in range(0, self.pixels.shape[0], block_rows):
+            block = np.asarray(self.pixels[start:(start + block_rows)])
+            block_min = block.min()
+            block_max = block.max()
+            self.min = block_min if self.min is None else min(self.min, block_min)
+            self.max = block_max if self.max is None else max(self.max, block_max)
+
+    def region(self, roi):
+        offset = np.maximum(roi.min(axis=0) - self.padding, 0)
+        xmax, ymax = roi.max(axis=0) + self.padding + 1
+        crop = np.asarray(self.pixels[offset[1]:ymax, offset[0]:xmax])
+        crop = (crop - self.min) / (self.max - self.min)
+        return crop.astype("float32"), offset
+
+def read_frame_rois(archive, roi_filenames):
+    """
+    Reads a subset of the ROIs saved in a Zip archive.
+
+    Equivalent to cellphe.input.read_rois, but only the requested ROIs are
+    read so the cost is proportional to the number of cells in this frame
+    rather than the size of the archive.
+
+    :param archive: Filepath to an archive containing ROI files.
+    :param roi_filenames: The ROI filenames to read, without the .roi
+        extension. Any that aren't present in the archive are skipped.
+    :return: A dict where each entry is a 2D numpy array containing the
+        coordinates, and the keys are the ROI filenames with the .roi
+        extension.
+    """
+    rois = {}
+    with zipfile.ZipFile(archive) as zf:
+        for roi_fn in roi_filenames:
+            name = f"{roi_fn}.roi"
+            try:
+                raw = zf.read(name)
+            except KeyError:
+                continue
+            roi = ImagejRoi.frombytes(raw)
+            # Want the integer coordinates rather than the subpixel ones
+            rois[name] = roi.integer_coordinates + [roi.left, roi.top]
+    return rois
+
+def load_frame_cells(trackmate_file, frame_ids, chunksize=100000):
+    """
+    Loads the cells present in a set of frames from the TrackMate features.
+
+    Equivalent to filtering the output of
+    cellphe.input.import_data(trackmate_file, "Trackmate_auto") to each frame,
+    but only the ID columns are parsed and the file is read in chunks with rows
+    from other frames being discarded as they're read, so the memory footprint
+    is proportional to the number of cells in the requested frames. For a
+    Parquet file the frames are filtered as the file is read, skipping any
+    row groups that don't contain them.
+
+    :param trackmate_file: Path to the TrackMate features, as CSV or Parquet.
+    :param frame_ids: The FrameIDs to load.
+    :param chunksize: Number of rows to read at a time.
+    :return: A dict with an entry for every FrameID in frame_ids, holding a
+        DataFrame with columns CellID and ROI_filename, with 1 row per CellID
+        ordered by CellID. If a CellID appears multiple times in a frame the
+        first one in the file is kept.
+    """
+    columns = ["FRAME", "TRACK_ID", "ROI_FILENAME"]
+    if is_parquet(trackmate_file):
+        cells = pd.read_parquet(trackmate_file, columns=columns, filters=[("FRAME", "in", list(frame_ids))])
     else:
-        return int(res.group(1))
+        chunks = []
+        reader = pd.read_csv(trackmate_file, usecols=columns, chunksize=chunksize)
+        for chunk in reader:
+            chunks.append(chunk.loc[chunk["FRAME"].astype(int).isin(frame_ids)])
+        cells = pd.concat(chunks)
+    cells = cells.rename(columns={"FRAME": "FrameID", "TRACK_ID": "CellID", "ROI_FILENAME": "ROI_filename"})
+    cells["FrameID"] = cells["FrameID"].astype(int)
+    cells["CellID"] = cells["CellID"].astype(int)
+    cells = cells.drop_duplicates(["FrameID", "CellID"]).sort_values(["FrameID", "CellID"])
+    frame_cells = {}
+    for frame_id in frame_ids:
+        frame_cells[frame_id] = cells.loc[cells["FrameID"] == frame_id, ["CellID", "ROI_filename"]]
+    return frame_cells
 
-# Parse trackmate file
-df = import_data(args.trackmate_file, "Trackmate_auto")
+def process_frame(image_file, roi_file, frame_id, cells, crop_padding=None, output_format="csv"):
+    """
+    Calculates the static features of every cell in a frame and saves them
+    to frame_features_<frameid>.<output_format>.
 
-# Load frame and normalize to 0-1
-image = load_image(args.image_file)
+    :param image_file: Path to the frame image, or a FrameView of a frame store.
+    :param roi_file: Path to a ROI archive containing this frame's ROIs.
+    :param frame_id: The FrameID.
+    :param cells: DataFrame with columns CellID and ROI_filename of the cells
+        in this frame.
+    :param crop_padding: If provided, each cell is extracted from a bounding
+        box with this much padding rather than from the full frame.
+    :param output_format: Either csv or parquet.
+    :return: None, writes to disk as a side-effect.
+    """
+    # Load frame and normalize to 0-1
+    if crop_padding is None:
+        frame = Frame(image_file)
+    else:
+        frame = CroppedFrame(image_file, crop_padding)
 
-# Get FrameID from filename
-frame_id = get_index(args.image_file)
+    # Find all cells in this frame
+    records = []
+    rois = read_frame_rois(roi_file, cells["ROI_filename"])
+    for cell_id, roi_fn in zip(cells["CellID"], cells["ROI_filename"]):
+        try:
+            roi = rois[f"{roi_fn}.roi"]
+        except KeyError:
+            print(f"Unable to read file {roi_fn} - skipping to next ROI")
+            continue
+        # No negative coordinates
+        roi = np.maximum(roi, 0)
 
-# Find all cells in this frame
-records = []
-cell_ids = df.loc[df["FrameID"] == frame_id]["CellID"].unique()
-rois = read_rois(args.roi_file)
-for cell_id in cell_ids:
-    roi_fn = df.loc[(df["FrameID"] == frame_id) & (df["CellID"] == cell_id)]["ROI_filename"].values[0]
-    try:
-        roi = rois[f"{roi_fn}.roi"]
-    except FileNotFoundError:
-        print(f"Unable to read file {roi_fn} - skipping to next ROI")
-        continue
-    # No negative coordinates
-    roi = np.maximum(roi, 0)
-
-    # Calculate static features of the frame/cell pair
-    try:
-        static_features = extract_static_features(image, roi)
-    except RuntimeError:
-        # Throw from lack of interior pixels
-        pass
-
-    # Collate into a dict that will later populate a data frame
-    record = dict(zip(STATIC_FEATURE_NAMES, static_features))
-    record["FrameID"] = frame_id
-    record["CellID"] = cell_id
-    record["ROI_filename"] = roi_fn
-    records.append(record)
-feats = pd.DataFrame.from_records(records)
-# Create an empty header row if don't have any data, as otherwise nextflow complains
-output_fn = f"frame_features_{frame_id}.csv"
-if feats.shape[0] == 0:
-    cols = STATIC_FEATURE_NAMES + ['FrameID', 'CellID', 'ROI_filename']
-    with open(output_fn, "w") as outfile:
-        outfile.write(",".join(cols))
-else:
-    feats.to_csv(output_fn, index=False)
+        # Calculate static features of the frame/cell pair
+        image, offset = frame.region(roi)
+        try:
+            static_features = extract_static_features(image, roi - offset)
+            # The centroid is relative to the image, so use the original ROI
+            static_features[-2:] = roi.mean(axis=0)
+        except RuntimeError:
+            # Throw from lack of interior pixels
+            pass
+
+        # Collate into a dict that will later populate a data frame
+        record = dict(zip(STATIC_FEATURE_NAMES, static_features))
+        record["FrameID"] = frame_id
+        record["CellID"] = cell_id
+        record["ROI_filename"] = roi_fn
+        records.append(record)
+    feats = pd.DataFrame.from_records(records)
+    # Create an empty header row if don't have any data, as otherwise nextflow complains
+    output_fn = f"frame_features_{frame_id}.{output_format}"
+    if feats.shape[0] == 0:
+        cols = STATIC_FEATURE_NAMES + ['FrameID', 'CellID', 'ROI_filename']
+        if output_format == "csv":
+            with open(output_fn, "w") as outfile:
+                outfile.write(",".join(cols))
+        else:
+            write_table(pd.DataFrame(columns=cols), output_fn)
+    else:
+        write_table(feats, output_fn)
+
+profile = Profile(args.profile, workers=args.workers)
+image_files = args.image_file.split(" ")
+roi_files = args.roi_file.split(" ")
+profile.add_inputs(args.trackmate_file, image_files, roi_files)
+# A single archive can be shared by every frame
+if len(roi_files) == 1:
+    roi_files = roi_files * len(image_files)
+if len(roi_files) != len(image_files):
+    parser.error("roi_file must either be a single archive or have 1 archive per frame")
+
+# Get FrameIDs from filenames
+frame_ids = [get_frame_id(fn) for fn in image_files]
+if args.frame_store is not None:
+    store = FrameStore(args.frame_store)
+    image_files = [store.frame(frame_id) for frame_id in frame_ids]
+
+# Parse the trackmate file once for every frame
+profile.phase("read_trackmate")
+frame_cells = load_frame_cells(args.trackmate_file, frame_ids)
+crop_padding = args.crop_padding if args.crop else None
+frame_args = [
+    (image_fn, roi_fn, frame_id, frame_cells[frame_id], crop_padding, args.format)
+    for image_fn, roi_fn, frame_id in zip(image_files, roi_files, frame_ids)
+]
+profile.record(frames=len(frame_ids), cells=sum(cells.shape[0] for cells in frame_cells.values()))
+
+profile.phase("features")
+# Consume the results so any errors are raised
+list(parallel_map(process_frame, args.workers, *zip(*frame_args)))
+profile.save()
@@ -0,0 +1,36 @@
+"""
+Reads the frames of a timelapse, whether each is stored in its own image
+file or is a reference to a page of an OME-TIFF, and finds their FrameIDs
+from their filenames, frame_<frameid>.<ext>. Used by segment_image_batch.py,
+store_frames.py and frame_features_image.py.
+"""
+from pathlib import Path
+import re
+import numpy as np
+from PIL import Image
+from ome_frames import is_frame_ref, open_frame
+
+FRAME_ID_PATTERN = re.compile(r"frame_([0-9]+)\.")
+
+def read_frame(fn: str) -> np.ndarray:
+    """
+    Reads a frame into memory in its original data type.
+
+    :param fn: Path to the frame image, or to an OME-TIFF frame reference.
+    :return: The frame as a numpy array.
+    """
+    if is_frame_ref(fn):
+        return np.array(open_frame(fn))
+    return np.array(Image.open(fn))
+
+def get_frame_id(fn: str) -> int:
+    """
+    Extracts the FrameID from a frame's filename.
+
+    :param fn: Path to the frame, named frame_<frameid>.<ext>.
+    :return: The FrameID.
+    """
+    res = FRAME_ID_PATTERN.search(Path(fn).name)
+    if res is None:
+        raise ValueError(f"Unable to find the FrameID of {fn}")
+    return int(res.group(1))
@@ -0,0 +1,223 @@
+"""
+A chunked and compressed store of the processed frames of a timelapse, from
+which a single frame, or a region of one, can be read without reading the
+rest.
+
+The store is a Zarr (version 2) array with zlib compression, so it can also
+be opened with zarr.open or dask.array.from_zarr, but it's written and read
+here with numpy alone. The frames are stacked along the first axis in
+FrameID order and split into square chunks. Every chunk is saved to its own
+file, so once the metadata has been created the frames can be written by
+many processes at once. Used by store_frames.py and frame_features_image.py.
+"""
+import json
+import os
+import zlib
+import numpy as np
+
+METADATA_FILENAME = ".zarray"
+
+def create_store(
+    path: str,
+    n_frames: int,
+    frame_shape: tuple[int, ...],
+    dtype: np.dtype,
+    chunk_size: int = 1024,
+    compression_level: int = 1,
+) -> dict:
+    """
+    Creates an empty frame store.
+
+    :param path: Directory to create the store in.
+    :param n_frames: Number of frames in the timelapse.
+    :param frame_shape: Shape of every frame, with rows and columns as the
+        first 2 dimensions.
+    :param dtype: Data type of the frames.
+    :param chunk_size: Size of each square chunk in pixels.
+    :param compression_level: zlib compression level, from 1 (fastest) to 9
+        (smallest).
+    :return: The store's metadata.
+    """
+    metadata = {
+        "zarr_format": 2,
+        "shape": [n_frames, *frame_shape],
+        "chunks": [1, min(chunk_size, frame_shape[0]), min(chunk_size, frame_shape[1]), *frame_shape[2:]],
+        "dtype": np.dtype(dtype).str,
+        "compressor": {"id": "zlib", "level": compression_level},
+        "fill_value": 0,
+        "order": "C",
+        "filters": None,
+        "dimension_separator": ".",
+    }
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, METADATA_FILENAME), "w") as outfile:
+        json.dump(metadata, outfile, indent=4)
+    return metadata
+
+def read_metadata(path: str) -> dict:
+    """
+    Reads the metadata of a frame store.
+
+    :param path: Directory of the store.
+    :return: The store's metadata, as written by create_store.
+    """
+    with open(os.path.join(path, METADATA_FILENAME)) as infile:
+        return json.load(infile)
+
+def _chunk_filename(path: str, index: int, row_chunk: int, col_chunk: int, ndim: int) -> str:
+    """
+    The location of a chunk in the store.
+
+    :param path: Directory of the store.
+    :param index: Position of the frame in the store.
+    :param row_chunk: Row index of the chunk.
+    :param col_chunk: Column index of the chunk.
+    :param ndim: Number of dimensions of the store.
+    :return: The path to the chunk.
+    """
+    key = [index, row_chunk, col_chunk] + [0] * (ndim - 3)
+    return os.path.join(path, ".".join(str(i) for i in key))
+
+def write_frame(path: str, metadata: dict, index: int, image: np.ndarray) -> None:
+    """
+    Saves a frame into the store.
+
+    :param path: Directory of the store.
+    :param metadata: The store's metadata, from create_store or read_metadata.
+    :param index: Position of the frame in the store, which is its FrameID - 1.
+    :param image: The frame, which must have the shape of the store's frames.
+    :return: None, writes to disk as a side-effect.
+    """
+    dtype = np.dtype(metadata["dtype"])
+    image = np.asarray(image)
+    if list(image.shape) != metadata["shape"][1:]:
+        raise ValueError(f"Frame has shape {image.shape} but the store holds frames of shape {tuple(metadata['shape'][1:])}")
+    chunk_shape = metadata["chunks"][1:]
+    rows, cols = chunk_shape[:2]
+    level = metadata["compressor"]["level"]
+    for row_chunk, row in enumerate(range(0, image.shape[0], rows)):
+        for col_chunk, col in enumerate(range(0, image.shape[1], cols)):
+            block = image[row:(row + rows), col:(col + cols)]
+            # Chunks at the edges are stored at the full chunk size
+            chunk = np.full(chunk_shape, metadata["fill_value"], dtype=dtype)
+            chunk[:block.shape[0], :block.shape[1]] = block
+            chunk_fn = _chunk_filename(path, index, row_chunk, col_chunk, len(metadata["shape"]))
+            with open(chunk_fn, "wb") as outfile:
+                outfile.write(zlib.compress(chunk.tobytes(), level))
+
+class FrameStore:
+    """
+    Reads frames from a frame store.
+
+    :param path: Directory of the store.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.metadata = read_metadata(path)
+        if self.metadata["compressor"]["id"] != "zlib" or self.metadata["filters"] is not None:
+            raise ValueError(f"{path} isn't a frame store created by create_store")
+        self.dtype = np.dtype(self.metadata["dtype"])
+        self.frame_shape = tuple(self.metadata["shape"][1:])
+
+    def __len__(self) -> int:
+        return self.metadata["shape"][0]
+
+    def frame(self, frame_id: int) -> "FrameView":
+        """
+        Opens a frame without reading it.
+
+        :param frame_id: The 1-indexed FrameID.
+        :return: A FrameView of the frame.
+        """
+        if not 1 <= frame_id <= len(self):
+            raise IndexError(f"FrameID {frame_id} isn't in the store, which has {len(self)} frames")
+        return FrameView(self, frame_id - 1)
+
+    def read(self, index: int, rows: tuple[int, int], cols: tuple[int, int]) -> np.ndarray:
+        """
+        Reads a rectangular region of a frame, decompressing only the chunks
+        that overlap it.
+
+        :param index: Position of the frame in the store, which is its
+            FrameID - 1.
+        :param rows: The (start, end) rows of the region.
+        :param cols: The (start, end) columns of the region.
+        :return: An array of the region, including any trailing dimensions of
+            the frames.
+        """
+        chunk_shape = self.metadata["chunks"][1:]
+        chunk_rows, chunk_cols = chunk_shape[:2]
+        out = np.full(
+            (rows[1] - rows[0], cols[1] - cols[0], *self.frame_shape[2:]),
+            self.metadata["fill_value"],
+            dtype=self.dtype,
+        )
+        if out.shape[0] <= 0 or out.shape[1] <= 0:
+            return out
+        for row_chunk in range(rows[0] // chunk_rows, (rows[1] - 1) // chunk_rows + 1):
+            for col_chunk in range(cols[0] // chunk_cols, (cols[1] - 1) // chunk_cols + 1):
+                chunk_fn = _chunk_filename(self.path, index, row_chunk, col_chunk, len(self.metadata["shape"]))
+                if not os.path.exists(chunk_fn):
+                    # Not written, so it's all fill_value
+                    continue
+                with open(chunk_fn, "rb") as infile:
+                    chunk = np.frombuffer(zlib.decompress(infile.read()), dtype=self.dtype).reshape(chunk_shape)
+                # Overlap between the chunk and the region, in frame coordinates
+                row_start = max(rows[0], row_chunk * chunk_rows)
+                row_end = min(rows[1], (row_chunk + 1) * chunk_rows)
+                col_start = max(cols[0], col_chunk * chunk_cols)
+                col_end = min(cols[1], (col_chunk + 1) * chunk_cols)
+                out[(row_start - rows[0]):(row_end - rows[0]), (col_start - cols[0]):(col_end - cols[0])] = chunk[
+                    (row_start - row_chunk * chunk_rows):(row_end - row_chunk * chunk_rows),
+                    (col_start - col_chunk * chunk_cols):(col_end - col_chunk * chunk_cols),
+                ]
+        return out
+
+class FrameView:
+    """
+    A single frame in a frame store that is only read when it's sliced.
+
+    Supports numpy-style indexing, so a region can be read with
+    view[row_start:row_end, col_start:col_end], and np.asarray(view) reads the
+    whole frame.
+
+    :param store: The FrameStore holding the frame.
+    :param index: Position of the frame in the store, which is its FrameID - 1.
+    """
+
+    def __init__(self, store: FrameStore, index: int):
+        self.store = store
+        self.index = index
+        self.shape = store.frame_shape
+        self.dtype = store.dtype
+        self.ndim = len(self.shape)
+
+    def __getitem__(self, key) -> np.ndarray:
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * max(0, 2 - len(key))
+        bounds = []
+        local_key = []
+        for axis_key, length in zip(key[:2], self.shape[:2]):
+            if isinstance(axis_key, slice):
+                start, stop, step = axis_key.indices(length)
+                if step < 0:
+                    start, stop = stop + 1, start + 1
+                stop = max(start, stop)
+                bounds.append((start, stop))
+                local_key.append(slice(None, None, step))
+            else:
+                axis_key = int(axis_key)
+                if axis_key < 0:
+                    axis_key += length
+                if not 0 <= axis_key < length:
+                    raise IndexError(f"Index {axis_key} is out of bounds for frame of shape {self.shape}")
+                bounds.append((axis_key, axis_key + 1))
+                local_key.append(0)
+        region = self.store.read(self.index, bounds[0], bounds[1])
+        return region[tuple(local_key) + tuple(key[2:])]
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        pixels = self[:, :]
+        return pixels if dtype is None else pixels.astype(dtype)
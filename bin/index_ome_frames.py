@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+import argparse
+import os
+from ome_frames import read_companion, read_page_bytes, write_frame_refs
+from profiling import Profile
+
+parser = argparse.ArgumentParser(
+                    description='Creates a reference to the OME-TIFF page holding each frame of an OME timelapse, from its companion file'
+)
+parser.add_argument('companion', help="Path to the companion.ome file, in the same directory as the OME-TIFFs")
+parser.add_argument('--output-dir', help="Directory to save the frame_<frameid>.omeframe references to", default=".")
+parser.add_argument('--profile', help="Path to save a JSON profile of the time and memory used")
+args = parser.parse_args()
+
+profile = Profile(args.profile)
+profile.add_inputs(args.companion)
+profile.phase("read")
+frames = read_companion(args.companion)
+profile.record(frames=len(frames))
+page_bytes = read_page_bytes(frames, os.path.dirname(args.companion))
+profile.phase("write")
+write_frame_refs(frames, args.output_dir, page_bytes)
+print(f"Indexed {len(frames)} frames across {len(set(fn for fn, _ in frames))} OME-TIFFs")
+profile.save()
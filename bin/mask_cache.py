@@ -0,0 +1,150 @@
+"""
+A content-addressed cache of segmentation masks, stored in a local directory.
+
+Masks are keyed by a hash of the raw image's bytes, the Cellpose model and
+eval arguments, and the container image used to run the segmentation, so a
+mask is only reused when it would have been recreated exactly. Used by
+segment_image_batch.py.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from ome_frames import frame_blocks, is_frame_ref
+
+def cache_key(image_fn: str, model_args: dict, eval_args: dict, tag: str, options: dict | None = None) -> str:
+    """
+    Creates the cache key for segmenting an image.
+
+    :param image_fn: Path to the raw image, or to an OME-TIFF frame reference
+        in which case the referenced page is hashed.
+    :param model_args: Arguments for CellPoseModel.
+    :param eval_args: Arguments for CellPoseModel.eval.
+    :param tag: Identifier of the segmentation environment, i.e. the container
+        image.
+    :param options: Any other settings that change the mask, such as tiling.
+    :return: The key as a hex string.
+    """
+    digest = hashlib.sha256()
+    if is_frame_ref(image_fn):
+        for block in frame_blocks(image_fn):
+            digest.update(block)
+    else:
+        with open(image_fn, "rb") as infile:
+            for block in iter(lambda: infile.read(1 << 20), b""):
+                digest.update(block)
+    # Canonical JSON so the order the arguments were specified in doesn't matter
+    config = {"model": model_args, "eval": eval_args, "tag": tag}
+    if options is not None:
+        config["options"] = options
+    config = json.dumps(config, sort_keys=True, separators=(",", ":"))
+    digest.update(config.encode("utf-8"))
+    return digest.hexdigest()
+
+class MaskCache:
+    """
+    Cache of segmentation masks in a local directory.
+
+    Entries are evicted least recently used first once the total size of the
+    cache exceeds max_bytes. Reading an entry counts as using it. Entries are
+    written atomically, so multiple tasks can share a cache directory.
+
+    :param directory: Directory holding the cache, created if it doesn't
+        exist.
+    :param max_bytes: Maximum total size of the cached masks, or None for no
+        limit.
+    """
+
+    def __init__(self, directory: str, max_bytes: int | None = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        """
+        The location of an entry in the cache.
+
+        :param key: Cache key, as output from cache_key.
+        :return: The path to the cached mask.
+        """
+        return os.path.join(self.directory, key[:2], f"{key}.png")
+
+    def get(self, key: str, output_fn: str) -> bool:
+        """
+        Copies a cached mask to output_fn if it is in the cache.
+
+        :param key: Cache key, as output from cache_key.
+        :param output_fn: Where to save the mask.
+        :return: Whether the mask was in the cache.
+        """
+        cached_fn = self.path(key)
+        try:
+            shutil.copyfile(cached_fn, output_fn)
+            os.utime(cached_fn)
+        except FileNotFoundError:
+            self.misses += 1
+            return False
+        self.hits += 1
+        return True
+
+    def put(self, key: str, mask_fn: str) -> None:
+        """
+        Adds a mask to the cache.
+
+        :param key: Cache key, as output from cache_key.
+        :param mask_fn: Path to the mask to store.
+        :return: None, saves the mask into the cache directory.
+        """
+        cached_fn = self.path(key)
+        os.makedirs(os.path.dirname(cached_fn), exist_ok=True)
+        # Write to a temporary file first so other tasks never see a partial mask
+        fd, tmp_fn = tempfile.mkstemp(dir=os.path.dirname(cached_fn), suffix=".tmp")
+        os.close(fd)
+        shutil.copyfile(mask_fn, tmp_fn)
+        os.replace(tmp_fn, cached_fn)
+
+    def evict(self) -> int:
+        """
+        Removes the least recently used entries until the cache is within its
+        size limit.
+
+        :return: The number of entries removed.
+        """
+        if self.max_bytes is None:
+            return 0
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for fn in files:
+                if not fn.endswith(".png"):
+                    continue
+                path = os.path.join(root, fn)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(entry[1] for entry in entries)
+        n_removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                n_removed += 1
+            except FileNotFoundError:
+                # Already removed by another task
+                pass
+            total -= size
+        return n_removed
+
+    def summary(self) -> str:
+        """
+        Summarises the cache usage in this process.
+
+        :return: A string with the number of hits and misses.
+        """
+        return f"Mask cache: {self.hits} hits, {self.misses} misses"
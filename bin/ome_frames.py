@@ -0,0 +1,157 @@
+"""
+Reads the frames of an OME-TIFF timelapse in place, rather than first
+splitting the OME-TIFFs into 1 file per frame.
+
+The companion file lists the OME-TIFF and IFD (page) that every timepoint is
+stored in. Each frame is then represented in the pipeline by a small
+reference file, frame_<frameid>.omeframe, holding its OME-TIFF filename,
+IFD and the number of bytes the page is stored in as JSON. The size stands
+in for the size of the frame's file when requesting resources, as the
+reference itself is tiny. The OME-TIFFs are staged alongside the references and the
+frames are read straight from them, memory-mapping the page when it's
+stored uncompressed. Used by index_ome_frames.py, create_tiff_stack.py,
+frame_files.py, frame_features_image.py and mask_cache.py.
+"""
+from collections.abc import Iterator
+import json
+import os
+import xml.etree.ElementTree as ET
+import numpy as np
+import tifffile
+
+FRAME_REF_SUFFIX = ".omeframe"
+
+def _local_name(tag: str) -> str:
+    """
+    Removes the namespace from an XML tag.
+
+    :param tag: The tag, as {namespace}name or just name.
+    :return: The name without the namespace.
+    """
+    return tag.rsplit("}", 1)[-1]
+
+def read_companion(companion_fn: str) -> list[tuple[str, int]]:
+    """
+    Lists where each frame is stored from an OME companion file.
+
+    Every TiffData element gives the OME-TIFF, the first IFD and the first
+    timepoint of a run of PlaneCount planes (1 if not specified). The frames
+    are ordered by timepoint, with ties kept in the order they're listed.
+
+    :param companion_fn: Path to the companion.ome XML file.
+    :return: A list of the (OME-TIFF filename, IFD) of every frame, in frame
+        order.
+    """
+    planes = []
+    for elem in ET.parse(companion_fn).iter():
+        if _local_name(elem.tag) != "TiffData":
+            continue
+        filename = None
+        for child in elem:
+            if _local_name(child.tag) == "UUID":
+                filename = child.get("FileName")
+        if filename is None:
+            raise ValueError(f"TiffData element in {companion_fn} doesn't have a UUID FileName")
+        ifd = int(elem.get("IFD", 0))
+        first_t = int(elem.get("FirstT", 0))
+        for i in range(int(elem.get("PlaneCount", 1))):
+            planes.append((first_t + i, filename, ifd + i))
+    planes.sort(key=lambda plane: plane[0])
+    return [(filename, ifd) for _, filename, ifd in planes]
+
+def read_page_bytes(frames: list[tuple[str, int]], tiff_dir: str = ".") -> list[int]:
+    """
+    Finds how many bytes each frame's page is stored in, without reading its
+    pixels.
+
+    :param frames: The (OME-TIFF filename, IFD) of every frame, as output from
+        read_companion.
+    :param tiff_dir: Directory containing the OME-TIFFs.
+    :return: A list of the stored size of every frame in bytes.
+    """
+    page_bytes = [0] * len(frames)
+    for tiff_fn in dict.fromkeys(filename for filename, _ in frames):
+        with tifffile.TiffFile(os.path.join(tiff_dir, tiff_fn)) as tif:
+            for i, (filename, ifd) in enumerate(frames):
+                if filename == tiff_fn:
+                    page_bytes[i] = int(sum(tif.pages[ifd].databytecounts))
+    return page_bytes
+
+def write_frame_refs(frames: list[tuple[str, int]], output_dir: str = ".", page_bytes: list[int] | None = None) -> list[str]:
+    """
+    Saves a reference file for every frame.
+
+    :param frames: The (OME-TIFF filename, IFD) of every frame, as output from
+        read_companion.
+    :param output_dir: Directory to save the references to.
+    :param page_bytes: The stored size of every frame, as output from
+        read_page_bytes, or None to leave it out of the references.
+    :return: A list of the reference filenames, named frame_<frameid>.omeframe
+        with the FrameID 1-indexed and 0 padded to 5 digits to match the
+        other frame images.
+    """
+    ref_fns = []
+    for i, (filename, ifd) in enumerate(frames):
+        ref_fn = os.path.join(output_dir, f"frame_{i+1:05}{FRAME_REF_SUFFIX}")
+        ref = {"file": filename, "ifd": ifd}
+        if page_bytes is not None:
+            ref["bytes"] = page_bytes[i]
+        with open(ref_fn, "w") as outfile:
+            json.dump(ref, outfile)
+        ref_fns.append(ref_fn)
+    return ref_fns
+
+def is_frame_ref(fn: str) -> bool:
+    """
+    Whether a frame is an OME-TIFF frame reference rather than an image.
+
+    :param fn: Path to the frame.
+    :return: True if the file has the .omeframe extension.
+    """
+    return str(fn).endswith(FRAME_REF_SUFFIX)
+
+def resolve_frame_ref(ref_fn: str) -> tuple[str, int]:
+    """
+    Finds the OME-TIFF page a frame reference points to.
+
+    :param ref_fn: Path to the frame reference.
+    :return: A tuple of the path to the OME-TIFF, relative to the reference's
+        directory, and the IFD.
+    """
+    with open(ref_fn) as infile:
+        ref = json.load(infile)
+    return os.path.join(os.path.dirname(ref_fn), ref["file"]), int(ref["ifd"])
+
+def open_frame(ref_fn: str) -> np.ndarray:
+    """
+    Opens the frame a reference points to.
+
+    Uncompressed pages are memory-mapped so that pixels are only read from
+    disk when they are accessed, otherwise the page is decoded into memory.
+
+    :param ref_fn: Path to the frame reference.
+    :return: The frame's pixels in their original data type.
+    """
+    tiff_fn, ifd = resolve_frame_ref(ref_fn)
+    with tifffile.TiffFile(tiff_fn) as tif:
+        page = tif.pages[ifd]
+        if not page.is_memmappable:
+            return page.asarray()
+    return tifffile.memmap(tiff_fn, page=ifd, mode="r")
+
+def frame_blocks(ref_fn: str) -> Iterator[bytes]:
+    """
+    Reads the stored bytes of the frame a reference points to, without
+    decoding them, so that they can be hashed.
+
+    :param ref_fn: Path to the frame reference.
+    :return: A generator of the page's shape, data type and compression as
+        JSON, followed by each of its encoded strips or tiles.
+    """
+    tiff_fn, ifd = resolve_frame_ref(ref_fn)
+    with tifffile.TiffFile(tiff_fn) as tif:
+        page = tif.pages[ifd]
+        yield json.dumps([list(page.shape), str(page.dtype), int(page.compression)]).encode("utf-8")
+        for offset, bytecount in zip(page.dataoffsets, page.databytecounts):
+            tif.filehandle.seek(offset)
+            yield tif.filehandle.read(bytecount)
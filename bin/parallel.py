@@ -0,0 +1,34 @@
+"""
+Maps a function over its inputs across a pool of processes. The processes
+are forked, so they can run functions from scripts that do their work at
+module level, and they share the data the script has already loaded. Used by
+parse_xml.py, frame_features_image.py, create_frame_summary_features.py,
+time_series_features.py, store_frames.py and track_masks.py, and by the
+benchmarks' synthetic.py.
+"""
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+def parallel_map(fn: Callable, n_workers: int, *iterables: Iterable, chunksize: int = 1) -> Iterator:
+    """
+    Calls a function on each set of inputs, in the same way as map, across a
+    pool of processes.
+
+    The results are yielded in order as they're ready, and the pool is shut
+    down once they've all been consumed. Any error is raised when its result
+    is reached, so the results must be consumed even when they're not needed.
+
+    :param fn: The function, which must be picklable by reference.
+    :param n_workers: Number of processes. With 1 or fewer, the function is
+        called in this process instead.
+    :param iterables: An iterable of each argument to pass to the function.
+    :param chunksize: Number of calls to send to a process at a time.
+    :return: An iterator of the function's results.
+    """
+    if n_workers <= 1:
+        yield from map(fn, *iterables)
+        return
+    context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=context) as executor:
+        yield from executor.map(fn, *iterables, chunksize=chunksize)
@@ -1,170 +1,698 @@
 #!/usr/bin/env python
 import argparse
-from dataclasses import dataclass, field
+from array import array
+from dataclasses import dataclass
+from decimal import Decimal
 import json
+import math
+import os
 import sys
-from typing import List
 import xml.etree.ElementTree as ET
+import zipfile
 import numpy as np
 import pandas as pd
-from roifile import ImagejRoi, roiwrite
-from skimage.draw import line
+from roifile import ImagejRoi
+from parallel import parallel_map
+from profiling import Profile
+from tables import write_table
 
-def interpolate_between_points(coords: np.array) -> np.array:
+def densify_rois(coords: np.ndarray, offsets: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
     """
-    Interpolates between the ROI coordinates to ensure there aren't any breaks
-    in the boundary.
+    Interpolates between the coordinates of a batch of ROIs to ensure there
+    aren't any breaks in their boundaries.
 
     All the downstream CellPhe analysis assumes that there aren't any gaps in
-    the ROIs. This function guarantees that.
-
-    :param coords: A 2D Numpy array of coordinate pairs in the form (x,y).
-    :return: An array in the same format as coords with either the same number
-        of coordinates, or more.
-    """
-    new_coords_raw = []
-    # Iterate through each consecutive coordinate pair interpolating a
-    # line between them
-    # NB: assumes that ROIs are stored in order, which they should be from
-    # TrackMate
-    for i in range(1, coords.shape[0]):
-        # These are in format (y, x) (i.e. row/column)
-        new_coords_raw.append(line(coords[i - 1, 1], coords[i - 1, 0], coords[i, 1], coords[i, 0]))
-    # Ensure first and last point are connected
-    new_coords_raw.append(line(coords[-1, 1], coords[-1, 0], coords[0, 1], coords[0, 0]))
-    # Convert back to a single 2D numpy array in (y,x) format
-    new_coords = np.concatenate([np.asarray(x).T for x in new_coords_raw])
-    # Remove duplicate coordinates
-    # Have to do a 2-step process as np.unique() sorts by default and cannot
-    # be told not to
-    _, inds = np.unique(new_coords, axis=0, return_index=True)
-    new_coords = new_coords[np.sort(inds)]
-
-    # Convert back to (x,y)
-    new_coords = np.flip(new_coords, axis=1)
-    return new_coords
-
-def save_rois(rois: list[dict], filename: str = "rois.zip"):
+    the ROIs. This function guarantees that by drawing a Bresenham line between
+    every pair of consecutive points (including the last and first), producing
+    exactly the same pixels as skimage.draw.line, with duplicate points
+    removed. Rather than drawing each line separately, the points on every
+    line of every ROI are calculated at once from a flat array of line
+    offsets.
+
+    :param coords: A 2D Numpy array of coordinate pairs in the form (x,y),
+        containing every ROI concatenated together.
+        NB: assumes that each ROI's points are stored in order, which they
+        should be from TrackMate.
+    :param offsets: Array of length n_rois + 1, where the coordinates for ROI
+        i are coords[offsets[i]:offsets[i+1]]. Every ROI must have at least
+        1 point.
+    :return: A tuple of (coords, offsets) in the same format as the inputs,
+        with each ROI having either the same number of coordinates, or more.
+    """
+    coords = coords.astype(int)
+    n_rois = offsets.shape[0] - 1
+    lengths = np.diff(offsets)
+    roi_ids = np.repeat(np.arange(n_rois), lengths)
+
+    # Every point is joined to the next one, with the last point of each ROI
+    # joined back to the first
+    next_point = np.arange(1, coords.shape[0] + 1)
+    next_point[offsets[1:] - 1] = offsets[:-1]
+    x0 = coords[:, 0]
+    y0 = coords[:, 1]
+    dx = coords[next_point, 0] - x0
+    dy = coords[next_point, 1] - y0
+
+    # Bresenham: step 1 pixel at a time along the major axis, with the number
+    # of steps taken along the minor axis given in closed form
+    steep = np.abs(dy) > np.abs(dx)
+    major = np.maximum(np.abs(dx), np.abs(dy))
+    minor = np.minimum(np.abs(dx), np.abs(dy))
+    n_line_points = major + 1
+    line_ids = np.repeat(np.arange(coords.shape[0]), n_line_points)
+    line_starts = np.cumsum(n_line_points) - n_line_points
+    i = np.arange(line_ids.shape[0]) - line_starts[line_ids]
+    major = major[line_ids]
+    j = (2 * minor[line_ids] * i + major) // np.maximum(2 * major, 1)
+    step_x = np.where(dx[line_ids] > 0, 1, -1)
+    step_y = np.where(dy[line_ids] > 0, 1, -1)
+    line_steep = steep[line_ids]
+    x = x0[line_ids] + step_x * np.where(line_steep, j, i)
+    y = y0[line_ids] + step_y * np.where(line_steep, i, j)
+
+    # Remove duplicate coordinates within each ROI, keeping the first
+    # occurrence of each so that the boundary remains in order
+    point_roi_ids = roi_ids[line_ids]
+    width = x.max() - x.min() + 1
+    height = y.max() - y.min() + 1
+    keys = point_roi_ids * (width * height) + (y - y.min()) * width + (x - x.min())
+    _, inds = np.unique(keys, return_index=True)
+    inds = np.sort(inds)
+
+    new_coords = np.stack([x[inds], y[inds]], axis=1)
+    new_lengths = np.bincount(point_roi_ids[inds], minlength=n_rois)
+    new_offsets = np.concatenate([[0], np.cumsum(new_lengths)])
+    return new_coords, new_offsets
+
+def encode_rois(
+    coords: np.ndarray, offsets: np.ndarray, names: list[str], positions: list[int]
+) -> list[bytes]:
+    """
+    Converts a batch of ROIs into the ImageJ binary ROI format.
+
+    :param coords: A 2D Numpy array of (x,y) coordinates of every ROI.
+    :param offsets: Array of length n_rois + 1 giving where each ROI starts in
+        coords.
+    :param names: The name of each ROI.
+    :param positions: The position (frame) of each ROI.
+    :return: A list with the encoded bytes of each ROI.
+    """
+    new_coords, new_offsets = densify_rois(coords, offsets)
+    encoded = []
+    for i, (name, position) in enumerate(zip(names, positions)):
+        roi_obj = ImagejRoi.frompoints(new_coords[new_offsets[i]:new_offsets[i + 1]])
+        roi_obj.position = position
+        roi_obj.name = name
+        encoded.append(roi_obj.tobytes())
+    return encoded
+
+def save_rois(
+    coords: np.ndarray,
+    offsets: np.ndarray,
+    names: list[str],
+    positions: list[int],
+    filename: str = "rois.zip",
+    n_workers: int = 1,
+    chunk_size: int = 10000,
+    shard_dir: str | None = None,
+):
     """
     Saves ROIs to disk.
 
-    :param rois: List of dicts, each one representing an ROI with elements:
-        - coords: 2D numpy array containing the ROI coordinates.
-        - CellID: Cell ID
-        - FrameID: Frame ID
-        - filename: Filename to save the ROI to
+    The ROIs are processed in chunks, which are optionally spread across a
+    pool of worker processes. The archive itself is written by the calling
+    process in the same order as the input.
+
+    :param coords: A 2D Numpy array of (x,y) coordinates of every ROI.
+    :param offsets: Array of length n_rois + 1 giving where each ROI starts in
+        coords.
+    :param names: Filename to save each ROI to (without the .roi extension).
+    :param positions: Frame ID of each ROI.
     :param filename: Filename of output archive.
+    :param n_workers: Number of processes to use to prepare the ROIs.
+    :param chunk_size: Number of ROIs in each chunk.
+    :param shard_dir: If provided, each ROI is also saved to an archive
+        containing just the ROIs from its frame, named
+        frame_<frameid>_rois.zip (with the FrameID 0 padded to 5 digits to
+        match the frame images) in this directory. This is most efficient when
+        the ROIs are ordered by frame.
     :return: None, writes to disk as a side-effect.
     """
-    roi_objs = []
-    for roi in rois:
-        new_coords = interpolate_between_points(roi["coords"].astype(int))
-        roi_obj = ImagejRoi.frompoints(new_coords)
-        roi_obj.position = roi["FrameID"]
-        roi_obj.name = roi["Filename"]
-        roi_objs.append(roi_obj)
+    chunks = []
+    for start in range(0, len(names), chunk_size):
+        end = min(start + chunk_size, len(names))
+        chunks.append((
+            coords[offsets[start]:offsets[end]],
+            offsets[start:end + 1] - offsets[start],
+            names[start:end],
+            positions[start:end],
+        ))
+
+    def encoded_rois():
+        for chunk, encoded in zip(chunks, parallel_map(encode_rois, n_workers, *zip(*chunks))):
+            yield from zip(chunk[2], chunk[3], encoded)
+
+    shard = None
+    shard_frame = None
+    shard_fns = set()
+    with zipfile.ZipFile(filename, "w") as zf:
+        for name, position, roi_bytes in encoded_rois():
+            zf.writestr(f"{name}.roi", roi_bytes)
+            if shard_dir is None:
+                continue
+            if position != shard_frame:
+                if shard is not None:
+                    shard.close()
+                shard_fn = os.path.join(shard_dir, f"frame_{position:05}_rois.zip")
+                # Only append if this frame has already been seen in this run
+                shard = zipfile.ZipFile(shard_fn, "a" if shard_fn in shard_fns else "w")
+                shard_fns.add(shard_fn)
+                shard_frame = position
+            shard.writestr(f"{name}.roi", roi_bytes)
+    if shard is not None:
+        shard.close()
+
+@dataclass
+class TrackMateData:
+    """
+    Columnar representation of the contents of a TrackMate XML file.
+
+    :param spots: DataFrame with 1 row per Spot and 1 column per Spot
+        attribute, with the Spot name stored in LABEL.
+    :param roi_coords: 2D array of every ROI's absolute (x,y) coordinates,
+        concatenated in the same order as the rows of spots.
+    :param roi_offsets: Array of length spots.shape[0] + 1, where the ROI
+        for row i is roi_coords[roi_offsets[i]:roi_offsets[i+1]].
+    :param edge_sources: Spot IDs of the source of every Edge.
+    :param edge_targets: Spot IDs of the target of every Edge.
+    """
+    spots: pd.DataFrame
+    roi_coords: np.ndarray
+    roi_offsets: np.ndarray
+    edge_sources: np.ndarray
+    edge_targets: np.ndarray
+
+    def subset_rois(self, indices: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Extracts the ROIs for a subset of the Spots.
+
+        :param indices: Row indices of spots.
+        :return: A tuple of (coords, offsets) in the same format as roi_coords
+            and roi_offsets.
+        """
+        lengths = self.roi_offsets[indices + 1] - self.roi_offsets[indices]
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        point_inds = np.arange(offsets[-1]) - np.repeat(offsets[:-1] - self.roi_offsets[indices], lengths)
+        return self.roi_coords[point_inds], offsets
+
+def read_trackmate_xml(xml_path: str) -> TrackMateData:
+    """
+    Reads a TrackMate XML file by loading the full document into memory.
+
+    :param xml_path: Path to the TrackMate XML file.
+    :return: A TrackMateData instance.
+    """
+    tree = ET.parse(xml_path)
+    spot_records = []
+    rois = []
+    for frame in tree.findall("./Model/AllSpots/SpotsInFrame"):
+        # Get all spots, reading in their attributes and ROIs
+        for spot in frame.findall("Spot"):
+            spot_records.append(spot.attrib)
+            # Read ROIs
+            coords = np.array([spot.text.split(" ")]).astype(float)
+            coords = coords.reshape(int(coords.size / 2), 2)
+            coords[:, 0] = coords[:, 0] + float(spot.attrib["POSITION_X"])
+            coords[:, 1] = coords[:, 1] + float(spot.attrib["POSITION_Y"])
+            rois.append(coords)
+    spot_df = pd.DataFrame.from_records(spot_records)
+    spot_df = spot_df.rename(columns={"name": "LABEL"})
+    spot_df['ID'] = spot_df['ID'].astype('int')
+    spot_df['FRAME'] = spot_df['FRAME'].astype('int')
 
-    roiwrite(filename, roi_objs)
+    sources = []
+    targets = []
+    for track in tree.findall("./Model/AllTracks/Track"):
+        for edge in track.findall("Edge"):
+            sources.append(int(edge.attrib["SPOT_SOURCE_ID"]))
+            targets.append(int(edge.attrib["SPOT_TARGET_ID"]))
+
+    return TrackMateData(
+        spots=spot_df,
+        roi_coords=np.concatenate(rois) if len(rois) > 0 else np.zeros((0, 2)),
+        roi_offsets=np.concatenate([[0], np.cumsum([x.shape[0] for x in rois])]).astype("int64"),
+        edge_sources=np.array(sources, dtype="int64"),
+        edge_targets=np.array(targets, dtype="int64"),
+    )
+
+def parse_attribute(value: str) -> int | float | str:
+    """
+    Parses a Spot attribute into a number, if the number is written back out
+    as exactly the same text.
+
+    The in-memory reader keeps every attribute as the text from the XML, so
+    the streaming reader only stores a number where writing it to CSV gives
+    the same output, e.g. "1" and "0.5" but not "1.0E-4" or "1.50".
+
+    :param value: The attribute's text.
+    :return: The value as an int or float, or the text itself.
+    """
+    try:
+        parsed = int(value)
+        if str(parsed) == value and -2**63 <= parsed < 2**63:
+            return parsed
+    except ValueError:
+        pass
+    try:
+        parsed = float(value)
+        if math.isfinite(parsed) and repr(parsed) == value:
+            return parsed
+    except ValueError:
+        pass
+    return value
+
+class SpotBuffer:
+    """
+    Array-backed accumulator for Spot attributes and ROIs.
+
+    Every attribute is stored in its own array.array of either 64-bit ints or
+    doubles, while the ROI coordinates of all Spots are stored in a single
+    flat array with a separate array holding the number of points in each
+    ROI. This keeps the memory overhead per Spot to a handful of bytes, rather
+    than a dict and a numpy array per Spot. An attribute is only stored as
+    text, in a list, if any of its values can't be stored as a number and
+    written back out unchanged, or if any Spot doesn't have it, so that the
+    output is the same as the in-memory reader's.
+    """
+    def __init__(self):
+        self.n = 0
+        self.labels = []
+        self.columns = {}
+        self.roi_coords = array('d')
+        self.roi_lengths = array('q')
+
+    def append(self, attrib: dict, text: str | None) -> None:
+        """
+        Adds a Spot.
+
+        :param attrib: The Spot element's attributes.
+        :param text: The Spot element's text, containing the ROI coordinates
+            relative to the Spot's position.
+        :return: None, updates the buffers as a side-effect.
+        """
+        for key, value in attrib.items():
+            if key == "name":
+                self.labels.append(value)
+                continue
+            parsed = parse_attribute(value)
+            col = self.columns.get(key)
+            if col is None:
+                if self.n > 0:
+                    # Backfill for the Spots that didn't have this attribute
+                    col = [None] * self.n
+                else:
+                    col = array('q') if isinstance(parsed, int) else array('d') if isinstance(parsed, float) else []
+                self.columns[key] = col
+            elif isinstance(col, array) and not (
+                (col.typecode == 'q' and isinstance(parsed, int)) or (col.typecode == 'd' and isinstance(parsed, float))
+            ):
+                col = self.columns[key] = self._as_text(col)
+            col.append(value if isinstance(col, list) else parsed)
+        self.n += 1
+        # Pad any attributes that this Spot didn't have
+        for key, col in self.columns.items():
+            if len(col) < self.n:
+                if isinstance(col, array):
+                    col = self.columns[key] = self._as_text(col)
+                col.append(None)
+        if len(self.labels) < self.n:
+            self.labels.append("")
+
+        n_before = len(self.roi_coords)
+        if text is not None:
+            self.roi_coords.extend(map(float, text.split()))
+        self.roi_lengths.append((len(self.roi_coords) - n_before) // 2)
+
+    @staticmethod
+    def _as_text(col: array) -> list[str]:
+        """
+        Converts a numeric attribute to text, which is the same as the text
+        it was parsed from.
+
+        :param col: The attribute's values.
+        :return: A list of the values as text.
+        """
+        return [str(value) for value in col] if col.typecode == 'q' else [repr(value) for value in col]
+
+    def to_trackmate_data(self, edge_sources: array, edge_targets: array) -> TrackMateData:
+        """
+        Converts the buffers into a TrackMateData instance.
+
+        :param edge_sources: Spot IDs of the source of every Edge.
+        :param edge_targets: Spot IDs of the target of every Edge.
+        :return: A TrackMateData instance.
+        """
+        spot_df = pd.DataFrame({"LABEL": self.labels})
+        for key, col in self.columns.items():
+            if isinstance(col, list):
+                spot_df[key] = pd.Series(col, dtype="object")
+            else:
+                spot_df[key] = np.frombuffer(col, dtype="int64" if col.typecode == 'q' else "float64")
+        spot_df['ID'] = spot_df['ID'].astype('int')
+        spot_df['FRAME'] = spot_df['FRAME'].astype('int')
+
+        # ROIs are stored relative to the Spot centre
+        lengths = np.frombuffer(self.roi_lengths, dtype="int64")
+        coords = np.frombuffer(self.roi_coords, dtype="float64").reshape(-1, 2).copy()
+        coords[:, 0] += np.repeat(spot_df["POSITION_X"].values.astype(float), lengths)
+        coords[:, 1] += np.repeat(spot_df["POSITION_Y"].values.astype(float), lengths)
+
+        return TrackMateData(
+            spots=spot_df,
+            roi_coords=coords,
+            roi_offsets=np.concatenate([[0], np.cumsum(lengths)]).astype("int64"),
+            edge_sources=np.frombuffer(edge_sources, dtype="int64"),
+            edge_targets=np.frombuffer(edge_targets, dtype="int64"),
+        )
+
+def read_trackmate_xml_streaming(xml_path: str) -> TrackMateData:
+    """
+    Reads a TrackMate XML file incrementally.
+
+    Rather than building the full document tree, elements are consumed as soon
+    as they have been parsed and are then removed from the tree, so that peak
+    memory is driven by the size of the output rather than the size of the XML.
+
+    :param xml_path: Path to the TrackMate XML file.
+    :return: A TrackMateData instance.
+    """
+    spots = SpotBuffer()
+    edge_sources = array('q')
+    edge_targets = array('q')
+    # Stack of currently open elements
+    path = []
+    for event, elem in ET.iterparse(xml_path, events=("start", "end")):
+        if event == "start":
+            path.append(elem)
+            continue
+        path.pop()
+        tags = [x.tag for x in path[-3:]]
+        if elem.tag == "Spot" and tags[-3:] == ["Model", "AllSpots", "SpotsInFrame"]:
+            spots.append(elem.attrib, elem.text)
+        elif elem.tag == "Edge" and tags[-3:] == ["Model", "AllTracks", "Track"]:
+            edge_sources.append(int(elem.attrib["SPOT_SOURCE_ID"]))
+            edge_targets.append(int(elem.attrib["SPOT_TARGET_ID"]))
+        # Every element is processed on its end event, so by now all of its
+        # previous siblings have been consumed and can be dropped from the tree
+        elem.clear()
+        if len(path) > 0:
+            del path[-1][:]
+
+    return spots.to_trackmate_data(edge_sources, edge_targets)
+
+def java_double_string(value: float) -> str:
+    """
+    Formats a number in the same way as Java's Double.toString, which is how
+    TrackMate writes the non-integer features to its XML.
+
+    :param value: The number.
+    :return: The number as text, in scientific notation such as 1.0E-4 if
+        its magnitude is less than 10^-3 or at least 10^7.
+    """
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "Infinity" if value > 0 else "-Infinity"
+    if value == 0 or 1e-3 <= abs(value) < 1e7:
+        # The same shortest round-tripping digits as Java
+        return repr(value)
+    sign, digits, exponent = Decimal(repr(value)).as_tuple()
+    exponent += len(digits) - 1
+    digits = "".join(map(str, digits)).rstrip("0")
+    return f"{'-' if sign else ''}{digits[0]}.{digits[1:] or '0'}E{exponent}"
+
+def npz_feature_column(values: np.ndarray) -> np.ndarray:
+    """
+    Converts a Spot feature from the .npz export into the column that
+    parse_attribute gives from the XML TrackMate would have written.
+
+    :param values: The feature's values, int64 for TrackMate's integer
+        features or float64 otherwise.
+    :return: The values unchanged if they're written to CSV as in the XML,
+        otherwise the text TrackMate would have written for each of them.
+    """
+    if values.dtype.kind in "iu":
+        return values.astype("int64")
+    magnitude = np.abs(values)
+    as_repr = (magnitude == 0) | ((magnitude >= 1e-3) & (magnitude < 1e7))
+    if as_repr.all():
+        return values
+    return np.array([java_double_string(value) for value in values.tolist()], dtype="object")
+
+def read_trackmate_npz(npz_path: str) -> TrackMateData:
+    """
+    Reads the columnar export of a TrackMate model from track_images.py or
+    track_masks.py.
+
+    The features are formatted as TrackMate writes them to its XML, so the
+    output is the same as from the XML. The exception is a Spot that doesn't
+    have a feature, which TrackMate omits from the XML but is written here
+    as NaN.
+
+    :param npz_path: Path to the .npz file.
+    :return: A TrackMateData instance.
+    """
+    with np.load(npz_path) as npz:
+        spot_df = pd.DataFrame({"LABEL": npz["spot_LABEL"]})
+        for key in npz.files:
+            if key.startswith("spot_") and key != "spot_LABEL":
+                spot_df[key.removeprefix("spot_")] = npz_feature_column(npz[key])
+        spot_df['ID'] = spot_df['ID'].astype('int')
+        spot_df['FRAME'] = spot_df['FRAME'].astype('int')
+
+        # ROIs are stored relative to the Spot centre
+        lengths = npz["roi_lengths"]
+        coords = npz["roi_coords"].copy()
+        coords[:, 0] += np.repeat(npz["spot_POSITION_X"], lengths)
+        coords[:, 1] += np.repeat(npz["spot_POSITION_Y"], lengths)
+
+        return TrackMateData(
+            spots=spot_df,
+            roi_coords=coords,
+            roi_offsets=np.concatenate([[0], np.cumsum(lengths)]).astype("int64"),
+            edge_sources=npz["edge_sources"].astype("int64"),
+            edge_targets=npz["edge_targets"].astype("int64"),
+        )
+
+def assign_track_ids(
+    spot_ids: np.ndarray,
+    frames: np.ndarray,
+    edge_sources: np.ndarray,
+    edge_targets: np.ndarray,
+) -> np.ndarray:
+    """
+    Assigns a track id to every Spot from the graph formed by the Edges.
+
+    Tracks are identified by a depth-first traversal starting from every root
+    (a Spot with children but no parents) in frame order. A new track id is
+    assigned to every root and whenever a split event is reached (defined as a
+    parent having more than 1 child), with every child after the first
+    starting a new track. On a merge, the Spot keeps the track id of the first
+    branch to reach it.
+
+    The graph is stored in Compressed Sparse Row (CSR) format and the
+    traversal is carried out iteratively over linear segments (runs of Spots
+    with a single parent whose parent has a single child) rather than over
+    individual Spots, as all the Spots in a segment share a track id. This
+    means the Python-level work scales with the number of tracks, splits and
+    merges rather than the number of Spots.
+
+    :param spot_ids: Array of Spot IDs.
+    :param frames: Array of the frame of each Spot.
+    :param edge_sources: Spot IDs of the source of every Edge, in file order.
+    :param edge_targets: Spot IDs of the target of every Edge, in file order.
+    :return: An array the same length as spot_ids with the 0-indexed track id
+        of each Spot, or -1 for Spots that aren't part of any track.
+    """
+    n = spot_ids.shape[0]
+    track_ids = np.full(n, -1, dtype="int64")
+    if edge_sources.shape[0] == 0:
+        return track_ids
+
+    # Convert Spot IDs into row indices
+    sorter = np.argsort(spot_ids, kind="stable")
+    src = sorter[np.searchsorted(spot_ids, edge_sources, sorter=sorter)]
+    tgt = sorter[np.searchsorted(spot_ids, edge_targets, sorter=sorter)]
+
+    # CSR adjacency, with children kept in the order their Edges were read
+    order = np.argsort(src, kind="stable")
+    children = tgt[order]
+    out_degree = np.bincount(src, minlength=n)
+    in_degree = np.bincount(tgt, minlength=n)
+    indptr = np.zeros(n + 1, dtype="int64")
+    np.cumsum(out_degree, out=indptr[1:])
+
+    # A Spot starts a new segment unless it has a single parent which itself
+    # has a single child. Every other Spot continues its parent's segment,
+    # which is resolved by pointer jumping
+    in_graph = (in_degree > 0) | (out_degree > 0)
+    parent = np.arange(n)
+    single_parent = in_degree == 1
+    # Only need the parent for Spots with 1 parent, where it is unique
+    parent[tgt[single_parent[tgt]]] = src[single_parent[tgt]]
+    is_head = in_graph & ~(single_parent & (out_degree[parent] == 1))
+    segment = np.where(is_head | ~in_graph, np.arange(n), parent)
+    while True:
+        next_segment = segment[segment]
+        if np.array_equal(next_segment, segment):
+            break
+        segment = next_segment
+
+    # The tail of a segment is its last Spot, and its children are the heads
+    # of the segments that follow on from it
+    has_head_child = np.zeros(n, dtype=bool)
+    has_head_child[src[is_head[tgt]]] = True
+    is_tail = in_graph & ((out_degree != 1) | has_head_child)
+    tail = np.zeros(n, dtype="int64")
+    tail[segment[is_tail]] = np.flatnonzero(is_tail)
+
+    # Roots in frame order, ties broken by the order the Spots were read in
+    roots = np.flatnonzero(in_graph & (in_degree == 0))
+    roots = roots[np.argsort(frames[roots], kind="stable")]
+
+    # Depth-first traversal over segment heads
+    segment_track = np.full(n, -1, dtype="int64")
+    track_id = 0
+    stack = [(int(r), True) for r in roots[:0:-1]]
+    if roots.shape[0] > 0:
+        stack.append((int(roots[0]), False))
+    while stack:
+        head, accum = stack.pop()
+        # Prevent multiple tracks on a merge
+        if segment_track[head] >= 0:
+            continue
+        # Assign different track_ids after a split
+        if accum:
+            track_id += 1
+        segment_track[head] = track_id
+        seg_tail = tail[head]
+        seg_children = children[indptr[seg_tail]:indptr[seg_tail + 1]]
+        for j in range(seg_children.shape[0] - 1, -1, -1):
+            stack.append((int(seg_children[j]), j > 0))
+
+    track_ids[in_graph] = segment_track[segment[in_graph]]
+    return track_ids
+
+def keep_track_ids(track_ids: np.ndarray, previous_track_ids: np.ndarray) -> np.ndarray:
+    """
+    Renumbers the tracks so that those continuing from a previous run keep
+    their track ids, when the tracks have been extended into new frames.
+
+    Extending the tracks joins the segments again across the whole
+    timelapse, which can change the links in earlier frames, so a track from
+    the previous run can be split between tracks or joined onto another.
+    Each track takes the previous id of its first Spot that was tracked in
+    the previous run, and where several tracks would take the same id, the
+    first that assign_track_ids found keeps it. The remaining tracks, such
+    as those that start in the new frames, are numbered after the previous
+    ones in the order that assign_track_ids found them.
+
+    :param track_ids: Array of the 0-indexed track id of each Spot from
+        assign_track_ids, or -1 for Spots that aren't part of any track. The
+        Spots are in the order of their IDs.
+    :param previous_track_ids: Array of the 0-indexed track id of each Spot in
+        the previous run, or -1 for Spots that weren't part of any track or
+        didn't exist.
+    :return: An array the same length as track_ids with the renumbered track
+        id of each Spot, or -1 for Spots that aren't part of any track.
+    """
+    tracked = track_ids >= 0
+    if not tracked.any():
+        return track_ids
+    mapping = np.full(track_ids.max() + 1, -1, dtype="int64")
+    continuing = np.flatnonzero(tracked & (previous_track_ids >= 0))
+    tracks, first = np.unique(track_ids[continuing], return_index=True)
+    claimed = previous_track_ids[continuing[first]]
+    # tracks is sorted, so the first track to claim each id keeps it
+    kept_ids, keeps = np.unique(claimed, return_index=True)
+    mapping[tracks[keeps]] = kept_ids
+    is_new = mapping < 0
+    mapping[is_new] = max(previous_track_ids.max(initial=-1) + 1, 0) + np.arange(is_new.sum())
+    return np.where(tracked, mapping[np.maximum(track_ids, 0)], -1)
+
+def filter_size_and_observations(
+    areas: np.ndarray,
+    track_ids: np.ndarray,
+    minimum_cell_size: int,
+    minimum_observations: int,
+) -> np.ndarray:
+    """
+    Identifies the Spots that pass the size and number of observations QC.
+
+    Spots smaller than minimum_cell_size are removed first, then any track
+    with fewer than minimum_observations of the remaining Spots.
+
+    :param areas: Array of the AREA of each Spot.
+    :param track_ids: Array of the track id of each Spot.
+    :param minimum_cell_size: Minimum AREA of a Spot.
+    :param minimum_observations: Minimum number of Spots in a track.
+    :return: A boolean array the same length as areas, True for the Spots to
+        keep.
+    """
+    # NaN areas compare False so are removed, as in dplyr::filter
+    keep = areas >= minimum_cell_size
+    _, inverse, counts = np.unique(track_ids[keep], return_inverse=True, return_counts=True)
+    keep[keep] = counts[inverse] >= minimum_observations
+    return keep
 
 parser = argparse.ArgumentParser(
                     description='Tracks a given image'
 )
-parser.add_argument('xml_path', help="Path of TrackMate XML file")
+parser.add_argument('xml_path', help="Path of TrackMate XML file, or the .npz export from track_images.py")
 parser.add_argument('rois_path', help="Path to output ROIs zip")
 parser.add_argument('csv_path', help="Path to output feature csv")
+parser.add_argument('--streaming', action='store_true', help="Parse the XML incrementally to reduce peak memory")
+parser.add_argument('--roi-workers', help="Number of processes to use when writing the ROIs", default=1, type=int)
+parser.add_argument('--roi-shard-dir', help="Directory to additionally save the ROIs to as 1 archive per frame")
+parser.add_argument('--filtered-csv-path', help="Path to output the features of the cells that pass the size and observations QC. Only these cells' ROIs are saved")
+parser.add_argument('--filtered-parquet-path', help="Path to additionally save the filtered features to in Parquet format, which is faster for the later steps to read")
+parser.add_argument('--minimum-cell-size', help="Minimum AREA of a cell to keep in the filtered output", default=0, type=int)
+parser.add_argument('--minimum-observations', help="Minimum number of frames a cell must be tracked across to keep in the filtered output", default=0, type=int)
+parser.add_argument('--previous-features', help="The unfiltered features CSV from a previous run, when the tracks have since been extended into new frames. The tracks from that run keep their TRACK_IDs")
+parser.add_argument('--profile', help="Path to save a JSON profile of the time and memory used")
 args = parser.parse_args()
 
-tree = ET.parse(args.xml_path)
-spot_records = []
-rois = {}
+profile = Profile(args.profile, workers=args.roi_workers)
+profile.add_inputs(args.xml_path, args.previous_features)
+profile.phase("read")
+if args.xml_path.endswith(".npz"):
+    data = read_trackmate_npz(args.xml_path)
+elif args.streaming:
+    data = read_trackmate_xml_streaming(args.xml_path)
+else:
+    data = read_trackmate_xml(args.xml_path)
+spot_df = data.spots
+profile.record(spots=spot_df.shape[0], edges=data.edge_sources.size)
 
-# Get all Spots
-nodes = {}
-@dataclass
-class Node:
-    id: int
-    frame: int
-    children: List[id] = field(default_factory=list)
-    parents: List[id] = field(default_factory=list)
-
-for frame in tree.findall("./Model/AllSpots/SpotsInFrame"):
-    # Get all spots, reading in their attributes and ROIs
-    for spot in frame.findall("Spot"):
-        spot_records.append(spot.attrib)
-        node_id = int(spot.attrib['ID'])
-        nodes[node_id] = Node(id=node_id, frame=int(spot.attrib['FRAME']))
-        # Read ROIs
-        coords = np.array([spot.text.split(" ")]).astype(float)
-        coords = coords.reshape(int(coords.size / 2), 2)
-        coords[:, 0] = coords[:, 0] + float(spot.attrib["POSITION_X"])
-        coords[:, 1] = coords[:, 1] + float(spot.attrib["POSITION_Y"])
-        rois[spot.attrib["name"]] = coords
-spot_df = pd.DataFrame.from_records(spot_records)
-spot_df = spot_df.rename(columns={"name": "LABEL"})
-spot_df['ID'] = spot_df['ID'].astype('int')
-spot_df['FRAME'] = spot_df['FRAME'].astype('int')
-
-# Add edges to children and parents
-for track in tree.findall("./Model/AllTracks/Track"):
-    for edge in track.findall("Edge"):
-        source_id = int(edge.attrib["SPOT_SOURCE_ID"])
-        target_id = int(edge.attrib["SPOT_TARGET_ID"])
-        nodes[source_id].children.append(target_id)
-        nodes[target_id].parents.append(source_id)
-
-# Remove nodes with no parents or children - not part of any track
-for id in list(nodes.keys()):
-    if len(nodes[id].parents) == 0 and len(nodes[id].children) == 0:
-        nodes.pop(id)
-
-# Obtain root nodes in frame order
-root_nodes = [n for id, n in nodes.items() if len(n.parents) == 0]
-root_nodes.sort(key = lambda x: x.frame)
-
-# Iterate through graph, creating unique track ids
-track_records = []
-track_id = 0
-traversed_nodes = set()
-def traverse_track(node, accum=False):
-    """
-    Recursive function to traverse a graph representing tracks between
-    cells in a timelapse.
-    A global counter keeps track of the current track id, and is incremented
-    whenever a split event is reached (defined as a parent having more than
-    1 child).
-
-    Args:
-        - node (Node): The current node being visited.
-        - accum (bool): Whether to accumulate the track_id counter in case a
-          split event is reached.
-
-    Returns:
-        None. Populates a global variable `track_records` with visited nodes
-        and their newly assigned track_id instead.
-    """
-    global track_id
-
-    # Prevent multiple tracks on a merge
-    if node.id in traversed_nodes:
-        return
-
-    # Assign different track_ids after a split
-    if accum:
-        track_id += 1
-
-    track_records.append({'ID': node.id, 'TRACK_ID': track_id})
-    traversed_nodes.add(node.id)
-    for j, child in enumerate(node.children):
-        traverse_track(nodes[child], j > 0)
-
-# Traverse graph starting from from all root nodes, each of which will
-# accumulate the track counter.
-for i, root in enumerate(root_nodes):
-    traverse_track(root, i > 0)
-
-# Combine Spots and Tracks into single DataFrame
-track_df = pd.DataFrame.from_records(track_records)
-comb_df = pd.merge(spot_df, track_df, on="ID")
+profile.phase("track")
+# Assign a TRACK_ID to every Spot that is part of a track
+track_ids = assign_track_ids(
+    spot_df['ID'].values,
+    spot_df['FRAME'].values,
+    data.edge_sources,
+    data.edge_targets,
+)
+if args.previous_features is not None:
+    previous_df = pd.read_csv(args.previous_features, usecols=["ID", "TRACK_ID"])
+    # Back to 0-indexed
+    previous_track_ids = previous_df.set_index("ID")["TRACK_ID"].reindex(spot_df["ID"].values).fillna(0).values.astype("int64") - 1
+    track_ids = keep_track_ids(track_ids, previous_track_ids)
+is_tracked = track_ids >= 0
+# Keep track of each Spot's row so that its ROI can be found once the untracked
+# Spots have been removed
+roi_indices = np.flatnonzero(is_tracked)
+comb_df = spot_df.loc[is_tracked].reset_index(drop=True)
+comb_df["TRACK_ID"] = track_ids[is_tracked]
 
 # Reorder columns to be the same as exported from the GUI
 col_order = [
@@ -209,19 +737,49 @@ comb_df["ROI_FILENAME"] = (
     + "-"
     + comb_df["ID"].astype(str).str.pad(n_digits_spot_id, fillchar="0")
 )
-clean_rois = []
-for _, row in comb_df.iterrows():
-    try:
-        this_cell = {
-            "CellID": row["TRACK_ID"],
-            "FrameID": row["FRAME"],
-            "Filename": row["ROI_FILENAME"],
-            "coords": rois[row["LABEL"]],
-        }
-        clean_rois.append(this_cell)
-    except KeyError:
-        pass
+# Spots without a contour have no ROI to save
+has_roi = (data.roi_offsets[roi_indices + 1] - data.roi_offsets[roi_indices]) > 0
+filtering = args.filtered_csv_path is not None or args.filtered_parquet_path is not None
+if filtering:
+    passes_qc = filter_size_and_observations(
+        pd.to_numeric(comb_df["AREA"], errors="coerce").values,
+        comb_df["TRACK_ID"].values,
+        args.minimum_cell_size,
+        args.minimum_observations,
+    )
+    # Nothing downstream uses the ROIs of the cells that fail QC
+    has_roi &= passes_qc
+roi_rows = np.flatnonzero(has_roi)
+if args.roi_shard_dir is not None:
+    # Group ROIs by frame so that each shard is written in one go
+    roi_rows = roi_rows[np.argsort(comb_df["FRAME"].values[roi_rows], kind="stable")]
+    os.makedirs(args.roi_shard_dir, exist_ok=True)
+roi_coords, roi_offsets = data.subset_rois(roi_indices[roi_rows])
 
 # Save to disk
+profile.phase("write_tables")
 comb_df.to_csv(args.csv_path, index=False)
-save_rois(clean_rois, args.rois_path)
+# Only written if any cells pass QC, so that the downstream steps are skipped otherwise
+if filtering and passes_qc.any():
+    filtered_df = comb_df.loc[passes_qc]
+    if args.filtered_csv_path is not None:
+        filtered_df.to_csv(args.filtered_csv_path, index=False)
+    if args.filtered_parquet_path is not None:
+        # Depending on the reader the values can be strings, but Parquet keeps
+        # the types so give every reader the same schema
+        filtered_df = filtered_df.copy()
+        for col in filtered_df.columns.drop(["LABEL", "ROI_FILENAME"]):
+            dtype = "int64" if col in ["ID", "TRACK_ID", "FRAME"] else "float64"
+            filtered_df[col] = pd.to_numeric(filtered_df[col], errors="coerce").astype(dtype)
+        write_table(filtered_df, args.filtered_parquet_path)
+profile.phase("write_rois")
+save_rois(
+    roi_coords,
+    roi_offsets,
+    comb_df["ROI_FILENAME"].values[roi_rows].tolist(),
+    comb_df["FRAME"].values[roi_rows].tolist(),
+    args.rois_path,
+    n_workers=args.roi_workers,
+    shard_dir=args.roi_shard_dir,
+)
+profile.save()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+from cellphe.features.frame import STATIC_FEATURE_NAMES
+import argparse
+import numpy as np
+import pandas as pd
+from profiling import Profile
+from tables import read_trackmate, write_table
+
+parser = argparse.ArgumentParser(
+                    description='Finds the frames whose static frame features need calculating after the tracks of a timelapse have been extended into new frames, reusing the features of the other frames from the previous run'
+)
+parser.add_argument('trackmate', help="The filtered TrackMate features, as CSV or Parquet")
+parser.add_argument('frames_path', help="Where to save the FrameIDs of the frames to calculate the features of, 1 per line")
+parser.add_argument('reused_path', help="Where to save the reused static frame features, as CSV or Parquet. Only written if any frames are reused")
+parser.add_argument('--previous', help="The frame features CSV from the previous run. If not provided, every frame is calculated")
+parser.add_argument('--profile', help="Path to save a JSON profile of the time and memory used")
+args = parser.parse_args()
+
+profile = Profile(args.profile)
+profile.add_inputs(args.trackmate, args.previous)
+profile.phase("read")
+cells = read_trackmate(args.trackmate)
+id_cols = ["FrameID", "CellID"]
+if args.previous is None:
+    recalculate = np.unique(cells["FrameID"])
+    reused = cells.iloc[:0]
+else:
+    previous = pd.read_csv(args.previous, usecols=id_cols + STATIC_FEATURE_NAMES, float_precision="round_trip")
+    profile.record(previous_rows=previous.shape[0])
+
+    profile.phase("plan")
+    # Cells keep their CellIDs when the tracks are extended, so a cell's
+    # static features in an earlier frame can be reused. A frame with any
+    # cell that's new to it, such as one that now passes the QC, is
+    # recalculated in full
+    cells = cells.merge(previous, on=id_cols, how="left", indicator=True)
+    recalculate = np.unique(cells.loc[cells["_merge"] == "left_only", "FrameID"])
+    reused = cells.loc[~cells["FrameID"].isin(recalculate)]
+profile.record(rows=cells.shape[0], frames=cells["FrameID"].nunique(), recalculated_frames=recalculate.size)
+
+profile.phase("write")
+with open(args.frames_path, "w") as outfile:
+    outfile.writelines(f"{frame_id}\n" for frame_id in recalculate)
+if reused.shape[0] > 0:
+    # Same columns and types as frame_features_image.py
+    reused = reused[STATIC_FEATURE_NAMES + ["FrameID", "CellID", "ROI_filename"]].astype({col: "float64" for col in STATIC_FEATURE_NAMES})
+    write_table(reused, args.reused_path)
+print(f"Reusing the frame features of {reused['FrameID'].nunique()} frames, calculating {recalculate.size} frames")
+profile.save()
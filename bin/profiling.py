@@ -0,0 +1,165 @@
+"""
+Optional resource profiles of the pipeline's scripts.
+
+A profile records how long each phase of a script took, the peak resident
+memory of the script and of any worker processes it started, and the size
+of its inputs, and is saved as a small JSON file. The total size and number
+of the input files are the same measurements that nextflow.config can take
+of a task's inputs before it's submitted, so a model fitted to the profiles
+by fit_resource_model.py can be used to request each task's memory and time.
+Used by every script in bin/ through its --profile option, and by
+fit_resource_model.py.
+"""
+import json
+import os
+import resource
+import sys
+import time
+
+# The extension of OME-TIFF frame references, as in ome_frames.py, which isn't
+# imported as not every script's container has tifffile
+FRAME_REF_SUFFIX = ".omeframe"
+
+def _file_sizes(path: str) -> list[int]:
+    """
+    The sizes of a file, or of every file within a directory.
+
+    An OME-TIFF frame reference counts as the size of the page it refers to,
+    which index_ome_frames.py saves in the reference, matching input_size in
+    nextflow.config.
+
+    :param path: Path to a file or directory.
+    :return: A list of file sizes in bytes.
+    """
+    if str(path).endswith(FRAME_REF_SUFFIX):
+        with open(path) as infile:
+            return [json.load(infile).get("bytes", os.path.getsize(path))]
+    if not os.path.isdir(path):
+        return [os.path.getsize(path)]
+    sizes = []
+    for root, _, filenames in os.walk(path):
+        sizes.extend(os.path.getsize(os.path.join(root, fn)) for fn in filenames)
+    return sizes
+
+def _peak_rss_mb(who: int) -> float:
+    """
+    The peak resident set size of this process or its largest child.
+
+    :param who: resource.RUSAGE_SELF or resource.RUSAGE_CHILDREN.
+    :return: The peak RSS in MB.
+    """
+    peak = resource.getrusage(who).ru_maxrss
+    # Reported in bytes on macOS and KB everywhere else
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+def task_memory_mb(profile: dict) -> float:
+    """
+    An upper bound on the memory used by a profiled script and its workers.
+
+    Every worker is assumed to reach the peak RSS of the largest one at the
+    same time. Forked workers share their parent's pages until they write to
+    them but each counts them in its own RSS, so this overestimates rather
+    than underestimates what the scheduler will see.
+
+    :param profile: A profile as loaded from the JSON file.
+    :return: The memory in MB.
+    """
+    return profile["peak_rss_mb"] + profile["workers"] * profile["peak_worker_rss_mb"]
+
+class Profile:
+    """
+    Collects the resource usage of a script, saving it on request.
+
+    Every method is cheap enough to call unconditionally, and when no output
+    path is given save does nothing, so scripts don't need to check whether
+    profiling was requested.
+    """
+    def __init__(self, path: str | None, workers: int = 1):
+        """
+        :param path: Where to save the profile JSON, or None to not save it.
+        :param workers: Number of worker processes the script runs.
+        """
+        self.path = path
+        self.workers = workers
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.current_phase = None
+        self.sizes = {}
+        self.input_bytes = 0
+        self.input_files = 0
+
+    def phase(self, name: str) -> None:
+        """
+        Starts timing a phase of the script, ending the previous one.
+
+        Time spent in a phase with the same name as an earlier one is added
+        onto it.
+
+        :param name: The phase name.
+        :return: None, updates the profile as a side-effect.
+        """
+        self._end_phase()
+        self.current_phase = (name, time.perf_counter())
+
+    def _end_phase(self) -> None:
+        """
+        Adds the time since the current phase started onto its total.
+
+        :return: None, updates the profile as a side-effect.
+        """
+        if self.current_phase is not None:
+            name, start = self.current_phase
+            self.phases[name] = self.phases.get(name, 0) + time.perf_counter() - start
+            self.current_phase = None
+
+    def add_inputs(self, *paths) -> None:
+        """
+        Adds files onto the total size and number of the inputs.
+
+        These should be the same files as the Nextflow process's inputs.
+
+        :param paths: Paths to files or directories, or lists of them.
+        :return: None, updates the profile as a side-effect.
+        """
+        for path in paths:
+            if path is None:
+                continue
+            if isinstance(path, (list, tuple)):
+                self.add_inputs(*path)
+                continue
+            sizes = _file_sizes(path)
+            self.input_bytes += sum(sizes)
+            self.input_files += len(sizes)
+
+    def record(self, **sizes) -> None:
+        """
+        Records the dimensions of the inputs, such as the number of frames,
+        Spots, or pixels.
+
+        :param sizes: The dimensions as keyword arguments.
+        :return: None, updates the profile as a side-effect.
+        """
+        self.sizes.update({key: int(value) for key, value in sizes.items()})
+
+    def save(self) -> None:
+        """
+        Saves the profile as JSON, if an output path was given.
+
+        :return: None, writes to disk as a side-effect.
+        """
+        if self.path is None:
+            return
+        self._end_phase()
+        profile = {
+            "script": os.path.splitext(os.path.basename(sys.argv[0]))[0],
+            "wall_seconds": time.perf_counter() - self.start,
+            "phases": self.phases,
+            "peak_rss_mb": _peak_rss_mb(resource.RUSAGE_SELF),
+            "peak_worker_rss_mb": _peak_rss_mb(resource.RUSAGE_CHILDREN),
+            "workers": self.workers,
+            "input_files": self.input_files,
+            "input_bytes": self.input_bytes,
+            "sizes": self.sizes,
+        }
+        with open(self.path, "w") as outfile:
+            json.dump(profile, outfile, indent=2)
@@ -0,0 +1,95 @@
+"""
+Small downsampled previews of each segmented frame for the segmentation QC
+report.
+
+The thumbnails are created by the segmentation step while the full size
+image and mask are already in memory, so the report only has to load a few
+small arrays per frame rather than every full size image and mask. Each
+thumbnail holds the downsampled image, the cell outlines, the downsampled
+mask for the fill highlighting, and the area of every cell at full
+resolution for the cell count and size summaries. Used by
+segment_image_batch.py, and read by segmentation_qc.qmd.
+"""
+import math
+from pathlib import Path
+import numpy as np
+from scipy import ndimage
+from skimage.segmentation import find_boundaries
+
+THUMBNAIL_SUFFIX = "_qc.npz"
+
+def thumbnail_filename(image_fn: str) -> str:
+    """
+    The filename of a frame's thumbnail.
+
+    :param image_fn: Path to the raw image or OME-TIFF frame reference.
+    :return: The filename, frame_<frameid>_qc.npz, in the current directory.
+    """
+    return f"{Path(image_fn).stem}{THUMBNAIL_SUFFIX}"
+
+def _block_reduce(array: np.ndarray, factor: int, func) -> np.ndarray:
+    """
+    Downsamples the first 2 dimensions of an array by applying a function
+    to each factor x factor block.
+
+    :param array: The array to downsample.
+    :param factor: The size of each block.
+    :param func: A numpy reduction accepting an axis argument, such as
+        np.mean or np.max.
+    :return: The downsampled array. Partial blocks at the edges are padded
+        by repeating the edge values.
+    """
+    rows = math.ceil(array.shape[0] / factor) * factor
+    cols = math.ceil(array.shape[1] / factor) * factor
+    padding = [(0, rows - array.shape[0]), (0, cols - array.shape[1])] + [(0, 0)] * (array.ndim - 2)
+    array = np.pad(array, padding, mode="edge")
+    blocks = array.reshape(rows // factor, factor, cols // factor, factor, *array.shape[2:])
+    return func(blocks, axis=(1, 3))
+
+def make_thumbnail(image: np.ndarray, mask: np.ndarray, max_size: int = 256) -> dict[str, np.ndarray]:
+    """
+    Creates the QC thumbnail of a segmented frame.
+
+    :param image: The raw image.
+    :param mask: The segmentation mask, with 0 as the background and every
+        cell labelled with its own integer.
+    :param max_size: The maximum number of rows or columns of the
+        thumbnail.
+    :return: A dict of the thumbnail arrays:
+        - image: the image, downsampled by averaging
+        - outline: boolean array of the cell outlines
+        - labels: the mask, downsampled by taking every factor-th pixel
+        - cell_ids: the label of every cell in the mask
+        - cell_areas: the number of pixels in every cell at full resolution
+    """
+    factor = max(1, math.ceil(max(mask.shape[:2]) / max_size))
+    outline = _block_reduce(find_boundaries(mask, mode="inner"), factor, np.max)
+    # Thicken the outlines so they're visible in the report, to the same
+    # extent as a 5x5 dilation at full resolution
+    width = math.ceil(5 / factor)
+    if width > 1:
+        outline = ndimage.binary_dilation(outline, structure=np.ones((width, width), dtype=bool))
+    areas = np.bincount(mask.ravel().astype(np.int64))
+    cell_ids = np.flatnonzero(areas)
+    cell_ids = cell_ids[cell_ids != 0]
+    return {
+        "image": _block_reduce(image.astype(np.float32), factor, np.mean),
+        "outline": outline,
+        # Same type as the saved masks
+        "labels": mask[::factor, ::factor].astype(np.uint16),
+        "cell_ids": cell_ids,
+        "cell_areas": areas[cell_ids],
+    }
+
+def save_thumbnail(fn: str, image: np.ndarray, mask: np.ndarray, max_size: int = 256) -> None:
+    """
+    Creates and saves the QC thumbnail of a segmented frame.
+
+    :param fn: Path to save the thumbnail to, see thumbnail_filename.
+    :param image: The raw image.
+    :param mask: The segmentation mask.
+    :param max_size: The maximum number of rows or columns of the
+        thumbnail.
+    :return: None, writes to disk as a side-effect.
+    """
+    np.savez_compressed(fn, **make_thumbnail(image, mask, max_size))
@@ -1,25 +1,213 @@
 #!/usr/bin/env python3
 from cellpose import models
 import argparse
+from collections import deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import time
 import numpy as np
 from pathlib import Path
-from PIL import Image
 from skimage import io
 import json
+from frame_files import read_frame
+from mask_cache import MaskCache, cache_key
+from profiling import Profile
+from qc_thumbnails import save_thumbnail, thumbnail_filename
+from tiled_segmentation import normalise_for_tiles, segment_tiled
+
+def prefetch(fns: list[str], reader: ThreadPoolExecutor, n_ahead: int) -> Iterator[tuple[str, np.ndarray]]:
+    """
+    Reads images in order, keeping a number of reads ahead queued in a pool
+    so the images are decoded while the earlier ones are segmented.
+
+    :param fns: Paths to the images.
+    :param reader: The pool to read the images in.
+    :param n_ahead: Maximum number of images to read ahead.
+    :return: A generator of tuples of each path and its image.
+    """
+    fn_iter = iter(fns)
+    pending = deque((fn, reader.submit(read_frame, fn)) for fn in itertools.islice(fn_iter, max(1, n_ahead)))
+    while pending:
+        fn, image = pending.popleft()
+        pending.extend((next_fn, reader.submit(read_frame, next_fn)) for next_fn in itertools.islice(fn_iter, 1))
+        yield fn, image.result()
+
+def mini_batches(images: Iterable[tuple[str, np.ndarray]], batch_size: int) -> Iterator[list[tuple[str, np.ndarray]]]:
+    """
+    Groups consecutive images of the same shape into batches, which can be
+    segmented as a single stack.
+
+    :param images: Tuples of each image's path and the image.
+    :param batch_size: Maximum number of images in a batch.
+    :return: A generator of lists of tuples of each path and image.
+    """
+    batch = []
+    for fn, image in images:
+        if len(batch) == batch_size or (len(batch) > 0 and batch[0][1].shape != image.shape):
+            yield batch
+            batch = []
+        batch.append((fn, image))
+    if len(batch) > 0:
+        yield batch
+
+def stack_eval_args(eval_args: dict) -> dict | None:
+    """
+    The arguments for CellposeModel.eval to segment a stack of 2D images in
+    a single call. In Cellpose 3.1, CellposeModel.eval treats the z axis of
+    a stack as separate planes when it isn't segmenting in 3D or stitching,
+    normalising each plane and computing its masks on its own, while
+    core.run_net runs the tiles of as many planes as fit in batch_size tiles
+    through the network at once. tests/test_segment_image_batch.py checks
+    that this gives the same masks as segmenting each image separately.
+
+    :param eval_args: The arguments for a single image.
+    :return: The arguments for a stack, or None if the settings segment in
+        3D or give the z axis themselves, so images can't be stacked.
+    """
+    if eval_args.get("do_3D") or eval_args.get("stitch_threshold") or eval_args.get("z_axis") is not None:
+        return None
+    stack_args = {**eval_args, "z_axis": 0}
+    channel_axis = eval_args.get("channel_axis")
+    if channel_axis is not None and channel_axis >= 0:
+        stack_args["channel_axis"] = channel_axis + 1
+    return stack_args
+
+def segment_batch(model: models.CellposeModel, images: list[np.ndarray], eval_args: dict, stack_args: dict | None) -> list[np.ndarray]:
+    """
+    Segments a batch of images of the same shape.
+
+    :param model: The loaded Cellpose model.
+    :param images: The images.
+    :param eval_args: Arguments for CellposeModel.eval for a single image.
+    :param stack_args: Arguments for CellposeModel.eval for a stack of
+        images, as output from stack_eval_args.
+    :return: A list of the masks of each image.
+    """
+    if len(images) == 1:
+        return [model.eval(images[0], **eval_args)[0]]
+    return list(model.eval(np.stack(images), **stack_args)[0])
+
+def segment_tiled_image(model: models.CellposeModel, image: np.ndarray, eval_args: dict, tile_size: int, overlap: int) -> np.ndarray:
+    """
+    Segments an image in overlapping tiles, normalised as a whole.
+
+    :param model: The loaded Cellpose model.
+    :param image: The image.
+    :param eval_args: Arguments for CellposeModel.eval for the image.
+    :param tile_size: Size of each square tile in pixels.
+    :param overlap: Overlap between neighbouring tiles in pixels.
+    :return: The image's masks.
+    """
+    normalised, tile_args = normalise_for_tiles(image, eval_args, model.nchan)
+    return segment_tiled(normalised, lambda tile: model.eval(tile, **tile_args)[0], tile_size, overlap)
+
+def save_outputs(fn: str, image: np.ndarray, masks: np.ndarray, thumbnail_size: int | None, cache: MaskCache | None, key: str | None) -> None:
+    """
+    Saves an image's masks, along with its QC thumbnail and cache entry if
+    requested.
+
+    :param fn: Path to the image.
+    :param image: The image.
+    :param masks: The image's masks.
+    :param thumbnail_size: Maximum number of rows and columns of the
+        thumbnail, or None to not save one.
+    :param cache: The mask cache to add the masks to, or None.
+    :param key: The image's cache key.
+    :return: None, writes to disk as a side-effect.
+    """
+    output_fn = f"{Path(fn).stem}_mask.png"
+    io.imsave(output_fn, masks.astype("uint16"))  # Assuming masks are uint16
+    if thumbnail_size is not None:
+        save_thumbnail(thumbnail_filename(fn), image, masks, thumbnail_size)
+    if cache is not None:
+        cache.put(key, output_fn)
 
 parser = argparse.ArgumentParser(
-                    description='Creates the segmentation mask for a single image using CellPose'
+                    description='Creates the segmentation masks for a batch of images using CellPose, loading the model once'
 )
 parser.add_argument('model_args', help="Arguments for CellPoseModel")
 parser.add_argument('eval_args', help="Arguments for CellPoseModel.eval")
-parser.add_argument('files', help="List of images to process")
+parser.add_argument('files', help="List of images, or OME-TIFF frame references, to process")
+parser.add_argument('--threads', help="Number of threads for PyTorch to use within each operation, defaults to PyTorch's own choice", default=None, type=int)
+parser.add_argument('--cache-dir', help="Directory of previously created masks to reuse", default=None)
+parser.add_argument('--cache-max-gb', help="Maximum size of the mask cache in GB, evicting the least recently used masks", default=None, type=float)
+parser.add_argument('--cache-tag', help="Identifier of the segmentation environment, such as the container image, to include in the cache key", default="")
+parser.add_argument('--tile-size', help="Segment the image in square tiles of this many pixels to reduce memory usage, rather than all at once", default=None, type=int)
+parser.add_argument('--tile-overlap', help="Overlap between tiles in pixels, which should be larger than the largest cell diameter", default=128, type=int)
+parser.add_argument('--batch-size', help="Number of images of the same shape to segment in a single call to the model, so a GPU can process tiles from several images at once. Cellpose's eval batch_size sets how many tiles that is", default=1, type=int)
+parser.add_argument('--readers', help="Number of threads to read and decode the upcoming images in while the current ones are segmented", default=2, type=int)
+parser.add_argument('--writers', help="Number of threads to encode and save the masks in while the next images are segmented", default=2, type=int)
+parser.add_argument('--thumbnail-size', help="Also save a downsampled QC thumbnail of each frame with at most this many rows and columns, as frame_<frameid>_qc.npz", default=None, type=int)
+parser.add_argument('--profile', help="Path to save a JSON profile of the time and memory used")
 args = parser.parse_args()
 model_args = json.loads(args.model_args)
 eval_args = json.loads(args.eval_args)
+# Tiling can change the mask so needs to be part of the cache key
+tile_options = None if args.tile_size is None else {"tile_size": args.tile_size, "tile_overlap": args.tile_overlap}
 
-model = models.CellposeModel(**model_args)
-for fn in args.files.split(" "):
-    output_fn = f"{Path(fn).stem}_mask.png"
-    image = np.array(Image.open(fn))
-    masks = model.eval(image, **eval_args)[0]
-    io.imsave(output_fn, masks.astype("uint16"))  # Assuming masks are uint16
+fns = args.files.split(" ")
+profile = Profile(args.profile)
+profile.add_inputs(fns)
+profile.record(images=len(fns))
+cache = None
+if args.cache_dir is not None:
+    max_bytes = None if args.cache_max_gb is None else int(args.cache_max_gb * 1e9)
+    profile.phase("cache")
+    cache = MaskCache(args.cache_dir, max_bytes)
+    keys = {fn: cache_key(fn, model_args, eval_args, args.cache_tag, tile_options) for fn in fns}
+    cached_fns = [fn for fn in fns if cache.get(keys[fn], f"{Path(fn).stem}_mask.png")]
+    fns = [fn for fn in fns if fn not in cached_fns]
+    # The thumbnails aren't cached as they're quick to create from the image
+    # and mask, but without segmenting they need reading in
+    if args.thumbnail_size is not None:
+        for fn in cached_fns:
+            save_thumbnail(thumbnail_filename(fn), read_frame(fn), io.imread(f"{Path(fn).stem}_mask.png"), args.thumbnail_size)
+
+if args.threads is not None:
+    # Only needed here, as Cellpose loads PyTorch itself
+    import torch
+    torch.set_num_threads(args.threads)
+
+# Tiled images are segmented 1 at a time, so memory is bounded by the tile size
+batch_size = 1 if args.tile_size is not None else args.batch_size
+stack_args = stack_eval_args(eval_args)
+if batch_size > 1 and stack_args is None:
+    print("The eval settings segment in 3D or set the z axis, so images are segmented 1 at a time")
+    batch_size = 1
+
+# Only load the model if there are images that weren't in the cache
+if len(fns) > 0:
+    profile.phase("load_model")
+    model = models.CellposeModel(**model_args)
+    profile.phase("segment")
+    pixels = 0
+    start = time.perf_counter()
+    # The upcoming images are read in the background and the masks saved in
+    # the background, so the model is kept busy. At most a few batches of
+    # masks wait to be saved so memory usage stays bounded
+    with ThreadPoolExecutor(max_workers=max(1, args.readers)) as reader, ThreadPoolExecutor(max_workers=max(1, args.writers)) as writer:
+        saving = deque()
+        for batch in mini_batches(prefetch(fns, reader, args.readers + batch_size), batch_size):
+            images = [image for _, image in batch]
+            if args.tile_size is None:
+                batch_masks = segment_batch(model, images, eval_args, stack_args)
+            else:
+                batch_masks = [segment_tiled_image(model, image, eval_args, args.tile_size, args.tile_overlap) for image in images]
+            for (fn, image), masks in zip(batch, batch_masks):
+                pixels += image.shape[0] * image.shape[1]
+                key = None if cache is None else keys[fn]
+                saving.append(writer.submit(save_outputs, fn, image, masks, args.thumbnail_size, cache, key))
+            while len(saving) > max(1, args.writers) * batch_size:
+                saving.popleft().result()
+        for future in saving:
+            future.result()
+    elapsed = time.perf_counter() - start
+    print(f"Segmented {len(fns)} images in {elapsed:.1f} seconds, {len(fns) / elapsed:.2f} images per second")
+    profile.record(segmented=len(fns), pixels=pixels)
+
+if cache is not None:
+    profile.phase("cache")
+    cache.evict()
+    print(cache.summary())
+profile.save()
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+import argparse
+from frame_files import get_frame_id, read_frame
+from frame_store import create_store, read_metadata, write_frame
+from parallel import parallel_map
+from profiling import Profile
+
+def store_frame(store: str, metadata: dict, fn: str) -> None:
+    """
+    Saves a single frame into the store.
+
+    :param store: Directory of the store.
+    :param metadata: The store's metadata.
+    :param fn: Path to the frame.
+    :return: None, writes to disk as a side-effect.
+    """
+    write_frame(store, metadata, get_frame_id(fn) - 1, read_frame(fn))
+
+parser = argparse.ArgumentParser(
+                    description='Saves frames into a chunked, compressed frame store that they can be read back from individually'
+)
+parser.add_argument('store', help="Directory of the frame store")
+parser.add_argument('frames', help="Space separated list of frames to save, named frame_<frameid>")
+parser.add_argument('--create', help="Create the store's metadata for a timelapse with this many frames, using the first frame for the frame shape and data type, rather than saving the frames", default=None, type=int)
+parser.add_argument('--chunk-size', help="Size of each square chunk in pixels, when creating the store", default=1024, type=int)
+parser.add_argument('--compression-level', help="zlib compression level from 1 (fastest) to 9 (smallest), when creating the store", default=1, type=int)
+parser.add_argument('--workers', help="Number of frames to save in parallel", default=1, type=int)
+parser.add_argument('--profile', help="Path to save a JSON profile of the time and memory used")
+args = parser.parse_args()
+
+fns = args.frames.split(" ")
+profile = Profile(args.profile, workers=args.workers)
+profile.add_inputs(fns)
+profile.record(frames=len(fns))
+profile.phase("write")
+if args.create is not None:
+    first_frame = read_frame(fns[0])
+    create_store(args.store, args.create, first_frame.shape, first_frame.dtype, args.chunk_size, args.compression_level)
+else:
+    metadata = read_metadata(args.store)
+    # Consume the results so any errors are raised
+    list(parallel_map(store_frame, args.workers, [args.store] * len(fns), [metadata] * len(fns), fns))
+profile.save()
@@ -0,0 +1,135 @@
+"""
+Reading and writing the tables passed between the CellPhe steps, stored as
+either CSV or Parquet depending on the file extension.
+
+Parquet files keep the column types, so nothing needs to be parsed when
+they're read, and are stored by column, so only the columns a step uses are
+read from disk. CSV is still used for the final outputs. Parquet support
+requires pyarrow. Used by parse_xml.py, frame_features_image.py,
+plan_frame_features.py, combine_frame_features.py,
+create_frame_summary_features.py and time_series_features.py.
+"""
+from collections.abc import Iterator
+import pandas as pd
+
+def is_parquet(filename: str) -> bool:
+    """
+    Whether a table is stored as Parquet rather than CSV.
+
+    :param filename: Path to the table.
+    :return: True if the file has a .parquet extension.
+    """
+    return str(filename).endswith(".parquet")
+
+def read_table(filename: str, columns: list[str] | None = None) -> pd.DataFrame:
+    """
+    Reads a table into memory.
+
+    :param filename: Path to a CSV or Parquet file.
+    :param columns: The columns to read, or None for all of them.
+    :return: A DataFrame.
+    """
+    if is_parquet(filename):
+        return pd.read_parquet(filename, columns=columns)
+    return pd.read_csv(filename, usecols=columns)
+
+def iter_table(filename: str, chunksize: int, columns: list[str] | None = None) -> Iterator[pd.DataFrame]:
+    """
+    Reads a table a chunk of rows at a time.
+
+    :param filename: Path to a CSV or Parquet file.
+    :param chunksize: Maximum number of rows in each chunk.
+    :param columns: The columns to read, or None for all of them.
+    :return: A generator of DataFrames.
+    """
+    if not is_parquet(filename):
+        yield from pd.read_csv(filename, usecols=columns, chunksize=chunksize)
+        return
+    import pyarrow.parquet as pq
+    with pq.ParquetFile(filename) as infile:
+        for batch in infile.iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas()
+
+def write_table(df: pd.DataFrame, filename: str) -> None:
+    """
+    Writes a table to disk, without the index.
+
+    :param df: DataFrame to save.
+    :param filename: Path to save to, with a .csv or .parquet extension.
+    :return: None, writes to disk as a side-effect.
+    """
+    if is_parquet(filename):
+        df.to_parquet(filename, index=False)
+    else:
+        df.to_csv(filename, index=False)
+
+class TableWriter:
+    """
+    Writes a table to disk a chunk of rows at a time.
+
+    For Parquet each chunk becomes a row group, and is converted to the
+    column types of the first chunk so that the file has a single schema.
+
+    :param filename: Path to save to, with a .csv or .parquet extension.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.n_chunks = 0
+        self.writer = None
+
+    def write(self, df: pd.DataFrame) -> None:
+        """
+        Appends a chunk of rows to the table.
+
+        :param df: DataFrame with the same columns as every other chunk.
+        :return: None, writes to disk as a side-effect.
+        """
+        if not is_parquet(self.filename):
+            df.to_csv(self.filename, index=False, header=self.n_chunks == 0, mode="a" if self.n_chunks else "w")
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            if self.writer is None:
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                self.writer = pq.ParquetWriter(self.filename, table.schema)
+            else:
+                table = pa.Table.from_pandas(df, schema=self.writer.schema, preserve_index=False)
+            self.writer.write_table(table)
+        self.n_chunks += 1
+
+    def close(self) -> None:
+        """
+        Finishes writing the table.
+
+        :return: None.
+        """
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def read_trackmate(filename: str) -> pd.DataFrame:
+    """
+    Loads the IDs of every tracked cell from the TrackMate features.
+
+    Equivalent to cellphe.input.import_data(filename, "Trackmate_auto"), but
+    only the ID columns are read, which for a Parquet file means the other
+    columns aren't read from disk at all.
+
+    :param filename: Path to the TrackMate features as output by parse_xml.py,
+        either CSV or Parquet.
+    :return: A DataFrame with columns FrameID, CellID and ROI_filename, with 1
+        row per cell in each frame ordered by CellID and FrameID.
+    """
+    df = read_table(filename, columns=["FRAME", "TRACK_ID", "ROI_FILENAME"])
+    out = df[["FRAME", "TRACK_ID", "ROI_FILENAME"]]
+    out = out.rename(columns={"FRAME": "FrameID", "TRACK_ID": "CellID", "ROI_FILENAME": "ROI_filename"})
+    out["CellID"] = out["CellID"].astype(int)
+    out["FrameID"] = out["FrameID"].astype(int)
+    return out.sort_values(["CellID", "FrameID"])
@@ -0,0 +1,184 @@
+"""
+Segments large images in overlapping tiles, so that the memory used by the
+segmentation model is bounded by the tile size rather than the image size.
+
+Each tile is segmented independently and its labels are stitched into a
+single mask for the whole image. Every tile is responsible for a core
+region, which extends halfway into the overlap with each of its neighbours.
+A cell is kept from the tile whose core contains its centroid, unless it
+touches one of the tile's edges inside the image, in which case it's been
+cut off and the neighbouring tile will have the complete cell. The overlap
+should therefore be larger than the largest cell diameter. Used by
+segment_image_batch.py.
+"""
+from collections.abc import Callable
+import numpy as np
+
+def tile_starts(length: int, tile_size: int, overlap: int) -> list[int]:
+    """
+    Calculates the start positions of tiles along one axis.
+
+    The last tile is shifted back so that it ends at the edge of the image,
+    so every tile is the full tile_size unless the image is smaller.
+
+    :param length: Size of the image along this axis.
+    :param tile_size: Size of each tile.
+    :param overlap: Minimum overlap between neighbouring tiles.
+    :return: A list of the start position of each tile.
+    """
+    if length <= tile_size:
+        return [0]
+    stride = tile_size - overlap
+    starts = list(range(0, length - tile_size, stride))
+    starts.append(length - tile_size)
+    return starts
+
+def core_bounds(starts: list[int], length: int, tile_size: int) -> list[tuple[int, int]]:
+    """
+    Calculates the core region of each tile along one axis, which partition
+    the image between the midpoints of the overlaps.
+
+    :param starts: Start position of each tile, from tile_starts.
+    :param length: Size of the image along this axis.
+    :param tile_size: Size of each tile.
+    :return: A list of the start and end of each tile's core region.
+    """
+    bounds = [0]
+    for prev_start, start in zip(starts[:-1], starts[1:]):
+        bounds.append((start + min(prev_start + tile_size, length)) // 2)
+    bounds.append(length)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def filter_tile(
+    labels: np.ndarray,
+    offset: tuple[int, int],
+    core: tuple[tuple[int, int], tuple[int, int]],
+    image_shape: tuple[int, int],
+) -> np.ndarray:
+    """
+    Removes the cells from a segmented tile that another tile is responsible
+    for.
+
+    :param labels: 2D label image of the tile.
+    :param offset: The (row, column) of the tile's top-left corner in the
+        image.
+    :param core: The ((row start, row end), (column start, column end)) of the
+        tile's core region in the image.
+    :param image_shape: The (rows, columns) of the full image.
+    :return: A label image of the same shape as labels, with the cells this
+        tile isn't responsible for set to 0.
+    """
+    n_labels = int(labels.max()) + 1
+    flat = labels.ravel()
+    rows, cols = np.indices(labels.shape)
+    counts = np.bincount(flat, minlength=n_labels)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        centroid_row = np.bincount(flat, weights=rows.ravel(), minlength=n_labels) / counts + offset[0]
+        centroid_col = np.bincount(flat, weights=cols.ravel(), minlength=n_labels) / counts + offset[1]
+    keep = (
+        (counts > 0)
+        & (centroid_row >= core[0][0])
+        & (centroid_row < core[0][1])
+        & (centroid_col >= core[1][0])
+        & (centroid_col < core[1][1])
+    )
+    keep[0] = False
+
+    # Cells touching an edge that's inside the image have been cut off
+    if offset[0] > 0:
+        keep[labels[0, :]] = False
+    if offset[0] + labels.shape[0] < image_shape[0]:
+        keep[labels[-1, :]] = False
+    if offset[1] > 0:
+        keep[labels[:, 0]] = False
+    if offset[1] + labels.shape[1] < image_shape[1]:
+        keep[labels[:, -1]] = False
+    return np.where(keep[labels], labels, 0)
+
+def normalise_for_tiles(image: np.ndarray, eval_args: dict, nchan: int) -> tuple[np.ndarray, dict]:
+    """
+    Normalises an image for Cellpose as a whole, as Cellpose would if it were
+    segmented untiled. Otherwise CellposeModel.eval normalises each tile by
+    its own intensity percentiles, so the same cell is scaled differently
+    depending on what else is in its tile.
+
+    :param image: The image to segment.
+    :param eval_args: The arguments for CellposeModel.eval for the image.
+    :param nchan: The number of channels the model takes.
+    :return: A tuple of the image converted to rows, columns and channels and
+        normalised, and the arguments for CellposeModel.eval for its tiles,
+        which don't normalise them again.
+    """
+    from cellpose import transforms
+
+    image = transforms.convert_image(
+        image,
+        eval_args.get("channels"),
+        channel_axis=eval_args.get("channel_axis"),
+        z_axis=eval_args.get("z_axis"),
+        nchan=nchan,
+    )
+    normalize = eval_args.get("normalize", True)
+    if isinstance(normalize, dict):
+        normalize_params = normalize
+    else:
+        normalize_params = {"normalize": normalize, "invert": eval_args.get("invert", False)}
+    image = transforms.normalize_img(image, **normalize_params)
+    tile_args = {**eval_args, "channels": None, "channel_axis": 2, "normalize": False, "invert": False}
+    return image, tile_args
+
+def segment_tiled(
+    image: np.ndarray,
+    segment: Callable[[np.ndarray], np.ndarray],
+    tile_size: int,
+    overlap: int,
+) -> np.ndarray:
+    """
+    Segments an image in overlapping tiles.
+
+    :param image: The image to segment, with rows and columns as the first 2
+        dimensions.
+    :param segment: Function that segments an image, returning a 2D label
+        image with 0 as background. Any normalisation should already have
+        been applied to the whole image, see normalise_for_tiles.
+    :param tile_size: Size of each square tile in pixels.
+    :param overlap: Overlap between neighbouring tiles in pixels, which should
+        be larger than the largest cell diameter.
+    :return: A label image of the same size as the image, with cells numbered
+        from 1.
+    """
+    if overlap >= tile_size:
+        raise ValueError("The tile overlap must be smaller than the tile size")
+
+    height, width = image.shape[:2]
+    row_starts = tile_starts(height, tile_size, overlap)
+    col_starts = tile_starts(width, tile_size, overlap)
+    row_cores = core_bounds(row_starts, height, tile_size)
+    col_cores = core_bounds(col_starts, width, tile_size)
+    tiles = [
+        ((row_start, col_start), (min(tile_size, height), min(tile_size, width)), (row_core, col_core))
+        for row_start, row_core in zip(row_starts, row_cores)
+        for col_start, col_core in zip(col_starts, col_cores)
+    ]
+
+    mask = np.zeros((height, width), dtype=np.int32)
+    n_cells = 0
+    for offset, size, core in tiles:
+        tile_image = image[offset[0] : offset[0] + size[0], offset[1] : offset[1] + size[1]]
+        labels = filter_tile(np.asarray(segment(tile_image)).astype(np.int64), offset, core, (height, width))
+        region = mask[offset[0] : offset[0] + size[0], offset[1] : offset[1] + size[1]]
+        # Neighbouring tiles can disagree on the exact boundary of a cell
+        # so only fill in unassigned pixels, and discard any cell that
+        # mostly overlaps one that's already been placed
+        n_labels = int(labels.max()) + 1
+        counts = np.bincount(labels.ravel(), minlength=n_labels)
+        conflicts = np.bincount(labels[region > 0], minlength=n_labels)
+        keep = (counts > 0) & (conflicts * 2 < counts)
+        keep[0] = False
+        new_ids = np.zeros(n_labels, dtype=np.int32)
+        new_ids[keep] = np.arange(n_cells + 1, n_cells + 1 + keep.sum())
+        n_cells += int(keep.sum())
+        relabelled = new_ids[labels]
+        fill = (region == 0) & (relabelled > 0)
+        region[fill] = relabelled[fill]
+    return mask
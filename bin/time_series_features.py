@@ -1,16 +1,242 @@
 #!/usr/bin/env python
 from cellphe.features import time_series_features
-import pandas as pd
 import argparse
+import pandas as pd
+import numpy as np
+from parallel import parallel_map
+from profiling import Profile
+from tables import read_table
+
+# The largest fraction of the frame features that a shard can need before the
+# time-series features are calculated in a single process instead
+MAX_SHARD_FRACTION = 0.75
+
+def feature_validity(df: pd.DataFrame) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Finds which feature columns of each cell have any values, which
+    determines the cells whose values are used to interpolate its missing
+    values.
+
+    :param df: Frame features DataFrame with a CellID column.
+    :return: A tuple of the CellIDs in order, a boolean array of cells x
+        feature columns that's True where the cell has a value in the column,
+        and a boolean array that's True for the cells missing any values.
+    """
+    feature_cols = np.setdiff1d(df.columns.values, ["CellID", "FrameID", "x", "y", "ROI_filename"])
+    missing = df[feature_cols].isna()
+    valid = (~missing).groupby(df["CellID"]).any()
+    has_missing = missing.groupby(df["CellID"]).any().any(axis=1)
+    return valid.index.values, valid.values, has_missing.values
+
+def context_bounds(valid: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Finds the range of cells needed to calculate each cell's time-series
+    features, which extends back to the nearest earlier cell with a value in
+    each column and forward to the nearest later cell.
+
+    :param valid: Boolean array of cells x feature columns, as returned by
+        feature_validity.
+    :return: A tuple of the index of the first cell in each cell's range, and
+        the index after its last cell.
+    """
+    n_cells = valid.shape[0]
+    index = np.arange(n_cells)[:, None]
+    # The latest cell at or before each cell with a value, then shifted to be
+    # strictly before it, and the same for the next cell after it
+    last_valid = np.maximum.accumulate(np.where(valid, index, -1), axis=0)
+    before = np.vstack([np.full((1, valid.shape[1]), -1), last_valid[:-1]])
+    next_valid = np.minimum.accumulate(np.where(valid, index, n_cells)[::-1], axis=0)[::-1]
+    after = np.vstack([next_valid[1:], np.full((1, valid.shape[1]), n_cells)])
+    starts = np.where(before >= 0, before, index).min(axis=1, initial=n_cells)
+    ends = np.where(after < n_cells, after + 1, index + 1).max(axis=1, initial=0)
+    return np.minimum(starts, index[:, 0]), np.maximum(ends, index[:, 0] + 1)
+
+def shard_cells(df: pd.DataFrame, n_shards: int) -> list[tuple[np.ndarray, pd.DataFrame]]:
+    """
+    Splits the frame features into shards of complete cells, balanced by the
+    number of observations in each shard.
+
+    time_series_features linearly interpolates missing values over the whole
+    table ordered by CellID, so a cell's features can depend on the values of
+    its neighbouring cells. To give the same output as the single-process
+    path, each shard is a contiguous range of CellIDs, padded with the
+    neighbouring cells needed for interpolation. These context cells are
+    included in the shard's frame features but not its list of cells.
+
+    The padding is usually a few cells either side of each shard, but it has
+    no upper bound. In the worst case, such as a feature column that only has
+    values in the first and last cells, every shard is padded to the whole
+    table, so each process repeats the full calculation.
+
+    :param df: Frame features DataFrame with a CellID column.
+    :param n_shards: Maximum number of shards to create.
+    :return: A list of tuples of the CellIDs in each shard and the frame
+        features required to calculate them.
+    """
+    cell_ids, valid, _ = feature_validity(df)
+    context_starts, context_ends = context_bounds(valid)
+    n_shards = max(1, min(n_shards, cell_ids.size))
+
+    # Split at the cells where the cumulative number of observations crosses
+    # each multiple of the mean shard size
+    n_obs = df["CellID"].value_counts().reindex(cell_ids).values
+    cum_obs = np.cumsum(n_obs)
+    targets = cum_obs[-1] * np.arange(1, n_shards) / n_shards
+    bounds = np.unique(np.concatenate([[0], np.searchsorted(cum_obs, targets, side="right"), [cell_ids.size]]))
+
+    # The index of each cell in the order of cell_ids
+    cell_index = np.searchsorted(cell_ids, df["CellID"].values)
+    shards = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        context_start = context_starts[start:end].min()
+        context_end = context_ends[start:end].max()
+        rows = (cell_index >= context_start) & (cell_index < context_end)
+        shards.append((cell_ids[start:end], df.loc[rows]))
+    return shards
+
+def shard_time_series_features(shard: tuple[np.ndarray, pd.DataFrame]) -> pd.DataFrame:
+    """
+    Calculates the time-series features for a single shard.
+
+    :param shard: A tuple of the CellIDs in the shard and the frame features
+        required to calculate them, as output from shard_cells.
+    :return: A DataFrame with 1 row for each of the shard's cells.
+    """
+    cell_ids, df = shard
+    res = time_series_features(df)
+    return res.loc[res["CellID"].isin(cell_ids)]
+
+def sharded_time_series_features(df: pd.DataFrame, n_workers: int) -> pd.DataFrame:
+    """
+    Calculates the time-series features with the cells split across a pool of
+    processes.
+
+    :param df: Frame features DataFrame.
+    :param n_workers: Number of processes to use.
+    :return: A DataFrame with 1 row per cell, ordered by CellID, which is the
+        same as calling time_series_features on the full DataFrame.
+    """
+    shards = shard_cells(df, n_workers)
+    # When the interpolation context pads a shard to most of the table,
+    # splitting barely speeds it up but multiplies the memory used
+    if max(shard_df.shape[0] for _, shard_df in shards) > MAX_SHARD_FRACTION * df.shape[0]:
+        print("The cells depend on too much of the table to split them across processes")
+        return time_series_features(df)
+    results = parallel_map(shard_time_series_features, n_workers, shards)
+    return pd.concat(results).sort_values("CellID").reset_index(drop=True)
+
+def changed_cells(df: pd.DataFrame, previous: pd.DataFrame) -> np.ndarray:
+    """
+    Finds the cells whose frame features differ from a previous run, such as
+    those whose tracks have been extended into new frames.
+
+    :param df: Frame features DataFrame.
+    :param previous: Frame features DataFrame from the previous run.
+    :return: The CellIDs of the cells with any frame features added, removed
+        or changed, including cells that are only in one of the DataFrames.
+    """
+    compare_cols = np.setdiff1d(np.intersect1d(df.columns.values, previous.columns.values), ["CellID", "FrameID", "ROI_filename"])
+    merged = df.merge(previous, on=["CellID", "FrameID"], how="outer", suffixes=("", "_previous"), indicator=True)
+    same = (merged["_merge"] == "both").values
+    for col in compare_cols:
+        # Allow for the values having been through CSV
+        same &= np.isclose(merged[col].to_numpy(dtype=float), merged[f"{col}_previous"].to_numpy(dtype=float), rtol=1e-9, atol=0, equal_nan=True)
+    return np.unique(merged.loc[~same, "CellID"])
+
+def cells_to_recalculate(df: pd.DataFrame, changed: np.ndarray) -> np.ndarray:
+    """
+    Finds the cells whose time-series features could differ from a previous
+    run. These are the changed cells along with any cells with missing values
+    that are interpolated from a changed cell.
+
+    :param df: Frame features DataFrame.
+    :param changed: The CellIDs of the changed cells, as output from
+        changed_cells.
+    :return: The CellIDs to recalculate.
+    """
+    cell_ids, valid, has_missing = feature_validity(df)
+    starts, ends = context_bounds(valid)
+    # Compared by CellID rather than position, as changed cells can also have
+    # been removed
+    changed = np.sort(changed)
+    n_before = np.searchsorted(changed, cell_ids[starts], side="left")
+    n_to_end = np.searchsorted(changed, cell_ids[ends - 1], side="right")
+    dependent = has_missing & (n_to_end > n_before)
+    return cell_ids[np.isin(cell_ids, changed) | dependent]
+
+def context_rows(df: pd.DataFrame, cell_ids_subset: np.ndarray) -> pd.DataFrame:
+    """
+    Selects the frame features needed to calculate the time-series features
+    of a subset of cells, i.e. the cells themselves and the neighbouring
+    cells used for interpolation.
+
+    :param df: Frame features DataFrame.
+    :param cell_ids_subset: The CellIDs to calculate.
+    :return: The rows of df needed.
+    """
+    cell_ids, valid, _ = feature_validity(df)
+    starts, ends = context_bounds(valid)
+    selected = np.isin(cell_ids, cell_ids_subset)
+    # Mark the union of the selected cells' ranges
+    coverage = np.zeros(cell_ids.size + 1, dtype=int)
+    np.add.at(coverage, starts[selected], 1)
+    np.add.at(coverage, ends[selected], -1)
+    needed = np.cumsum(coverage[:-1]) > 0
+    cell_index = np.searchsorted(cell_ids, df["CellID"].values)
+    return df.loc[needed[cell_index]]
+
+def calculate(df: pd.DataFrame, n_workers: int) -> pd.DataFrame:
+    """
+    Calculates the time-series features, across a pool of processes if
+    requested.
+
+    :param df: Frame features DataFrame.
+    :param n_workers: Number of processes to use.
+    :return: A DataFrame with 1 row per cell, ordered by CellID.
+    """
+    if n_workers > 1 and df["CellID"].nunique() > 1:
+        return sharded_time_series_features(df, n_workers)
+    return time_series_features(df)
 
 parser = argparse.ArgumentParser(
                     description='Tracks a given image'
 )
-parser.add_argument('frame_file', help="Input frame features CSV file")
+parser.add_argument('frame_file', help="Input frame features CSV or Parquet file")
 parser.add_argument('time_series_file', help="Output time series features CSV")
+parser.add_argument('--workers', help="Number of processes to split the cells across", default=1, type=int)
+parser.add_argument('--previous', help="The time series features CSV from a previous run on the same timelapse. Only the cells whose features can differ from it are recalculated, requires --previous-frame-features")
+parser.add_argument('--previous-frame-features', help="The frame features CSV or Parquet file that --previous was calculated from")
+parser.add_argument('--profile', help="Path to save a JSON profile of the time and memory used")
 args = parser.parse_args()
+if (args.previous is None) != (args.previous_frame_features is None):
+    parser.error("--previous and --previous-frame-features must be used together")
 
-frame_features = pd.read_csv(args.frame_file)
-tsvariables = time_series_features(frame_features)
-tsvariables.to_csv(args.time_series_file, index=False)
+profile = Profile(args.profile, workers=args.workers)
+profile.add_inputs(args.frame_file, args.previous, args.previous_frame_features)
+profile.phase("read")
+frame_features = read_table(args.frame_file)
+profile.record(rows=frame_features.shape[0], cells=frame_features["CellID"].nunique())
+if args.previous is None:
+    profile.phase("features")
+    tsvariables = calculate(frame_features, args.workers)
+else:
+    previous_ts = pd.read_csv(args.previous, float_precision="round_trip")
+    previous_frames = read_table(args.previous_frame_features)
+
+    profile.phase("plan")
+    recalculate = cells_to_recalculate(frame_features, changed_cells(frame_features, previous_frames))
+    cell_ids = np.unique(frame_features["CellID"])
+    recalculate = np.union1d(recalculate, np.setdiff1d(cell_ids, previous_ts["CellID"]))
+    reused = previous_ts.loc[previous_ts["CellID"].isin(cell_ids) & ~previous_ts["CellID"].isin(recalculate)]
+    profile.record(recalculated_cells=recalculate.size)
+    print(f"Reusing the time series features of {reused.shape[0]} cells, calculating {recalculate.size} cells")
 
+    profile.phase("features")
+    tsvariables = reused
+    if recalculate.size > 0:
+        res = calculate(context_rows(frame_features, recalculate), args.workers)
+        res = res.loc[res["CellID"].isin(recalculate)]
+        tsvariables = pd.concat([reused, res]).sort_values("CellID").reset_index(drop=True)
+profile.phase("write")
+tsvariables.to_csv(args.time_series_file, index=False)
+profile.save()
@@ -2,8 +2,10 @@
 import argparse
 import json
 import sys
+import numpy as np
 import scyjava as sj
 import imagej
+from profiling import Profile
 
 def setup_imagej(max_heap: int | None = None) -> None:
     """
@@ -21,11 +23,14 @@ def setup_imagej(max_heap: int | None = None) -> None:
     imagej.init(["net.imagej:imagej", "sc.fiji:TrackMate:7.13.2"], add_legacy=False)
 
 
-def read_image_stack(image_dir: str):
+def read_image_stack(image_dir: str, virtual: bool = False):
     """
     Reads a directory containing TIFs into ImageJ as a stack.
 
     :param dir: Directory where the TIFs are located.
+    :param virtual: Whether to open the images as a virtual stack, where each
+        image is only read from disk when it is accessed, rather than loading
+        them all into memory up front.
     :return: An ImagePlus instance containing an ImageStack.
     """
     # pylint doesn't like the camel case naming. I think it helps readability as
@@ -33,7 +38,7 @@ def read_image_stack(image_dir: str):
     # pylint: disable=invalid-name
     FolderOpener = sj.jimport("ij.plugin.FolderOpener")
     # Load all images as framestack
-    imp = FolderOpener.open(image_dir, "")
+    imp = FolderOpener.open(image_dir, "virtual" if virtual else "")
 
     # When reading in the imagestack, the the number of frames is often
     # (always?) interpreted as the number of channels. This corrects that in the
@@ -57,6 +62,107 @@ def read_image_stack(image_dir: str):
     return imp
 
 
+def peak_heap_usage() -> float:
+    """
+    Measures the peak JVM heap usage so far.
+
+    This is the sum of the peak usage of each heap memory pool, so is an upper
+    bound as the pools may have peaked at different times.
+
+    :return: The peak heap usage in GB.
+    """
+    # pylint: disable=invalid-name
+    ManagementFactory = sj.jimport("java.lang.management.ManagementFactory")
+    MemoryType = sj.jimport("java.lang.management.MemoryType")
+    peak = 0
+    for pool in ManagementFactory.getMemoryPoolMXBeans():
+        if pool.getType() == MemoryType.HEAP:
+            peak += pool.getPeakUsage().getUsed()
+    return peak / 1e9
+
+
+def export_model(model, path: str) -> None:
+    """
+    Saves the Spots, their ROIs, and the Edges of a TrackMate model in a
+    columnar binary format, as an alternative to the TrackMate XML.
+
+    The output is an uncompressed numpy .npz archive containing:
+        - spot_LABEL: the name of every Spot
+        - spot_<FEATURE>: 1 array for each Spot feature, int64 for the
+            features TrackMate declares as integers and float64 otherwise,
+            with NaN where a Spot doesn't have the feature
+        - roi_coords: 2D array of every ROI's (x,y) coordinates relative to its
+            Spot's position, concatenated in the same order as the Spots
+        - roi_lengths: the number of coordinates in each Spot's ROI
+        - edge_sources and edge_targets: the Spot IDs at either end of every
+            Edge
+    The Spots are in the same order as they would be in the XML, so
+    parse_xml.py gives the same output from either.
+
+    Each feature is fetched for every Spot in a single call, which fills a
+    Java array that is copied straight into numpy, as calling into Java for
+    every feature of every Spot is slow for large models. Only the ID, name,
+    and ROI of each Spot are fetched individually.
+
+    :param model: An instance of the Java class fiji.plugin.trackmate.Model.
+    :param path: Where to save the .npz file.
+    :return: None, writes the file as a side-effect.
+    """
+    # pylint: disable=invalid-name
+    FeatureUtils = sj.jimport("fiji.plugin.trackmate.features.FeatureUtils")
+    TrackMateObject = sj.jimport("fiji.plugin.trackmate.gui.displaysettings.DisplaySettings$TrackMateObject")
+    spots = model.getSpots()
+    n_spots = spots.getNSpots(False)
+    feature_keys = [str(key) for key in model.getFeatureModel().getSpotFeatures()]
+    is_int = model.getFeatureModel().getSpotFeatureIsInt()
+    features = {}
+    for key in feature_keys:
+        # Iterates over the Spots in the same frame order as below, with NaN
+        # for Spots without the feature
+        values = np.array(FeatureUtils.collectFeatureValues(key, TrackMateObject.SPOTS, model, False), dtype="float64")
+        # TmXmlWriter truncates integer features to ints, so they're written
+        # as e.g. 1 rather than 1.0
+        if bool(is_int.get(key)) and not np.isnan(values).any():
+            values = values.astype("int64")
+        features[key] = values
+    ids = np.zeros(n_spots, dtype="int64")
+    labels = []
+    rois = []
+    roi_lengths = np.zeros(n_spots, dtype="int64")
+
+    i = 0
+    for frame in spots.keySet():
+        for spot in spots.iterable(frame, False):
+            ids[i] = spot.ID()
+            labels.append(str(spot.getName()))
+            roi = spot.getRoi()
+            if roi is not None:
+                coords = np.stack([np.asarray(roi.x, dtype="float64"), np.asarray(roi.y, dtype="float64")], axis=1)
+                rois.append(coords)
+                roi_lengths[i] = coords.shape[0]
+            i += 1
+
+    sources = []
+    targets = []
+    track_model = model.getTrackModel()
+    for track_id in track_model.trackIDs(False):
+        for edge in track_model.trackEdges(track_id):
+            sources.append(track_model.getEdgeSource(edge).ID())
+            targets.append(track_model.getEdgeTarget(edge).ID())
+
+    columns = {f"spot_{key}": values for key, values in features.items()}
+    columns["spot_ID"] = ids
+    columns["spot_LABEL"] = np.array(labels, dtype=str)
+    np.savez(
+        path,
+        roi_coords=np.concatenate(rois) if len(rois) > 0 else np.zeros((0, 2)),
+        roi_lengths=roi_lengths,
+        edge_sources=np.array(sources, dtype="int64"),
+        edge_targets=np.array(targets, dtype="int64"),
+        **columns,
+    )
+
+
 def load_detector(settings) -> None:
     """
     Loads a TrackMate detector.
@@ -128,8 +234,13 @@ parser = argparse.ArgumentParser(
 parser.add_argument('mask_dir', help="Path to the folder containing the masks")
 parser.add_argument('memory', help="Requested memory")
 parser.add_argument('config', help="TrackMate configuration settings")
-parser.add_argument('xml_path', help="Where to save the XML to")
+parser.add_argument('output_path', help="Where to save the tracking results, either as TrackMate XML (.xml) or in a columnar binary format (.npz) that parse_xml.py can read without parsing text")
+parser.add_argument('--xml-path', help="Additionally save the TrackMate XML here")
+parser.add_argument('--virtual', action='store_true', help="Read the masks lazily as TrackMate needs them, rather than loading them all into memory")
+parser.add_argument('--profile', help="Path to save a JSON profile of the time and memory used")
 args = parser.parse_args()
+profile = Profile(args.profile)
+profile.add_inputs(args.mask_dir)
 
 # Comes through as 'X GB' from Nextflow, obtain the number
 try:
@@ -142,9 +253,11 @@ tracker = config['algorithm']
 tracker_settings = config['settings']
 
 try:
+    profile.phase("setup")
     setup_imagej(requested_memory)
 
-    imp = read_image_stack(mask_dir)
+    profile.phase("read")
+    imp = read_image_stack(mask_dir, args.virtual)
     settings = sj.jimport("fiji.plugin.trackmate.Settings")(imp)
     load_detector(settings)
     load_tracker(settings, tracker, tracker_settings)
@@ -186,19 +299,37 @@ try:
     print("Checked input")
 
     # Run the full detection + tracking process
+    profile.phase("track")
     if not trackmate.process():
         print("process error")
         sys.exit(str(trackmate.getErrorMessage()))
     print("Processed")
+    profile.record(
+        frames=imp.getStackSize(),
+        spots=model.getSpots().getNSpots(True),
+        edges=model.getTrackModel().edgeSet().size(),
+    )
 
     # Export to and extract the Spots, Tracks, and ROIs
-    file_cls = sj.jimport("java.io.File")
-    writer_cls = sj.jimport("fiji.plugin.trackmate.io.TmXmlWriter")
-    writer = writer_cls(file_cls(args.xml_path))
-    writer.appendSettings(settings)
-    writer.appendModel(model)
-    writer.writeToFile()
-    print("Written to XML")
+    profile.phase("write")
+    xml_paths = [] if args.xml_path is None else [args.xml_path]
+    if args.output_path.endswith(".npz"):
+        export_model(model, args.output_path)
+        print("Written to npz")
+    else:
+        xml_paths.append(args.output_path)
+    for xml_path in xml_paths:
+        file_cls = sj.jimport("java.io.File")
+        writer_cls = sj.jimport("fiji.plugin.trackmate.io.TmXmlWriter")
+        writer = writer_cls(file_cls(xml_path))
+        writer.appendSettings(settings)
+        writer.appendModel(model)
+        writer.writeToFile()
+        print("Written to XML")
+    peak_heap = peak_heap_usage()
+    print(f"Peak JVM heap usage: {peak_heap:.2f} GB")
+    profile.record(peak_heap_mb=peak_heap * 1000)
+    profile.save()
 
 except Exception as e:
     print(f"Error: {e}")
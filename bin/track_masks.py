@@ -0,0 +1,590 @@
+#!/usr/bin/env python
+import argparse
+import json
+import os
+import re
+import numpy as np
+from PIL import Image
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+from scipy.spatial import ConvexHull, QhullError, cKDTree
+from skimage.measure import approximate_polygon, find_contours, regionprops_table
+from parallel import parallel_map
+from profiling import Profile
+
+# Spot features in the order they're saved, matching TrackMate's own
+SPOT_FEATURES = [
+    "QUALITY",
+    "POSITION_X",
+    "POSITION_Y",
+    "POSITION_Z",
+    "POSITION_T",
+    "FRAME",
+    "RADIUS",
+    "VISIBILITY",
+    "MEAN_INTENSITY_CH1",
+    "MEDIAN_INTENSITY_CH1",
+    "MIN_INTENSITY_CH1",
+    "MAX_INTENSITY_CH1",
+    "TOTAL_INTENSITY_CH1",
+    "STD_INTENSITY_CH1",
+    "CONTRAST_CH1",
+    "SNR_CH1",
+    "AREA",
+    "PERIMETER",
+    "CIRCULARITY",
+    "SOLIDITY",
+    "SHAPE_INDEX",
+]
+# The Spot features that TrackMate declares as integers, which are saved as
+# int64 so they're written out as integers as in the XML
+INT_SPOT_FEATURES = ["FRAME", "VISIBILITY"]
+
+# TrackMate's default settings for the LAP trackers
+DEFAULT_SETTINGS = {
+    "LINKING_MAX_DISTANCE": 15.0,
+    "LINKING_FEATURE_PENALTIES": {},
+    "ALLOW_GAP_CLOSING": True,
+    "MAX_FRAME_GAP": 2,
+    "GAP_CLOSING_MAX_DISTANCE": 15.0,
+    "GAP_CLOSING_FEATURE_PENALTIES": {},
+    "ALLOW_TRACK_MERGING": False,
+    "MERGING_MAX_DISTANCE": 15.0,
+    "MERGING_FEATURE_PENALTIES": {},
+    "ALLOW_TRACK_SPLITTING": False,
+    "SPLITTING_MAX_DISTANCE": 15.0,
+    "SPLITTING_FEATURE_PENALTIES": {},
+    "ALTERNATIVE_LINKING_COST_FACTOR": 1.05,
+    "CUTOFF_PERCENTILE": 0.9,
+}
+
+def list_mask_files(mask_dir: str) -> list[str]:
+    """
+    Lists the masks in a folder in frame order.
+
+    Filenames are sorted with any numbers compared numerically, in the same way
+    as ImageJ's FolderOpener, so each mask's position in the list is its frame.
+
+    :param mask_dir: Folder containing the masks.
+    :return: A list of paths.
+    """
+    def natural_key(fn):
+        return [int(x) if x.isdigit() else x for x in re.split(r"([0-9]+)", fn)]
+    fns = sorted((fn for fn in os.listdir(mask_dir) if not fn.startswith(".")), key=natural_key)
+    return [os.path.join(mask_dir, fn) for fn in fns]
+
+def trace_outline(image: np.ndarray) -> np.ndarray:
+    """
+    Traces the outer contour of a label.
+
+    :param image: Boolean image of the label within its bounding box.
+    :return: 2D array of the contour's (row, col) vertices relative to the
+        bounding box, which has fewer than 3 rows if the label has no outline.
+    """
+    # Padded so that contours are closed around labels touching the edge
+    contours = find_contours(np.pad(image, 1).astype(np.uint8), 0.5)
+    if len(contours) == 0:
+        return np.zeros((0, 2))
+    return approximate_polygon(max(contours, key=len), tolerance=0.5)[:-1] - 1
+
+def polygon_features(coords: np.ndarray, starts: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Calculates the centroid, area, and perimeter of many polygons at once.
+
+    :param coords: 2D array of the (x,y) vertices of every polygon, one after
+        another.
+    :param starts: Index in coords of each polygon's first vertex.
+    :return: A tuple of arrays of each polygon's centroid x and y, area, and
+        perimeter.
+    """
+    # Each vertex's next one, wrapping around to the start of its polygon
+    following = np.arange(1, coords.shape[0] + 1)
+    following[np.append(starts[1:], coords.shape[0]) - 1] = starts
+    x = coords[:, 0]
+    y = coords[:, 1]
+    x_next = x[following]
+    y_next = y[following]
+    cross = x * y_next - x_next * y
+    signed_area = np.add.reduceat(cross, starts) / 2
+    lengths = np.diff(np.append(starts, coords.shape[0]))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        centroid_x = np.add.reduceat((x + x_next) * cross, starts) / (6 * signed_area)
+        centroid_y = np.add.reduceat((y + y_next) * cross, starts) / (6 * signed_area)
+    degenerate = signed_area == 0
+    centroid_x[degenerate] = (np.add.reduceat(x, starts) / lengths)[degenerate]
+    centroid_y[degenerate] = (np.add.reduceat(y, starts) / lengths)[degenerate]
+    perimeter = np.add.reduceat(np.sqrt((x_next - x) ** 2 + (y_next - y) ** 2), starts)
+    return centroid_x, centroid_y, np.abs(signed_area), perimeter
+
+def hull_area(coords: np.ndarray) -> float:
+    """
+    Calculates the area of a polygon's convex hull.
+
+    :param coords: 2D array of the polygon's (x,y) vertices.
+    :return: The area, or 0 if the polygon is degenerate.
+    """
+    try:
+        return ConvexHull(coords).volume
+    except QhullError:
+        # Degenerate polygons, e.g. all points on a line
+        return 0.0
+
+def surrounding_means(
+    mask: np.ndarray,
+    labels: np.ndarray,
+    centre_x: np.ndarray,
+    centre_y: np.ndarray,
+    radius: np.ndarray,
+) -> np.ndarray:
+    """
+    Calculates the mean intensity around each Spot, over the pixels within
+    twice its radius of its centre that aren't part of it, as in TrackMate's
+    SpotContrastAndSNRAnalyzer.
+
+    :param mask: The labelled mask, which is also the intensity image.
+    :param labels: The label of each Spot.
+    :param centre_x: The x position of each Spot.
+    :param centre_y: The y position of each Spot.
+    :param radius: The radius of each Spot.
+    :return: The mean of each Spot's surroundings, which is NaN if there are
+        no pixels around it.
+    """
+    outer = 2 * radius
+    min_x = np.maximum(np.ceil(centre_x - outer), 0).astype(int)
+    min_y = np.maximum(np.ceil(centre_y - outer), 0).astype(int)
+    widths = np.maximum(np.minimum(np.floor(centre_x + outer), mask.shape[1] - 1).astype(int) - min_x + 1, 0)
+    heights = np.maximum(np.minimum(np.floor(centre_y + outer), mask.shape[0] - 1).astype(int) - min_y + 1, 0)
+    # Every pixel in each Spot's bounding square, labelled by its Spot
+    n_pixels = widths * heights
+    spots = np.repeat(np.arange(labels.size), n_pixels)
+    offsets = np.arange(n_pixels.sum()) - np.repeat(np.cumsum(n_pixels) - n_pixels, n_pixels)
+    x = min_x[spots] + offsets % widths[spots]
+    y = min_y[spots] + offsets // widths[spots]
+    values = mask[y, x]
+    around = ((x - centre_x[spots]) ** 2 + (y - centre_y[spots]) ** 2 <= outer[spots] ** 2) & (values != labels[spots])
+    sums = np.bincount(spots[around], weights=values[around], minlength=labels.size)
+    counts = np.bincount(spots[around], minlength=labels.size)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return sums / counts
+
+def detect_spots(mask_fn: str, frame: int) -> tuple[dict, list[np.ndarray]]:
+    """
+    Creates a Spot for every label in a mask, in the same way as TrackMate's
+    LabelImageDetector.
+
+    Each Spot's ROI is its label's outer contour, and its position is the
+    centroid of that polygon. The intensity features are calculated from the
+    mask itself, as that's the image TrackMate runs on in this pipeline. As
+    every Spot has a uniform intensity, its SNR_CH1 is infinite as in
+    TrackMate.
+
+    :param mask_fn: Path to the mask.
+    :param frame: The frame index of the mask, starting at 0.
+    :return: A tuple of a dict of Spot feature arrays, and a list of each
+        Spot's ROI coordinates relative to its position.
+    """
+    mask = np.array(Image.open(mask_fn))
+    if mask.ndim > 2:
+        mask = mask[..., 0]
+    # Every label's bounding box, number of pixels, and image in one pass
+    props = regionprops_table(mask, properties=("label", "bbox", "area", "image"))
+    outlines = [trace_outline(image) for image in props["image"]]
+    has_outline = np.array([outline.shape[0] >= 3 for outline in outlines], dtype=bool)
+    labels = props["label"][has_outline]
+    n_pixels = props["area"][has_outline].astype("float64")
+    # (row, col) -> (x, y) in the full image
+    polygons = [
+        outline[:, ::-1] + [min_col, min_row]
+        for outline, min_row, min_col, keep in zip(outlines, props["bbox-0"], props["bbox-1"], has_outline)
+        if keep
+    ]
+    if len(polygons) > 0:
+        starts = np.cumsum([0] + [polygon.shape[0] for polygon in polygons[:-1]])
+        centroid_x, centroid_y, area, perimeter = polygon_features(np.concatenate(polygons), starts)
+    else:
+        centroid_x = centroid_y = area = perimeter = np.zeros(0)
+    keep = area > 0
+    labels = labels[keep]
+    n_pixels = n_pixels[keep]
+    centroid_x = centroid_x[keep]
+    centroid_y = centroid_y[keep]
+    area = area[keep]
+    perimeter = perimeter[keep]
+    polygons = [polygon for polygon, kept in zip(polygons, keep) if kept]
+    hull_areas = np.array([hull_area(polygon) for polygon in polygons], dtype="float64")
+    hull_areas[hull_areas == 0] = area[hull_areas == 0]
+
+    radius = np.sqrt(area / np.pi)
+    intensity = labels.astype("float64")
+    background = surrounding_means(mask, labels, centroid_x, centroid_y, radius)
+    features = {
+        "QUALITY": n_pixels,
+        "POSITION_X": centroid_x,
+        "POSITION_Y": centroid_y,
+        "POSITION_Z": np.zeros(labels.size),
+        "POSITION_T": np.full(labels.size, float(frame)),
+        "FRAME": np.full(labels.size, float(frame)),
+        "RADIUS": radius,
+        "VISIBILITY": np.ones(labels.size),
+        "MEAN_INTENSITY_CH1": intensity,
+        "MEDIAN_INTENSITY_CH1": intensity,
+        "MIN_INTENSITY_CH1": intensity,
+        "MAX_INTENSITY_CH1": intensity,
+        "TOTAL_INTENSITY_CH1": intensity * n_pixels,
+        "STD_INTENSITY_CH1": np.zeros(labels.size),
+        "AREA": area,
+        "PERIMETER": perimeter,
+        "CIRCULARITY": 4 * np.pi * area / perimeter**2,
+        "SOLIDITY": area / hull_areas,
+        "SHAPE_INDEX": perimeter / np.sqrt(area),
+    }
+    with np.errstate(invalid="ignore", divide="ignore"):
+        features["CONTRAST_CH1"] = (intensity - background) / (intensity + background)
+        features["SNR_CH1"] = (intensity - background) / features["STD_INTENSITY_CH1"]
+    rois = [polygon - [x, y] for polygon, x, y in zip(polygons, centroid_x, centroid_y)]
+    return {key: features[key] for key in SPOT_FEATURES}, rois
+
+def link_costs(
+    features: dict,
+    sources: np.ndarray,
+    targets: np.ndarray,
+    max_distance: float,
+    penalties: dict,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Finds the candidate links between 2 sets of Spots and their costs.
+
+    The cost is the squared distance, multiplied by (1 + p)^2 where p is the
+    sum of the feature penalties, as in TrackMate. Links whose cost is greater
+    than the squared maximum distance are removed.
+
+    :param features: Dict of Spot feature arrays.
+    :param sources: Indices of the Spots that links can start from.
+    :param targets: Indices of the Spots that links can end at.
+    :param max_distance: Maximum distance of a link.
+    :param penalties: Dict of feature name to penalty weight.
+    :return: A tuple of the positions in sources and targets of each candidate
+        link, and their costs.
+    """
+    if sources.size == 0 or targets.size == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0)
+    source_xy = np.stack([features["POSITION_X"][sources], features["POSITION_Y"][sources]], axis=1)
+    target_xy = np.stack([features["POSITION_X"][targets], features["POSITION_Y"][targets]], axis=1)
+    pairs = cKDTree(source_xy).sparse_distance_matrix(cKDTree(target_xy), max_distance, output_type="ndarray")
+    rows = pairs["i"].astype(int)
+    cols = pairs["j"].astype(int)
+    costs = pairs["v"] ** 2
+
+    penalty = np.zeros(rows.size)
+    for key, weight in penalties.items():
+        if key not in features:
+            raise ValueError(f"Unknown feature penalty {key}, must be one of {','.join(SPOT_FEATURES)}")
+        source_vals = features[key][sources[rows]]
+        target_vals = features[key][targets[cols]]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            diff = 3 * weight * np.abs(source_vals - target_vals) / (source_vals + target_vals)
+        penalty += np.nan_to_num(diff, nan=0.0)
+    costs = costs * (1 + penalty) ** 2
+
+    keep = costs <= max_distance**2
+    return rows[keep], cols[keep], costs[keep]
+
+def solve_lap(
+    rows: np.ndarray,
+    cols: np.ndarray,
+    costs: np.ndarray,
+    n_rows: int,
+    n_cols: int,
+    alternative_cost: float,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Solves a sparse linear assignment problem where every row and column can
+    also be left unassigned.
+
+    This uses the block formulation from Jaqaman et al. 2008. The cost matrix
+    is augmented with a diagonal block of alternative costs for leaving each
+    row unassigned, another for each column, and the transpose of the
+    candidate links to keep the problem square.
+
+    :param rows: Row index of each candidate link.
+    :param cols: Column index of each candidate link.
+    :param costs: Cost of each candidate link.
+    :param n_rows: Number of rows.
+    :param n_cols: Number of columns.
+    :param alternative_cost: Cost of leaving a row or column unassigned.
+    :return: A tuple of the row and column indices of the selected links.
+    """
+    if rows.size == 0:
+        return rows, cols
+    n = n_rows + n_cols
+    # Every perfect matching has n entries, so shifting all costs by a
+    # constant doesn't change the solution but stops any being 0, which would
+    # be treated as a missing entry
+    shift = 1.0
+    row_ind = np.concatenate([rows, np.arange(n_rows), n_rows + np.arange(n_cols), n_rows + cols])
+    col_ind = np.concatenate([cols, n_cols + np.arange(n_rows), np.arange(n_cols), n_cols + rows])
+    data = np.concatenate([
+        costs,
+        np.full(n_rows, alternative_cost),
+        np.full(n_cols, alternative_cost),
+        np.full(rows.size, costs.min()),
+    ]) + shift
+    matrix = csr_matrix((data, (row_ind, col_ind)), shape=(n, n))
+    matched_rows, matched_cols = min_weight_full_bipartite_matching(matrix)
+    is_link = (matched_rows < n_rows) & (matched_cols < n_cols)
+    return matched_rows[is_link], matched_cols[is_link]
+
+def link_frames(features: dict, settings: dict, first_frame: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Links Spots between consecutive frames.
+
+    :param features: Dict of Spot feature arrays.
+    :param settings: Tracker settings.
+    :param first_frame: Only create links into this frame and later ones, as
+        the earlier frames have already been tracked.
+    :return: A tuple of the source and target Spot indices of every link.
+    """
+    frames = features["FRAME"].astype(int)
+    order = np.argsort(frames, kind="stable")
+    frame_ids, frame_starts = np.unique(frames[order], return_index=True)
+    frame_spots = np.split(order, frame_starts[1:])
+    sources = []
+    targets = []
+    for i in range(len(frame_ids) - 1):
+        if frame_ids[i + 1] != frame_ids[i] + 1 or frame_ids[i + 1] < first_frame:
+            continue
+        rows, cols, costs = link_costs(
+            features,
+            frame_spots[i],
+            frame_spots[i + 1],
+            settings["LINKING_MAX_DISTANCE"],
+            settings["LINKING_FEATURE_PENALTIES"],
+        )
+        if costs.size == 0:
+            continue
+        alternative_cost = settings["ALTERNATIVE_LINKING_COST_FACTOR"] * costs.max()
+        rows, cols = solve_lap(rows, cols, costs, frame_spots[i].size, frame_spots[i + 1].size, alternative_cost)
+        sources.append(frame_spots[i][rows])
+        targets.append(frame_spots[i + 1][cols])
+    if len(sources) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    return np.concatenate(sources), np.concatenate(targets)
+
+def link_segments(
+    features: dict,
+    link_sources: np.ndarray,
+    link_targets: np.ndarray,
+    settings: dict,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Joins the track segments from frame to frame linking by gap closing,
+    merging, and splitting.
+
+    :param features: Dict of Spot feature arrays.
+    :param link_sources: Source Spot index of every frame to frame link.
+    :param link_targets: Target Spot index of every frame to frame link.
+    :param settings: Tracker settings.
+    :return: A tuple of the source and target Spot indices of every new link.
+    """
+    n_spots = features["FRAME"].size
+    frames = features["FRAME"].astype(int)
+    has_prev = np.zeros(n_spots, dtype=bool)
+    has_prev[link_targets] = True
+    has_next = np.zeros(n_spots, dtype=bool)
+    has_next[link_sources] = True
+    # Segment ends can link forward and segment starts can be linked to. Spots
+    # in the middle of a segment can be merged into or split from
+    ends = np.flatnonzero(~has_next)
+    starts = np.flatnonzero(~has_prev)
+    middles = np.flatnonzero(has_prev & has_next)
+
+    # Each block is (row spots, column spots, rows, cols, costs)
+    blocks = []
+    if settings["ALLOW_GAP_CLOSING"]:
+        rows, cols, costs = link_costs(
+            features,
+            ends,
+            starts,
+            settings["GAP_CLOSING_MAX_DISTANCE"],
+            settings["GAP_CLOSING_FEATURE_PENALTIES"],
+        )
+        gap = frames[starts[cols]] - frames[ends[rows]]
+        keep = (gap >= 1) & (gap <= settings["MAX_FRAME_GAP"])
+        blocks.append((ends[rows[keep]], starts[cols[keep]], costs[keep]))
+    if settings["ALLOW_TRACK_MERGING"]:
+        rows, cols, costs = link_costs(
+            features,
+            ends,
+            middles,
+            settings["MERGING_MAX_DISTANCE"],
+            settings["MERGING_FEATURE_PENALTIES"],
+        )
+        keep = frames[middles[cols]] - frames[ends[rows]] == 1
+        blocks.append((ends[rows[keep]], middles[cols[keep]], costs[keep]))
+    if settings["ALLOW_TRACK_SPLITTING"]:
+        rows, cols, costs = link_costs(
+            features,
+            middles,
+            starts,
+            settings["SPLITTING_MAX_DISTANCE"],
+            settings["SPLITTING_FEATURE_PENALTIES"],
+        )
+        keep = frames[starts[cols]] - frames[middles[rows]] == 1
+        blocks.append((middles[rows[keep]], starts[cols[keep]], costs[keep]))
+    if len(blocks) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+
+    sources = np.concatenate([block[0] for block in blocks])
+    targets = np.concatenate([block[1] for block in blocks])
+    costs = np.concatenate([block[2] for block in blocks])
+    if costs.size == 0:
+        return sources, targets
+    # Only the Spots with a candidate link need to be part of the problem.
+    # A Spot can be both a segment's start and end, so rows and columns are
+    # indexed separately
+    row_spots, rows = np.unique(sources, return_inverse=True)
+    col_spots, cols = np.unique(targets, return_inverse=True)
+    alternative_cost = settings["ALTERNATIVE_LINKING_COST_FACTOR"] * np.percentile(
+        costs, 100 * settings["CUTOFF_PERCENTILE"]
+    )
+    rows, cols = solve_lap(rows, cols, costs, row_spots.size, col_spots.size, alternative_cost)
+    return row_spots[rows], col_spots[cols]
+
+def track(
+    features: dict,
+    algorithm: str,
+    settings: dict,
+    previous_links: tuple[np.ndarray, np.ndarray] | None = None,
+    first_frame: int = 0,
+) -> tuple[np.ndarray, np.ndarray, int]:
+    """
+    Tracks Spots using one of TrackMate's LAP trackers.
+
+    This follows the same two-step approach from Jaqaman et al. 2008 as
+    TrackMate. Spots are first linked between consecutive frames, and the
+    resulting track segments are then joined by gap closing, merging, and
+    splitting. Both steps are solved as sparse linear assignment problems,
+    with candidate links found with a KD-tree.
+
+    Frames appended to an already tracked timelapse can be tracked by
+    passing the existing frame to frame links, which are the same as
+    linking every frame again as each pair of frames is solved on its own.
+    Only the new frames are linked. The segments are then joined across the
+    whole timelapse, as a single problem over every segment, because new
+    frames can change the solution in earlier frames. For example, the end
+    of a segment in the last tracked frame can become the middle of one that
+    another segment merges into. This gives the same tracks as tracking the
+    whole timelapse at once.
+
+    :param features: Dict of Spot feature arrays.
+    :param algorithm: Either SparseLAP or SimpleSparseLAP. SimpleSparseLAP
+        doesn't use feature penalties, merging, or splitting.
+    :param settings: Tracker settings, using TrackMate's names. Any that
+        aren't provided take TrackMate's defaults.
+    :param previous_links: A tuple of the source and target Spot indices of
+        the frame to frame links between the Spots in the frames before
+        first_frame.
+    :param first_frame: The first frame that hasn't been tracked.
+    :return: A tuple of the source and target Spot indices of every link,
+        starting with the frame to frame links including the previous links,
+        and the number of frame to frame links.
+    """
+    if algorithm not in ("SparseLAP", "SimpleSparseLAP"):
+        raise ValueError(f"The python tracking engine supports the SparseLAP and SimpleSparseLAP algorithms, not {algorithm}")
+    settings = {**DEFAULT_SETTINGS, **(settings or {})}
+    if algorithm == "SimpleSparseLAP":
+        settings.update({
+            "LINKING_FEATURE_PENALTIES": {},
+            "GAP_CLOSING_FEATURE_PENALTIES": {},
+            "ALLOW_TRACK_MERGING": False,
+            "ALLOW_TRACK_SPLITTING": False,
+        })
+
+    if previous_links is None:
+        previous_links = (np.zeros(0, dtype=int), np.zeros(0, dtype=int))
+    link_sources, link_targets = link_frames(features, settings, first_frame)
+    link_sources = np.concatenate([previous_links[0], link_sources])
+    link_targets = np.concatenate([previous_links[1], link_targets])
+    segment_sources, segment_targets = link_segments(features, link_sources, link_targets, settings)
+    return np.concatenate([link_sources, segment_sources]), np.concatenate([link_targets, segment_targets]), link_sources.size
+
+def read_previous(npz_path: str) -> tuple[dict, list[np.ndarray], np.ndarray, np.ndarray, int]:
+    """
+    Reads the tracking results of an earlier run, to extend them into frames
+    that have been added since.
+
+    :param npz_path: Path to the .npz file saved by this script.
+    :return: A tuple of the dict of Spot feature arrays, the list of each
+        Spot's ROI coordinates relative to its position, the source and target
+        Spot indices of every frame to frame link, and the number of frames
+        that were tracked.
+    """
+    with np.load(npz_path) as npz:
+        features = {key: npz[f"spot_{key}"] for key in SPOT_FEATURES}
+        rois = np.split(npz["roi_coords"], np.cumsum(npz["roi_lengths"])[:-1]) if npz["roi_lengths"].size > 0 else []
+        # The Spot IDs are their indices, and the frame to frame links come
+        # before the links that join segments, which are linked again
+        n_links = int(npz["n_frame_links"])
+        return features, rois, npz["edge_sources"][:n_links], npz["edge_targets"][:n_links], int(npz["n_frames"])
+
+parser = argparse.ArgumentParser(
+                    description='Tracks cells from labelled masks using a Python implementation of the TrackMate LAP trackers'
+)
+parser.add_argument('mask_dir', help="Path to the folder containing the masks")
+parser.add_argument('config', help="Tracking configuration settings")
+parser.add_argument('output_path', help="Where to save the tracking results as a .npz file, in the same format as track_images.py")
+parser.add_argument('--workers', help="Number of processes to detect Spots with", default=1, type=int)
+parser.add_argument('--previous', help="Tracking results of an earlier run on the first frames of this timelapse. Only the masks of the frames added since are read and linked, then the segments are joined again across the whole timelapse")
+parser.add_argument('--profile', help="Path to save a JSON profile of the time and memory used")
+args = parser.parse_args()
+config = json.loads(args.config)
+profile = Profile(args.profile, workers=args.workers)
+profile.add_inputs(args.mask_dir, args.previous)
+
+# Each mask's position in the folder is its frame
+mask_fns = list_mask_files(args.mask_dir)
+if args.previous is None:
+    previous_features = {key: np.zeros(0) for key in SPOT_FEATURES}
+    previous_rois = []
+    previous_links = None
+    first_frame = 0
+else:
+    previous_features, previous_rois, previous_sources, previous_targets, first_frame = read_previous(args.previous)
+    previous_links = (previous_sources, previous_targets)
+    print(f"Extending the tracks of {first_frame} frames into {len(mask_fns) - first_frame} new frames")
+frames = list(range(first_frame, len(mask_fns)))
+profile.phase("detect")
+detections = list(parallel_map(detect_spots, args.workers, mask_fns[first_frame:], frames, chunksize=8))
+
+features = {
+    key: np.concatenate([previous_features[key]] + [frame[0][key] for frame in detections])
+    for key in SPOT_FEATURES
+}
+rois = previous_rois + [roi for frame in detections for roi in frame[1]]
+profile.record(frames=len(frames), spots=features["FRAME"].size)
+profile.phase("track")
+edge_sources, edge_targets, n_frame_links = track(
+    features,
+    config['algorithm'],
+    config.get('settings'),
+    previous_links,
+    first_frame,
+)
+
+profile.record(edges=edge_sources.size)
+profile.phase("write")
+ids = np.arange(features["FRAME"].size)
+columns = {f"spot_{key}": values.astype("int64") if key in INT_SPOT_FEATURES else values for key, values in features.items()}
+columns["spot_ID"] = ids
+columns["spot_LABEL"] = np.array([f"ID{i}" for i in ids], dtype=str)
+np.savez(
+    args.output_path,
+    roi_coords=np.concatenate(rois) if len(rois) > 0 else np.zeros((0, 2)),
+    roi_lengths=np.array([roi.shape[0] for roi in rois], dtype="int64"),
+    edge_sources=ids[edge_sources].astype("int64"),
+    edge_targets=ids[edge_targets].astype("int64"),
+    n_frames=len(mask_fns),
+    n_frame_links=n_frame_links,
+    **columns,
+)
+profile.save()
@@ -9,6 +9,48 @@ params.run = ''
 params.raw_dir = ''
 params.output_dir = ''
 
+// Optional, can be overridden on the command line
+// Number of images segmented by each segment_image task on CPU
+params.segmentation_batch_size = 10
+// Number of images of the same size passed to Cellpose at once on GPU, so their tiles are
+// processed together
+params.segmentation_gpu_batch_size = 1
+// Directory to cache segmentation masks in so they're reused across runs, disabled if empty
+params.segmentation_cache_dir = ''
+// Maximum size of the segmentation cache in GB
+params.segmentation_cache_max_gb = 50
+// Size in pixels of the tiles to segment images in to reduce memory usage, disabled if 0
+params.segmentation_tile_size = 0
+// Overlap in pixels between segmentation tiles, which should be larger than the largest cell
+params.segmentation_tile_overlap = 128
+// Maximum number of rows and columns of the downsampled frames shown in the segmentation QC report
+params.segmentation_qc_thumbnail_size = 256
+// Whether TrackMate reads the masks lazily as a virtual stack rather than loading them all up
+// front. Off until its effect on TrackMate's results and memory has been measured
+params.tracking_virtual_stack = false
+// Whether to also save TrackMate's results as XML, which can be opened in the Fiji GUI
+params.save_trackmate_xml = false
+// Number of frames processed by each cellphe_frame_features_image task
+params.frame_features_batch_size = 1
+// Number of rows of frame features read at a time when creating the summary features
+params.frame_summary_chunk_size = 100000
+// Format of the tables passed between the CellPhe steps, either csv or parquet. The
+// published outputs are always CSV
+params.intermediate_format = 'csv'
+// Format to save the processed frames in, either zip (an archive of the frame TIFFs) or zarr
+// (a chunked frame store that frames can be read from individually)
+params.processed_format = 'zip'
+// Number of frames saved into the frame store by each store_frames task
+params.frame_store_batch_size = 50
+// Directory to save a profile of each script's time and memory use to, disabled if empty
+params.profile_dir = ''
+// Resource model fitted by fit_resource_model.py to request each task's memory and time from
+// the size of its inputs, rather than the defaults in nextflow.config. Disabled if empty
+params.resource_model = ''
+// Whether to only process the frames added to a live acquisition since the last run into the
+// same output directory, reusing its masks, tracks and features. Requires the python tracking engine
+params.incremental = false
+
 // Folder paths
 timelapse_id = "${params.folder_names.timelapse_id}"
 processed_dir = "${params.output_dir}/processed"
@@ -17,40 +59,46 @@ mask_dir = "${seg_dir}/masks/${timelapse_id}"
 track_dir = "${seg_dir}/tracking/${params.folder_names.tracking}"
 trackmate_dir = "${track_dir}/trackmate"
 trackmate_outputs_dir = "${trackmate_dir}/${timelapse_id}"
+thumbnail_dir = "${seg_dir}/thumbnails/${timelapse_id}"
 cellphe_dir = "${track_dir}/cellphe"
 cellphe_outputs_dir = "${cellphe_dir}/${timelapse_id}"
 
 process segment_image {
     container "${params.segmentation.image}"
-    containerOptions '--env "NUMBA_CACHE_DIR=/tmp" --contain'
-    publishDir "${mask_dir}", mode: 'copy'
+    containerOptions "--env \"NUMBA_CACHE_DIR=/tmp\" --contain ${segmentation_cache_bind()}"
+    publishDir "${mask_dir}", mode: 'copy', pattern: '*_mask.png'
+    publishDir "${thumbnail_dir}", mode: 'copy', pattern: '*_qc.npz', enabled: params.incremental
 
     input:
-    path input_fn
+    path files
+    path ome_tiffs
 
     output:
-    path "*_mask.png"
+    path "*_mask.png", emit: masks
+    path "*_qc.npz", emit: thumbnails
  
     script:
-    outName = input_fn.baseName 
     """
-    segment_image.py ${input_fn} ${outName}_mask.png '${JsonOutput.toJson(params.segmentation.model)}' '${JsonOutput.toJson(params.segmentation.eval)}'
+    segment_image_batch.py ${profile_arg()} --threads ${task.cpus} --thumbnail-size ${params.segmentation_qc_thumbnail_size} ${segmentation_cache_args()} ${segmentation_tile_args()} '${JsonOutput.toJson(params.segmentation.model)}' '${JsonOutput.toJson(params.segmentation.eval)}' '${files}'
     """
 }
 
 process segment_image_gpu {
     container "${params.segmentation.image}"
-    containerOptions '--nv --env "NUMBA_CACHE_DIR=/tmp" --contain'
-    publishDir "${mask_dir}", mode: 'copy'
+    containerOptions "--nv --env \"NUMBA_CACHE_DIR=/tmp\" --contain ${segmentation_cache_bind()}"
+    publishDir "${mask_dir}", mode: 'copy', pattern: '*_mask.png'
+    publishDir "${thumbnail_dir}", mode: 'copy', pattern: '*_qc.npz', enabled: params.incremental
 
     input:
     path files
+    path ome_tiffs
 
     output:
-    path "*_mask.png"
+    path "*_mask.png", emit: masks
+    path "*_qc.npz", emit: thumbnails
 
     """
-    segment_image_batch.py '${JsonOutput.toJson(params.segmentation.model)}' '${JsonOutput.toJson(params.segmentation.eval)}' '${files}'
+    segment_image_batch.py ${profile_arg()} --batch-size ${params.segmentation_gpu_batch_size} --thumbnail-size ${params.segmentation_qc_thumbnail_size} ${segmentation_cache_args()} ${segmentation_tile_args()} '${JsonOutput.toJson(params.segmentation.model)}' '${JsonOutput.toJson(params.segmentation.eval)}' '${files}'
     """
 }
 
@@ -96,33 +144,55 @@ process segmentation_qc {
 
     input:
     path notebook
-    path masks
-    path images
+    path thumbnails
 
     output:
     path "*.html"
 
     script:
     """
-    quarto render ${notebook} -P masks:"${masks}" -P images:"${images}" -P highlight_method:"${params.QC.segmentation_highlight}" -o "${timelapse_id}.html"
+    quarto render ${notebook} -P thumbnails:"${thumbnails}" -P highlight_method:"${params.QC.segmentation_highlight}" -o "${timelapse_id}.html"
     """
 }
 
 process track_images {
     container 'ghcr.io/uoy-research/cellphe-trackmate:0.1.1'
     containerOptions '-H /trackmate_libs'
+    publishDir "${trackmate_outputs_dir}", mode: 'copy', pattern: 'trackmate.xml'
+
+    input:
+    path mask_fns
+
+    output:
+    path "trackmate.npz", emit: model
+    path "trackmate.xml", emit: xml, optional: true
+ 
+    script:
+    xml_arg = params.save_trackmate_xml ? "--xml-path trackmate.xml" : ""
+    virtual_arg = params.tracking_virtual_stack ? "--virtual" : ""
+    """
+    mkdir -p masks
+    mv *_mask.png masks
+    track_images.py ${profile_arg()} ${virtual_arg} ${xml_arg} masks '$task.memory' '${JsonOutput.toJson(params.tracking)}' trackmate.npz
+    """
+}
+
+process track_masks {
+    container 'ghcr.io/uoy-research/cellphe-cellphepy:0.1.1'
+    publishDir "${trackmate_outputs_dir}", mode: 'copy', enabled: params.incremental
 
     input:
     path mask_fns
+    path previous_model
 
     output:
-    path "trackmate.xml"
+    path "trackmate.npz"
  
     script:
     """
     mkdir -p masks
     mv *_mask.png masks
-    track_images.py masks '$task.memory' '${JsonOutput.toJson(params.tracking)}' trackmate.xml
+    track_masks.py ${profile_arg()} --workers ${task.cpus} ${previous_arg('--previous', previous_model)} masks '${JsonOutput.toJson(params.tracking)}' trackmate.npz
     """
 }
 
@@ -147,94 +217,106 @@ process tracking_qc {
 
 process parse_trackmate_xml {
     container 'ghcr.io/uoy-research/cellphe-cellphepy:0.1.1'
-    publishDir "${trackmate_outputs_dir}", mode: 'copy'
+    publishDir "${trackmate_outputs_dir}", mode: 'copy', pattern: '{rois.zip,trackmate_features.csv,trackmate_features_filtered.csv}'
 
     input:
-    path xml_file
+    path trackmate_file
+    path previous_features
 
     output:
     path "rois.zip", emit: rois, optional: true
     path "trackmate_features.csv", emit: features, optional: true
+    path "trackmate_features_filtered.csv", emit: filtered_features, optional: true
+    path "trackmate_features_filtered.parquet", emit: filtered_table, optional: true
+    path "roi_frames/frame_*_rois.zip", emit: roi_frames, optional: true
 
     script:
     """
-    parse_xml.py ${xml_file} rois.zip trackmate_features.csv
+    parse_xml.py ${profile_arg()} --streaming --roi-workers ${task.cpus} --roi-shard-dir roi_frames --filtered-csv-path trackmate_features_filtered.csv --minimum-cell-size ${params.QC.minimum_cell_size as int} --minimum-observations ${params.QC.minimum_observations as int} ${parquet_arg('--filtered-parquet-path', 'trackmate_features_filtered.parquet')} ${previous_arg('--previous-features', previous_features)} ${trackmate_file} rois.zip trackmate_features.csv
     """
 }
 
-process filter_size_and_observations {
-    container 'ghcr.io/uoy-research/cellphe-r:0.1.1'
-    publishDir "${trackmate_outputs_dir}", mode: 'copy'
+process cellphe_frame_features_image {
+    container 'ghcr.io/uoy-research/cellphe-cellphepy:0.1.1'
 
     input:
-    path features_original
+    tuple path(image_fns), path(roi_fns)
+    path trackmate_table
+    path ome_tiffs
 
     output:
-    path "trackmate_features_filtered.csv", arity: '1', optional: true
-
-    """
-    #!/usr/bin/env Rscript
-    library(dplyr)
-    df <- read.csv("${features_original}")
-    feats <- df |>
-        filter(
-          AREA >= as.integer(${params.QC.minimum_cell_size})
-        ) |>
-        group_by(TRACK_ID) |>
-        filter(n() >= as.integer(${params.QC.minimum_observations})) |>
-        ungroup()
-    if (nrow(feats) > 0) {
-        write.csv(feats, "trackmate_features_filtered.csv", row.names=FALSE)
-    }
+    path "frame_features_*.${params.intermediate_format}"
+ 
+    script:
+    """
+    frame_features_image.py ${profile_arg()} --crop --workers ${task.cpus} --format ${params.intermediate_format} ${trackmate_table} '${image_fns}' '${roi_fns}'
     """
 }
 
-process cellphe_frame_features_image {
+process plan_frame_features {
     container 'ghcr.io/uoy-research/cellphe-cellphepy:0.1.1'
+    label 'small'
 
     input:
-    path image_fn
-    path trackmate_csv
-    path roi_fn
+    path trackmate_table
+    path previous_features
 
     output:
-    path "frame_features_*.csv"
- 
+    path "frames_to_process.txt", emit: frames
+    path "frame_features_reused.${params.intermediate_format}", emit: reused, optional: true
+
     script:
     """
-    frame_features_image.py ${trackmate_csv} ${image_fn} ${roi_fn}
+    plan_frame_features.py ${profile_arg()} ${previous_arg('--previous', previous_features)} ${trackmate_table} frames_to_process.txt frame_features_reused.${params.intermediate_format}
     """
 }
 
 process combine_frame_features {
-    container 'ghcr.io/uoy-research/cellphe-linux-utils:0.1.1'
+    container "${params.intermediate_format == 'parquet' ? 'ghcr.io/uoy-research/cellphe-cellphepy:0.1.1' : 'ghcr.io/uoy-research/cellphe-linux-utils:0.1.1'}"
 
     input:
     path input_fns
 
     output:
-    path "combined_frame_features.csv"
+    path "combined_frame_features.${params.intermediate_format}"
  
     script:
+    // Sort by cell and then frame so the summary features can be calculated
+    // a chunk of cells at a time. For CSV, sort spills to disk for large inputs.
+    if (params.intermediate_format == 'parquet')
+    """
+    combine_frame_features.py ${profile_arg()} --row-group-size ${params.frame_summary_chunk_size} combined_frame_features.parquet ${input_fns}
     """
-    awk '(NR == 1) || (FNR > 1)' ${input_fns} > combined_frame_features.csv
+    else
+    // The rows are combined under the first file's header, so every file,
+    // including any reused from a previous run, must have the same columns
+    """
+    awk 'FNR == 1 { if (NR == 1) header = \$0; else if (\$0 != header) { print "Different columns in " FILENAME > "/dev/stderr"; exit 1 }; nextfile }' ${input_fns}
+    header=\$(awk 'NR == 1 { print; exit }' ${input_fns})
+    cell_col=\$(echo "\$header" | tr ',' '\\n' | grep -nx CellID | cut -d: -f1)
+    frame_col=\$(echo "\$header" | tr ',' '\\n' | grep -nx FrameID | cut -d: -f1)
+    {
+        echo "\$header"
+        awk 'FNR > 1' ${input_fns} | LC_ALL=C sort -t, -k\${cell_col},\${cell_col}n -k\${frame_col},\${frame_col}n
+    } > combined_frame_features.csv
     """
 }
 
 process create_frame_summary_features {
     container 'ghcr.io/uoy-research/cellphe-cellphepy:0.1.1'
-    publishDir "${cellphe_outputs_dir}", mode: 'copy'
+    publishDir "${cellphe_outputs_dir}", mode: 'copy', pattern: 'frame_features.csv'
 
     input:
     path(frame_features_static) 
     path(trackmate_features) 
 
     output:
-    path "frame_features.csv"
+    path "frame_features.csv", emit: features
+    path "frame_features.parquet", emit: table, optional: true
  
     script:
     """
-    create_frame_summary_features.py $frame_features_static $trackmate_features frame_features.csv
+    create_frame_summary_features.py ${profile_arg()} --workers ${task.cpus} --chunksize ${params.frame_summary_chunk_size} ${parquet_arg('--parquet-path', 'frame_features.parquet')} $frame_features_static $trackmate_features frame_features.csv
     """
 }
 
@@ -244,78 +326,54 @@ process cellphe_time_series_features {
 
     input:
     path(frame_features) 
+    path previous_time_series
+    path previous_frame_features
 
     output:
     path "time_series_features.csv", optional: true
  
     script:
     """
-    time_series_features.py $frame_features time_series_features.csv
-    """
-}
-
-process ome_get_global_t {
-    container 'ghcr.io/uoy-research/cellphe-xpath:0.1.1'
-    label 'small'
-
-    input:
-    path(xml_file)
-
-    output:
-    stdout
-
-    script:
-    """
-    xpath -q -e '//OME/Image/Pixels/TiffData/@FirstT' $xml_file | sed 's/FirstT=//g' | sed 's/\"//g'
+    time_series_features.py ${profile_arg()} --workers ${task.cpus} ${previous_arg('--previous', previous_time_series)} ${previous_arg('--previous-frame-features', previous_frame_features)} $frame_features time_series_features.csv
     """
 }
 
-process ome_get_frame_t {
-    container 'ghcr.io/uoy-research/cellphe-xpath:0.1.1'
+process snapshot_incremental_state {
+    container 'ghcr.io/uoy-research/cellphe-linux-utils:0.1.1'
     label 'small'
 
     input:
-    path(xml_file)
+    path previous_fns
 
     output:
-    stdout
+    path "previous_trackmate.npz", emit: model, optional: true
+    path "previous_trackmate_features.csv", emit: trackmate_features, optional: true
+    path "previous_frame_features.csv", emit: frame_features, optional: true
+    path "previous_time_series_features.csv", emit: time_series, optional: true
 
     script:
+    // Copied rather than staged, as this run publishes over the same files
     """
-    xpath -q -e '//OME/Image/Pixels/TiffData/@IFD' $xml_file | sed 's/IFD=//g' | sed 's/\"//g'
+    for fn in ${previous_fns}; do
+        cp -L "\$fn" "previous_\$fn"
+    done
     """
 }
 
-process ome_get_filename {
-    container 'ghcr.io/uoy-research/cellphe-xpath:0.1.1'
+process index_ome_frames {
+    container 'ghcr.io/uoy-research/cellphe-cellphepy:0.1.1'
     label 'small'
 
     input:
-    path(xml_file)
-
-    output:
-    stdout
-
-    script:
-    """
-    xpath -q -e '//OME/Image/Pixels/TiffData/UUID/@FileName' $xml_file | sed 's/FileName=//g' | sed 's/\"//g'
-    """
-}
-
-process split_ome_frames {
-    container 'ghcr.io/uoy-research/cellphe-linux-utils:0.1.1'
-    label 'small'
+    path companion
+    path ome_tiffs
 
-    input:
-    tuple path(ome_fn), val(frame_index), val(global_frame_index)
-    
     output:
-    file('ome_split_*.tiff')
+    path "frame_*.omeframe"
 
     script:
     """
-    printf -v i "%05d" ${global_frame_index}
-    tiffcp ${ome_fn},${frame_index} "ome_split_\${i}.tiff"
+    index_ome_frames.py ${profile_arg()} '${companion}'
     """
 }
 
@@ -374,18 +432,59 @@ process split_stacked_tiff {
 }
 
 process create_tiff_stack {
-    container 'ghcr.io/uoy-research/cellphe-linux-utils:0.1.1'
+    container 'ghcr.io/uoy-research/cellphe-cellphepy:0.1.1'
     publishDir "${processed_dir}", mode: 'move'
 
     input:
     path(frames) 
+    path ome_tiffs
 
     output:
     path "${timelapse_id}.zip"
 
     script:
+    // OME frames are references to a page of one of the OME-TIFFs, which is
+    // decoded into its own TIFF so the archive holds the same frame TIFFs
+    // for every type of input
     """
-    zip "${timelapse_id}.zip" ${frames}
+    create_tiff_stack.py ${profile_arg()} '${frames}' "${timelapse_id}.zip"
+    """
+}
+
+process create_frame_store {
+    container 'ghcr.io/uoy-research/cellphe-cellphepy:0.1.1'
+    publishDir "${processed_dir}", mode: 'copy'
+    label 'small'
+
+    input:
+    path first_frame
+    val n_frames
+    path ome_tiffs
+
+    output:
+    path "${timelapse_id}.zarr/.zarray"
+
+    script:
+    """
+    store_frames.py ${profile_arg()} --create ${n_frames} "${timelapse_id}.zarr" '${first_frame}'
+    """
+}
+
+process store_frames {
+    container 'ghcr.io/uoy-research/cellphe-cellphepy:0.1.1'
+    publishDir "${processed_dir}", mode: 'copy'
+
+    input:
+    path metadata, stageAs: "${timelapse_id}.zarr/.zarray"
+    path frames
+    path ome_tiffs
+
+    output:
+    path "${timelapse_id}.zarr/*"
+
+    script:
+    """
+    store_frames.py ${profile_arg()} --workers ${task.cpus} "${timelapse_id}.zarr" '${frames}'
     """
 }
 
@@ -405,98 +504,184 @@ process convert_jpeg {
     """
 }
 
+// Extracts the FrameID from a frame image or per-frame file, i.e. frame_00012.tiff -> 12
+def frame_index(f) {
+    return (f.getName() =~ /frame_([0-9]+)/)[0][1].toInteger()
+}
+
+// Arguments for the segmentation scripts to reuse masks from the cache, if enabled.
+// The container image is part of the cache key so masks aren't reused across Cellpose versions
+def segmentation_cache_args() {
+    if (!params.segmentation_cache_dir) {
+        return ""
+    }
+    return "--cache-dir '${params.segmentation_cache_dir}' --cache-max-gb ${params.segmentation_cache_max_gb} --cache-tag '${params.segmentation.image}'"
+}
+
+// Arguments for the segmentation scripts to segment images in tiles, if enabled
+def segmentation_tile_args() {
+    if (!params.segmentation_tile_size) {
+        return ""
+    }
+    return "--tile-size ${params.segmentation_tile_size} --tile-overlap ${params.segmentation_tile_overlap}"
+}
+
+// Argument for a script to also save a table as Parquet, if that's the intermediate format
+def parquet_arg(flag, filename) {
+    return params.intermediate_format == 'parquet' ? "${flag} ${filename}" : ""
+}
+
+// Argument for a script to save a profile of its time and memory use, which is copied to
+// the profile directory after the task, if enabled
+def profile_arg() {
+    return params.profile_dir ? "--profile .profile.json" : ""
+}
+
+// Argument for a script to reuse an output of the previous run, if running incrementally
+// and the previous run saved it
+def previous_arg(flag, previous_fn) {
+    return previous_fn ? "${flag} ${previous_fn}" : ""
+}
+
+// Container option to mount the segmentation cache, if enabled
+def segmentation_cache_bind() {
+    return params.segmentation_cache_dir ? "-B '${params.segmentation_cache_dir}'" : ""
+}
+
 workflow {
     // Handle 4 possible inputs:
-    //    1. OME.TIFF (identified by companion.ome XML file) - need splitting into frame per tiff
+    //    1. OME.TIFF (identified by companion.ome XML file) - frames are read in place from the OME-TIFFs
     //    2. JPEG per frame - need converting into TIFFs
     //    3. Single TIFF - TIFF stack that needs splitting into frame per tiff
     //    4. Multiple TIFFs - already in 1 frame per tiff
     // The outcome of this input processing is to get a set of TIFFs with 1 per frame named
-    // as frame_<frameindex>.tiff. This is stored in the channel allFiles and will be used
-    // for all downstream analyses
+    // as frame_<frameindex>.tiff (or frame_<frameindex>.omeframe references for OME). This
+    // is stored in the channel allFiles and will be used for all downstream analyses
+
+    if (params.incremental && params.run.tracking && params.tracking.engine != 'python') {
+        error "Incremental runs require the python tracking engine"
+    }
 
     ome_companion = file("${params.raw_dir}/*companion.ome*")
     jpegs = files("${params.raw_dir}/*.{jpg,jpeg,JPG,JPEG}")
     tiffs = files("${params.raw_dir}/*.{tif,tiff,TIF,TIFF}")
     if (!ome_companion.isEmpty()) {
-        // OME that needs splitting into 1 tiff per frame
-        // Obtain a list of all the frames in the dataset in the format:
-        // (ome filename, ome frame index, overall frame index)
-        xml1 = ome_get_filename(ome_companion)
-            | splitText()
-            | map( it -> it.trim())
-            | map( it -> file("${params.raw_dir}/" + it) )
-        xml2 = ome_get_frame_t(ome_companion)
-                | splitText()
-                | map( it -> it.trim())
-        xml3 = ome_get_global_t(ome_companion)
-                | splitText()
-                | map( it -> it.trim())
-        separate = xml1
-            | merge(xml2)
-            | merge(xml3)
-            | split_ome_frames
-        frameFiles = separate
-    } else if (!jpegs.isEmpty()) {
-        // JPEGs need converting to TIFF
-        frameFiles = convert_jpeg(channel.fromList(jpegs))
-    } else if (tiffs.size() == 1) {
-        // TIFF stack that needs splitting into 1 tiff per frame
-        frameFiles = split_stacked_tiff(tiffs[0]).flatten()
-    } else if (tiffs.size() > 1) {
-        frameFiles = channel.fromList(tiffs)
+        // OME frames are read in place from the OME-TIFFs rather than split out,
+        // so each frame is a reference to its OME-TIFF page, already named in frame order.
+        // The OME-TIFFs are staged alongside the frames wherever they're read
+        ome_tiffs = tiffs
+        allFiles = index_ome_frames(ome_companion, ome_tiffs) | flatten
     } else {
-        // Fallback, shouldn't get here
-        println "No image files found!"
-        frameFiles = channel.empty()
-    }
-
-    // Remove spaces as that messes up collecting
-    // Then rename images to standard frame_XXXX.tiff format
-    frameFiles
-        .branch { f ->
-            has_space: f.getBaseName().contains(" ")
-            no_space: true
+        if (!jpegs.isEmpty()) {
+            // JPEGs need converting to TIFF
+            frameFiles = convert_jpeg(channel.fromList(jpegs))
+        } else if (tiffs.size() == 1) {
+            // TIFF stack that needs splitting into 1 tiff per frame
+            frameFiles = split_stacked_tiff(tiffs[0]).flatten()
+        } else if (tiffs.size() > 1) {
+            frameFiles = channel.fromList(tiffs)
+        } else {
+            // Fallback, shouldn't get here
+            println "No image files found!"
+            frameFiles = channel.empty()
         }
-        .set { filesBranched }
 
-    allFiles = filesBranched.has_space
-      | remove_spaces
-      | concat(filesBranched.no_space)
-      | collect
-      | rename_frames
-      | flatten
+        // Remove spaces as that messes up collecting
+        // Then rename images to standard frame_XXXX.tiff format
+        frameFiles
+            .branch { f ->
+                has_space: f.getBaseName().contains(" ")
+                no_space: true
+            }
+            .set { filesBranched }
+
+        allFiles = filesBranched.has_space
+          | remove_spaces
+          | concat(filesBranched.no_space)
+          | collect
+          | rename_frames
+          | flatten
+        ome_tiffs = []
+    }
 
     if (params.run.segmentation) {
 
         // Save config
 	save_segmentation_config(JsonOutput.toJson(['segmentation': params.segmentation]))
+        if (params.segmentation_cache_dir) {
+            file(params.segmentation_cache_dir).mkdirs()
+        }
 
         // Segment all images and track
-        // NB: if not specified otherwise, will segment in parallel across CPU cores
+        // NB: if not specified otherwise, will segment batches of images in parallel
+        // across CPU cores, loading the model once per batch
         // For GPU, this isn't feasible owing to longer queue times, so instead segment
         // every image in one batch
+        // The masks are accompanied by small thumbnails of each frame for the QC report
+        // When running incrementally, only the frames without a published mask are
+        // segmented, and the published masks and thumbnails of the others are reused
+        if (params.incremental) {
+            previous_masks = files("${mask_dir}/frame_*_mask.png")
+            previous_thumbnails = files("${thumbnail_dir}/frame_*_qc.npz")
+            segmented_frames = previous_masks.collect { f -> frame_index(f) } as Set
+            new_frames = allFiles
+              | filter { f -> !segmented_frames.contains(frame_index(f)) }
+        } else {
+            previous_masks = []
+            previous_thumbnails = []
+            new_frames = allFiles
+        }
         if (params.segmentation.model.gpu) {
-            masks = segment_image_gpu(allFiles.collect())
+            segmented = segment_image_gpu(new_frames.collect(), ome_tiffs)
         } else {
-            masks = segment_image(allFiles)
-              | collect
+            batches = new_frames
+              | buffer(size: params.segmentation_batch_size, remainder: true)
+            segmented = segment_image(batches, ome_tiffs)
         }
+        masks = segmented.masks
+          | mix(channel.fromList(previous_masks))
+          | collect
         segmentation_qc(
             file("${projectDir}/bin/segmentation_qc.qmd"),
-            masks,
-            allFiles.collect()
+            segmented.thumbnails | mix(channel.fromList(previous_thumbnails)) | collect
         )
         if (params.run.tracking) {
 
 	    // Save config
 	    save_tracking_config(JsonOutput.toJson(['tracking': params.tracking, 'QC': params.QC]))
 
-            track_images(masks)
-              | parse_trackmate_xml
+            // The previous run's outputs that an incremental run extends are copied before
+            // anything is published over them. Every task that publishes one of them runs
+            // after track_masks, which waits for the copy
+            if (params.incremental) {
+                previous = snapshot_incremental_state(
+                    files("${trackmate_outputs_dir}/{trackmate.npz,trackmate_features.csv}") +
+                    files("${cellphe_outputs_dir}/{frame_features,time_series_features}.csv")
+                )
+                previous_model = previous.model.ifEmpty([])
+                previous_trackmate_features = previous.trackmate_features.ifEmpty([])
+                previous_frame_features = previous.frame_features.ifEmpty([])
+                previous_time_series = previous.time_series.ifEmpty([])
+            } else {
+                previous_model = []
+                previous_trackmate_features = []
+                previous_frame_features = []
+                previous_time_series = []
+            }
 
-            // QC step, filter on size and number of observations
-            trackmate_feats = filter_size_and_observations(parse_trackmate_xml.out.features)
+            // TrackMate runs in a JVM, the python engine is a lighter-weight
+            // implementation of the LAP trackers with the same output
+            if (params.tracking.engine == 'python') {
+                tracked = track_masks(masks, previous_model)
+            } else {
+                track_images(masks)
+                tracked = track_images.out.model
+            }
+            // Also carries out the QC step, filtering on size and number of
+            // observations, so only the ROIs of the remaining cells are saved
+            parse_trackmate_xml(tracked, previous_trackmate_features)
+            trackmate_feats = parse_trackmate_xml.out.filtered_features
+            trackmate_table = params.intermediate_format == 'parquet' ? parse_trackmate_xml.out.filtered_table : trackmate_feats
             // Hacky way of getting Nextflow to find the Quarto markdown, since it can't be run with
             // a shebang like all the other files in bin/
             tracking_qc(
@@ -506,20 +691,50 @@ workflow {
             )
             if (params.run.cellphe) {
 
-                // Generate CellPhe features on each frame separately
+                // Generate CellPhe features on batches of frames, pairing each frame
+                // with the archive holding just its ROIs. Frames without any ROIs have no
+                // features to calculate.
                 // Then combine and add the summary features (density, velocity etc..., then time-series features)
-                static_feats = cellphe_frame_features_image(
-                    allFiles,
-                    trackmate_feats,
-                    parse_trackmate_xml.out.rois
-                )
+                frame_rois = parse_trackmate_xml.out.roi_frames
+                  | flatten
+                  | map { f -> [frame_index(f), f] }
+                frame_ids = allFiles
+                  | map { f -> [frame_index(f), f] }
+                // When running incrementally, the features of frames whose cells are unchanged
+                // are reused from the previous run
+                if (params.incremental) {
+                    plan_frame_features(trackmate_table, previous_frame_features)
+                    planned = plan_frame_features.out.frames
+                      | splitText
+                      | map { line -> [line.trim().toInteger()] }
+                    frame_ids = frame_ids | join(planned)
+                    reused_feats = plan_frame_features.out.reused
+                } else {
+                    reused_feats = channel.empty()
+                }
+                frame_inputs = frame_ids
+                  | join(frame_rois)
+                  | buffer(size: params.frame_features_batch_size, remainder: true)
+                  | map { batch -> [batch.collect { it[1] }, batch.collect { it[2] }] }
+                static_feats = cellphe_frame_features_image(frame_inputs, trackmate_table, ome_tiffs)
+                  | mix(reused_feats)
                   | collect
                   | combine_frame_features
 
-                create_frame_summary_features(static_feats, trackmate_feats)
-                  | cellphe_time_series_features
+                create_frame_summary_features(static_feats, trackmate_table)
+                frame_table = params.intermediate_format == 'parquet' ? create_frame_summary_features.out.table : create_frame_summary_features.out.features
+                cellphe_time_series_features(frame_table, previous_time_series, previous_frame_features)
             }
         }
     }
-    create_tiff_stack(allFiles.collect())
+    if (params.processed_format == 'zarr') {
+        // Every frame is saved into its own chunks, so once the store has been created
+        // the frames are saved in parallel batches
+        frame_store = create_frame_store(allFiles.first(), allFiles.count(), ome_tiffs)
+        frame_batches = allFiles
+          | buffer(size: params.frame_store_batch_size, remainder: true)
+        store_frames(frame_store, frame_batches, ome_tiffs)
+    } else {
+        create_tiff_stack(allFiles.collect(), ome_tiffs)
+    }
 }
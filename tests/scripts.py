@@ -0,0 +1,37 @@
+"""
+Access to the functions of the scripts in bin/ for the tests.
+
+The scripts parse their arguments and do their work at module level, so they
+can't be imported. Instead, only their imports, functions, classes and
+upper-case constants are run, into a new module.
+"""
+import ast
+from pathlib import Path
+import sys
+import types
+
+BIN_DIR = Path(__file__).resolve().parent.parent / "bin"
+# For the shared modules the scripts import
+sys.path.insert(0, str(BIN_DIR))
+
+def load_script(name: str) -> types.ModuleType:
+    """
+    Loads the definitions from a script without running it.
+
+    :param name: The script's filename in bin/, without the .py extension.
+    :return: A module with the script's imports, functions, classes and
+        upper-case constants.
+    """
+    path = BIN_DIR / f"{name}.py"
+    tree = ast.parse(path.read_text(), filename=str(path))
+    definitions = [
+        node for node in tree.body
+        if isinstance(node, (ast.Import, ast.ImportFrom, ast.FunctionDef, ast.ClassDef))
+        or (isinstance(node, ast.Assign) and all(isinstance(target, ast.Name) and target.id.isupper() for target in node.targets))
+    ]
+    module = types.ModuleType(name)
+    module.__file__ = str(path)
+    # So the functions can be pickled by reference to run in worker processes
+    sys.modules[name] = module
+    exec(compile(ast.Module(body=definitions, type_ignores=[]), str(path), "exec"), module.__dict__)
+    return module
@@ -0,0 +1,88 @@
+import json
+import subprocess
+import sys
+import numpy as np
+import pytest
+from scripts import BIN_DIR, load_script
+
+fit_resource_model = load_script("fit_resource_model")
+
+def profiles(seed: int, n_profiles: int = 12) -> list[dict]:
+    """
+    Generates profiles of tasks of a range of input sizes.
+
+    :param seed: Seed for the random number generator.
+    :param n_profiles: Number of profiles.
+    :return: A list of profiles with the predictors of a resource model.
+    """
+    rng = np.random.default_rng(seed)
+    return [
+        {"input_bytes": int(rng.integers(1e6, 1e10)), "input_files": int(rng.integers(1, 500))}
+        for _ in range(n_profiles)
+    ]
+
+def predict(fit: dict, profile: dict) -> float:
+    """
+    Predicts a task's request as model_request in nextflow.config does.
+
+    :param fit: A fitted resource model.
+    :param profile: The task's profile.
+    :return: The request.
+    """
+    predicted = fit["intercept"] + sum(fit[predictor] * profile[predictor] for predictor in fit_resource_model.PREDICTORS)
+    return max(fit["minimum"], fit["scale"] * predicted)
+
+def test_recovers_linear_usage():
+    tasks = profiles(0)
+    usage = np.array([200 + 3e-7 * task["input_bytes"] + 2 * task["input_files"] for task in tasks])
+    fit = fit_resource_model.fit_resource(tasks, usage, 1.0, 0)
+    np.testing.assert_allclose([fit["intercept"], fit["input_bytes"], fit["input_files"]], [200, 3e-7, 2], rtol=1e-6)
+    assert fit["scale"] == pytest.approx(1.0)
+
+def test_coefficients_are_non_negative():
+    tasks = profiles(1)
+    # Usage that falls with the number of files still never requests less
+    # for larger inputs
+    usage = np.array([1000 + 1e-7 * task["input_bytes"] - task["input_files"] for task in tasks])
+    fit = fit_resource_model.fit_resource(tasks, usage, 1.0, 0)
+    assert all(fit[key] >= 0 for key in ["intercept", *fit_resource_model.PREDICTORS])
+
+def test_no_task_is_under_provisioned():
+    tasks = profiles(2, 30)
+    rng = np.random.default_rng(3)
+    usage = np.array([50 + 1e-7 * task["input_bytes"] * rng.uniform(0.5, 2) for task in tasks])
+    margin = 1.2
+    fit = fit_resource_model.fit_resource(tasks, usage, margin, 512)
+    requests = np.array([predict(fit, task) for task in tasks])
+    assert np.all(requests >= usage * margin * (1 - 1e-9))
+    assert np.all(requests >= 512)
+
+def test_fits_saved_profiles(tmp_path):
+    profile_dir = tmp_path / "profiles"
+    profile_dir.mkdir()
+    rng = np.random.default_rng(4)
+    for i, task in enumerate(profiles(5)):
+        rss = 100 + 2e-6 * task["input_bytes"]
+        profile = {
+            "script": "parse_xml",
+            "wall_seconds": 60 + 1e-8 * task["input_bytes"] * rng.uniform(0.9, 1.1),
+            "peak_rss_mb": rss,
+            "peak_worker_rss_mb": rss / 4,
+            "workers": 4,
+            **task,
+        }
+        (profile_dir / f"parse_trackmate_xml_{i}.json").write_text(json.dumps(profile))
+    # Too few profiles to fit
+    (profile_dir / "track_masks_0.json").write_text(json.dumps({**profile, "script": "track_masks"}))
+
+    model_fn = tmp_path / "model.json"
+    subprocess.run([sys.executable, BIN_DIR / "fit_resource_model.py", model_fn, profile_dir], check=True)
+    model = json.loads(model_fn.read_text())
+    assert list(model["scripts"]) == ["parse_xml"]
+    fit = model["scripts"]["parse_xml"]
+    assert fit["profiles"] == 12
+    for fn in sorted(profile_dir.glob("parse_trackmate_xml_*.json")):
+        profile = json.loads(fn.read_text())
+        # The workers' memory is counted on top of the script's
+        assert predict(fit["memory_mb"], profile) >= 1.2 * 2 * profile["peak_rss_mb"] * (1 - 1e-9)
+        assert predict(fit["time_minutes"], profile) >= 1.2 * profile["wall_seconds"] / 60 * (1 - 1e-9)
@@ -0,0 +1,119 @@
+import json
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from scripts import BIN_DIR
+
+sys.path.insert(0, str(BIN_DIR.parent / "benchmarks"))
+from synthetic import simulate, write_frames
+
+# Merging and splitting let new frames change the links in earlier ones
+CONFIG = json.dumps({"algorithm": "SparseLAP", "settings": {"ALLOW_TRACK_MERGING": True, "ALLOW_TRACK_SPLITTING": True}})
+
+def run_script(name: str, *args, cwd: Path | None = None) -> None:
+    """
+    Runs a script from bin/.
+
+    :param name: The script's filename in bin/, without the .py extension.
+    :param args: The script's arguments.
+    :param cwd: Directory to run the script in.
+    :return: None, the script writes its outputs as a side-effect.
+    """
+    subprocess.run([sys.executable, BIN_DIR / f"{name}.py", *map(str, args)], check=True, cwd=cwd)
+
+def calculate_frame_features(work_dir: Path, trackmate: Path, frame_fns: list[Path], rois: Path) -> list[str]:
+    """
+    Calculates the static frame features of some frames, combining them as
+    combine_frame_features does.
+
+    :param work_dir: Directory to calculate the features in.
+    :param trackmate: The TrackMate features CSV.
+    :param frame_fns: Paths to the frames.
+    :param rois: The ROI archive.
+    :return: The lines of the combined CSV, starting with the header.
+    """
+    work_dir.mkdir()
+    run_script("frame_features_image", trackmate, " ".join(map(str, frame_fns)), rois, cwd=work_dir)
+    calculated = [fn.read_text().splitlines() for fn in sorted(work_dir.glob("frame_features_*.csv"))]
+    return calculated[0][:1] + [line for lines in calculated for line in lines[1:]]
+
+def test_incremental_matches_full_run(tmp_path):
+    n_first = 8
+    timelapse = simulate(n_frames=12, n_cells=15, image_size=160, split_rate=0.05, merge_rate=0.05, seed=0)
+    write_frames(timelapse, tmp_path / "frames", tmp_path / "masks")
+    frame_fns = sorted((tmp_path / "frames").glob("frame_*.tiff"))
+    (tmp_path / "first_masks").mkdir()
+    for fn in sorted((tmp_path / "masks").iterdir())[:n_first]:
+        shutil.copy(fn, tmp_path / "first_masks" / fn.name)
+
+    # Tracks
+    run_script("track_masks", tmp_path / "first_masks", CONFIG, tmp_path / "previous.npz")
+    run_script("track_masks", "--previous", tmp_path / "previous.npz", tmp_path / "masks", CONFIG, tmp_path / "extended.npz")
+    run_script("track_masks", tmp_path / "masks", CONFIG, tmp_path / "full.npz")
+    with np.load(tmp_path / "extended.npz") as extended, np.load(tmp_path / "full.npz") as full:
+        assert sorted(extended.files) == sorted(full.files)
+        for key in full.files:
+            np.testing.assert_array_equal(extended[key], full[key], err_msg=key)
+
+    # Track ids
+    run_script("parse_xml", tmp_path / "previous.npz", tmp_path / "previous_rois.zip", tmp_path / "previous.csv")
+    run_script(
+        "parse_xml",
+        "--previous-features", tmp_path / "previous.csv",
+        tmp_path / "extended.npz", tmp_path / "extended_rois.zip", tmp_path / "extended.csv",
+    )
+    run_script("parse_xml", tmp_path / "full.npz", tmp_path / "full_rois.zip", tmp_path / "full.csv")
+    previous = pd.read_csv(tmp_path / "previous.csv")
+    extended = pd.read_csv(tmp_path / "extended.csv")
+    full = pd.read_csv(tmp_path / "full.csv")
+    # The same Spots, in the same tracks, only numbered differently
+    pd.testing.assert_frame_equal(extended.drop(columns=["TRACK_ID", "ROI_FILENAME"]), full.drop(columns=["TRACK_ID", "ROI_FILENAME"]))
+    track_pairs = extended[["TRACK_ID"]].assign(FULL_TRACK_ID=full["TRACK_ID"]).drop_duplicates()
+    assert track_pairs["TRACK_ID"].is_unique and track_pairs["FULL_TRACK_ID"].is_unique
+    # Tracks whose Spots in the earlier frames haven't changed keep their ids
+    earlier = extended.loc[extended["FRAME"] <= n_first, ["ID", "TRACK_ID"]]
+    earlier_tracks = earlier.groupby("TRACK_ID")["ID"].apply(frozenset)
+    previous_tracks = previous.groupby("TRACK_ID")["ID"].apply(frozenset)
+    unchanged = earlier_tracks.reset_index().merge(previous_tracks.reset_index(), on="ID", suffixes=("", "_PREVIOUS"))
+    assert unchanged.shape[0] > 0
+    assert (unchanged["TRACK_ID"] == unchanged["TRACK_ID_PREVIOUS"]).all()
+
+    # Frame features
+    previous_features = calculate_frame_features(tmp_path / "previous_features", tmp_path / "previous.csv", frame_fns[:n_first], tmp_path / "previous_rois.zip")
+    (tmp_path / "previous_features.csv").write_text("\n".join(previous_features) + "\n")
+    run_script(
+        "plan_frame_features",
+        "--previous", tmp_path / "previous_features.csv",
+        tmp_path / "extended.csv", tmp_path / "frames.txt", tmp_path / "reused.csv",
+    )
+    recalculate = [int(line) for line in (tmp_path / "frames.txt").read_text().splitlines()]
+    assert 0 < len(recalculate) < len(frame_fns)
+    calculated = calculate_frame_features(
+        tmp_path / "extended_features",
+        tmp_path / "extended.csv",
+        [frame_fns[frame_id - 1] for frame_id in recalculate],
+        tmp_path / "extended_rois.zip",
+    )
+    reused = (tmp_path / "reused.csv").read_text().splitlines()
+    assert reused[0] == calculated[0]
+    full_features = calculate_frame_features(tmp_path / "full_features", tmp_path / "extended.csv", frame_fns, tmp_path / "extended_rois.zip")
+    assert sorted(reused[1:] + calculated[1:]) == sorted(full_features[1:])
+    (tmp_path / "frame_features.csv").write_text("\n".join(full_features) + "\n")
+
+    # Time series features
+    run_script("time_series_features", tmp_path / "previous_features.csv", tmp_path / "previous_time_series.csv")
+    run_script(
+        "time_series_features",
+        "--previous", tmp_path / "previous_time_series.csv",
+        "--previous-frame-features", tmp_path / "previous_features.csv",
+        tmp_path / "frame_features.csv", tmp_path / "incremental_time_series.csv",
+    )
+    run_script("time_series_features", tmp_path / "frame_features.csv", tmp_path / "full_time_series.csv")
+    pd.testing.assert_frame_equal(
+        pd.read_csv(tmp_path / "incremental_time_series.csv", float_precision="round_trip"),
+        pd.read_csv(tmp_path / "full_time_series.csv", float_precision="round_trip"),
+        rtol=1e-12,
+    )
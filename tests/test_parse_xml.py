@@ -0,0 +1,251 @@
+import subprocess
+import sys
+from pathlib import Path
+import numpy as np
+import pytest
+from scripts import BIN_DIR, load_script
+
+parse_xml = load_script("parse_xml")
+
+# The attributes TrackMate saves for each Spot, other than its name
+SPOT_ATTRIBUTES = [
+    "ID",
+    "QUALITY",
+    "POSITION_X",
+    "POSITION_Y",
+    "POSITION_Z",
+    "POSITION_T",
+    "FRAME",
+    "RADIUS",
+    "VISIBILITY",
+    "MEAN_INTENSITY_CH1",
+    "MEDIAN_INTENSITY_CH1",
+    "MIN_INTENSITY_CH1",
+    "MAX_INTENSITY_CH1",
+    "TOTAL_INTENSITY_CH1",
+    "STD_INTENSITY_CH1",
+    "CONTRAST_CH1",
+    "SNR_CH1",
+    "AREA",
+    "PERIMETER",
+    "CIRCULARITY",
+    "SOLIDITY",
+    "SHAPE_INDEX",
+]
+
+def write_trackmate_xml(path: Path, n_frames: int, n_cells: int) -> None:
+    """
+    Saves a small TrackMate XML file of cells that stay still, with the
+    attributes written in the mix of formats TrackMate itself uses.
+
+    :param path: Where to save the XML.
+    :param n_frames: Number of frames.
+    :param n_cells: Number of cells, each tracked across every frame.
+    :return: None, writes to disk as a side-effect.
+    """
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', "<TrackMate>", "<Model>", "<AllSpots>"]
+    for frame in range(n_frames):
+        lines.append(f'<SpotsInFrame frame="{frame}">')
+        for cell in range(n_cells):
+            spot_id = frame * n_cells + cell
+            values = {key: f"{spot_id + 0.5}" for key in SPOT_ATTRIBUTES}
+            values.update({
+                "ID": str(spot_id),
+                "FRAME": str(frame),
+                "POSITION_X": f"{20.0 * (cell + 1)}",
+                "POSITION_Y": "20.0",
+                "POSITION_Z": "0.0",
+                # Integers, Java's exponent notation, and trailing zeros
+                "VISIBILITY": "1",
+                "QUALITY": f"{cell + 1}.0E-4",
+                "AREA": "100" if cell % 2 == 0 else "100.50",
+            })
+            if spot_id == 1:
+                # An attribute that not every Spot has
+                del values["SHAPE_INDEX"]
+            attrs = " ".join(f'{key}="{value}"' for key, value in values.items())
+            lines.append(f'<Spot name="ID{spot_id}" {attrs}>-3.0 -3.0 3.0 -3.0 3.0 3.0 -3.0 3.0</Spot>')
+        lines.append("</SpotsInFrame>")
+    lines += ["</AllSpots>", "<AllTracks>"]
+    for cell in range(n_cells):
+        lines.append(f'<Track name="Track_{cell}" TRACK_ID="{cell}">')
+        for frame in range(n_frames - 1):
+            lines.append(f'<Edge SPOT_SOURCE_ID="{frame * n_cells + cell}" SPOT_TARGET_ID="{(frame + 1) * n_cells + cell}"/>')
+        lines.append("</Track>")
+    lines += ["</AllTracks>", "</Model>", "</TrackMate>"]
+    path.write_text("\n".join(lines))
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_readers_write_identical_features(tmp_path, streaming):
+    xml_path = tmp_path / "trackmate.xml"
+    write_trackmate_xml(xml_path, n_frames=4, n_cells=3)
+    reference = tmp_path / "reference.csv"
+    subprocess.run(
+        [sys.executable, BIN_DIR / "parse_xml.py", xml_path, tmp_path / "reference.zip", reference],
+        check=True,
+    )
+    output = tmp_path / "output.csv"
+    subprocess.run(
+        [sys.executable, BIN_DIR / "parse_xml.py", *(["--streaming"] if streaming else []), xml_path, tmp_path / "output.zip", output],
+        check=True,
+    )
+    assert output.read_bytes() == reference.read_bytes()
+    # The attributes are written as they appear in the XML
+    header, first_row = reference.read_text().splitlines()[:2]
+    row = dict(zip(header.split(","), first_row.split(",")))
+    assert row["VISIBILITY"] == "1"
+    assert row["QUALITY"] == "1.0E-4"
+
+def traverse_tracks(spot_ids: np.ndarray, frames: np.ndarray, edge_sources: np.ndarray, edge_targets: np.ndarray) -> dict[int, int]:
+    """
+    The original recursive track traversal, which assign_track_ids replaced.
+
+    :param spot_ids: Array of Spot IDs, in file order.
+    :param frames: Array of the frame of each Spot.
+    :param edge_sources: Spot IDs of the source of every Edge, in file order.
+    :param edge_targets: Spot IDs of the target of every Edge, in file order.
+    :return: A dict mapping the ID of every Spot in a track to its track id.
+    """
+    children = {spot_id: [] for spot_id in spot_ids}
+    parents = {spot_id: [] for spot_id in spot_ids}
+    for source, target in zip(edge_sources, edge_targets):
+        children[source].append(target)
+        parents[target].append(source)
+    frame_of = dict(zip(spot_ids, frames))
+    in_track = [spot_id for spot_id in spot_ids if len(children[spot_id]) > 0 or len(parents[spot_id]) > 0]
+    roots = sorted((spot_id for spot_id in in_track if len(parents[spot_id]) == 0), key=lambda spot_id: frame_of[spot_id])
+
+    track_ids = {}
+    track_id = 0
+
+    def traverse_track(spot_id, accum=False):
+        nonlocal track_id
+        # Prevent multiple tracks on a merge
+        if spot_id in track_ids:
+            return
+        # Assign different track_ids after a split
+        if accum:
+            track_id += 1
+        track_ids[spot_id] = track_id
+        for j, child in enumerate(children[spot_id]):
+            traverse_track(child, j > 0)
+
+    for i, root in enumerate(roots):
+        traverse_track(root, i > 0)
+    return track_ids
+
+def random_tracks(rng: np.random.Generator) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Generates a random graph of tracks with splits, merges and gaps.
+
+    :param rng: The random number generator.
+    :return: A tuple of the Spot IDs in file order, their frames, and the
+        source and target Spot IDs of every Edge in file order.
+    """
+    n_frames = int(rng.integers(2, 8))
+    frames = np.repeat(np.arange(n_frames), rng.integers(1, 6, n_frames))
+    spot_ids = rng.permutation(10 * frames.size)[:frames.size]
+    edges = set()
+    for i, frame in enumerate(frames):
+        # Link into the next frame or, for gap closing, the one after
+        later = np.flatnonzero((frames > frame) & (frames <= frame + 2))
+        if later.size == 0 or rng.random() < 0.2:
+            continue
+        n_children = 1 + int(rng.random() < 0.3) + int(rng.random() < 0.1)
+        for j in rng.choice(later, size=min(n_children, later.size), replace=False):
+            edges.add((spot_ids[i], spot_ids[j]))
+    edges = list(edges)
+    order = rng.permutation(len(edges))
+    edge_sources = np.array([edges[k][0] for k in order], dtype="int64")
+    edge_targets = np.array([edges[k][1] for k in order], dtype="int64")
+    # Spots are saved in frame order, but in any order within a frame
+    file_order = np.lexsort((rng.random(frames.size), frames))
+    return spot_ids[file_order], frames[file_order], edge_sources, edge_targets
+
+@pytest.mark.parametrize("seed", range(10))
+def test_assign_track_ids_matches_recursive_traversal(seed):
+    rng = np.random.default_rng(seed)
+    for _ in range(200):
+        spot_ids, frames, edge_sources, edge_targets = random_tracks(rng)
+        track_ids = parse_xml.assign_track_ids(spot_ids, frames, edge_sources, edge_targets)
+        expected = traverse_tracks(spot_ids, frames, edge_sources, edge_targets)
+        assert track_ids.tolist() == [expected.get(spot_id, -1) for spot_id in spot_ids]
+
+def test_npz_and_xml_write_identical_features(tmp_path):
+    n_frames, n_cells = 3, 3
+    # Each feature's value for every Spot, and the text TrackMate writes for
+    # it, for numbers that Python and Java write differently
+    spots = []
+    for frame in range(n_frames):
+        for cell in range(n_cells):
+            spot_id = frame * n_cells + cell
+            values = {key: (spot_id + 0.5, f"{spot_id + 0.5}") for key in SPOT_ATTRIBUTES}
+            values.update({
+                "ID": (spot_id, str(spot_id)),
+                "FRAME": (frame, str(frame)),
+                "VISIBILITY": (1, "1"),
+                "POSITION_X": (20.0 * (cell + 1), f"{20.0 * (cell + 1)}"),
+                "POSITION_Y": (20.0, "20.0"),
+                "POSITION_T": (float(frame), f"{float(frame)}"),
+                "QUALITY": (float(f"{cell + 1}.0E-4"), f"{cell + 1}.0E-4"),
+                "TOTAL_INTENSITY_CH1": (1.5e7 * (cell + 1), f"{1.5 * (cell + 1)}E7"),
+                "SNR_CH1": (np.nan, "NaN"),
+            })
+            spots.append(values)
+    roi = "-3.0 -3.0 3.0 -3.0 3.0 3.0 -3.0 3.0"
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', "<TrackMate>", "<Model>", "<AllSpots>"]
+    for frame in range(n_frames):
+        lines.append(f'<SpotsInFrame frame="{frame}">')
+        for values in spots[frame * n_cells:(frame + 1) * n_cells]:
+            attrs = " ".join(f'{key}="{text}"' for key, (_, text) in values.items())
+            lines.append(f'<Spot name="ID{values["ID"][0]}" {attrs}>{roi}</Spot>')
+        lines.append("</SpotsInFrame>")
+    lines += ["</AllSpots>", "<AllTracks>"]
+    edges = [(frame * n_cells + cell, (frame + 1) * n_cells + cell) for cell in range(n_cells) for frame in range(n_frames - 1)]
+    for cell in range(n_cells):
+        lines.append(f'<Track name="Track_{cell}" TRACK_ID="{cell}">')
+        lines += [f'<Edge SPOT_SOURCE_ID="{source}" SPOT_TARGET_ID="{target}"/>' for source, target in edges if source % n_cells == cell]
+        lines.append("</Track>")
+    lines += ["</AllTracks>", "</Model>", "</TrackMate>"]
+    xml_path = tmp_path / "trackmate.xml"
+    xml_path.write_text("\n".join(lines))
+
+    # In the format export_model in track_images.py saves
+    columns = {f"spot_{key}": np.array([values[key][0] for values in spots]) for key in SPOT_ATTRIBUTES}
+    npz_path = tmp_path / "trackmate.npz"
+    np.savez(
+        npz_path,
+        spot_LABEL=np.array([f"ID{values['ID'][0]}" for values in spots]),
+        roi_coords=np.tile(np.array(roi.split(), dtype=float).reshape(-1, 2), (len(spots), 1)),
+        roi_lengths=np.full(len(spots), 4),
+        edge_sources=np.array([source for source, _ in edges]),
+        edge_targets=np.array([target for _, target in edges]),
+        **columns,
+    )
+    assert columns["spot_FRAME"].dtype == "int64"
+
+    for path in [xml_path, npz_path]:
+        subprocess.run(
+            [sys.executable, BIN_DIR / "parse_xml.py", path, tmp_path / f"{path.suffix[1:]}.zip", tmp_path / f"{path.suffix[1:]}.csv"],
+            check=True,
+        )
+    assert (tmp_path / "npz.csv").read_bytes() == (tmp_path / "xml.csv").read_bytes()
+
+def test_keep_track_ids():
+    # Spots 0-5 were in the previous run, in tracks 0, 1 and 2, and spot 3
+    # wasn't tracked. Spots 6-9 are new
+    previous_track_ids = np.array([0, 0, 1, -1, 2, 2, -1, -1, -1, -1])
+    # Previous track 0 continues. Previous track 2 is split, with spot 4
+    # joined onto track 1 and spot 5 continuing with the new spots 8 and 9.
+    # Spot 3 and the new spots 6 and 7 start a new track
+    track_ids = np.array([1, 1, 0, 2, 0, 3, 2, 2, 3, 3])
+    renumbered = parse_xml.keep_track_ids(track_ids, previous_track_ids)
+    assert renumbered.tolist() == [0, 0, 1, 3, 1, 2, 3, 3, 2, 2]
+
+    # Both halves of a split track start with one of its Spots, and the
+    # first track found keeps its id
+    renumbered = parse_xml.keep_track_ids(np.array([0, 1, 0, 1]), np.array([0, 0, -1, -1]))
+    assert renumbered.tolist() == [0, 1, 0, 1]
+
+    # Unchanged tracks keep their ids, and untracked Spots stay untracked
+    assert parse_xml.keep_track_ids(np.array([1, 0, -1, 1]), np.array([2, 0, -1, -1])).tolist() == [2, 0, -1, 2]
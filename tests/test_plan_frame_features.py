@@ -0,0 +1,38 @@
+import glob
+import subprocess
+import sys
+from pathlib import Path
+from scripts import BIN_DIR
+
+sys.path.insert(0, str(BIN_DIR.parent / "benchmarks"))
+from synthetic import simulate, write_frames, write_trackmate_outputs
+
+def test_reused_features_match_calculated(tmp_path):
+    timelapse = simulate(n_frames=4, n_cells=6, image_size=128, seed=1)
+    write_frames(timelapse, tmp_path / "frames", tmp_path / "masks")
+    trackmate = tmp_path / "trackmate_features.csv"
+    write_trackmate_outputs(timelapse, trackmate, tmp_path / "rois.zip", tmp_path / "roi_frames")
+    frames = sorted(glob.glob(str(tmp_path / "frames" / "frame_*.tiff")))
+    subprocess.run(
+        [sys.executable, BIN_DIR / "frame_features_image.py", trackmate, " ".join(frames), tmp_path / "rois.zip"],
+        check=True,
+        cwd=tmp_path,
+    )
+    calculated = [Path(fn).read_text().splitlines() for fn in sorted(glob.glob(str(tmp_path / "frame_features_*.csv")))]
+    header = calculated[0][0]
+    assert all(lines[0] == header for lines in calculated)
+    previous = tmp_path / "previous.csv"
+    previous.write_text("\n".join([header] + [line for lines in calculated for line in lines[1:]]) + "\n")
+
+    # Every cell is in the previous run, so every frame is reused
+    reused = tmp_path / "reused.csv"
+    subprocess.run(
+        [sys.executable, BIN_DIR / "plan_frame_features.py", "--previous", previous, trackmate, tmp_path / "frames.txt", reused],
+        check=True,
+    )
+    assert (tmp_path / "frames.txt").read_text() == ""
+    # Combined with the newly calculated frames under the first file's
+    # header, so the columns and the formatting of the values must match
+    reused_lines = reused.read_text().splitlines()
+    assert reused_lines[0] == header
+    assert sorted(reused_lines[1:]) == sorted(line for lines in calculated for line in lines[1:])
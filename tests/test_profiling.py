@@ -0,0 +1,53 @@
+import json
+import sys
+import time
+import numpy as np
+import tifffile
+from scripts import BIN_DIR
+from ome_frames import read_page_bytes, write_frame_refs
+from profiling import Profile, task_memory_mb
+
+def test_saves_profile(tmp_path, monkeypatch):
+    monkeypatch.setattr(sys, "argv", [str(BIN_DIR / "track_masks.py")])
+    (tmp_path / "a.png").write_bytes(b"x" * 100)
+    masks = tmp_path / "masks"
+    (masks / "nested").mkdir(parents=True)
+    (masks / "frame_1.png").write_bytes(b"x" * 10)
+    (masks / "nested" / "frame_2.png").write_bytes(b"x" * 20)
+
+    profile = Profile(str(tmp_path / "profile.json"), workers=3)
+    profile.add_inputs(str(tmp_path / "a.png"), [str(masks)], None)
+    profile.record(frames=2, spots=np.int64(7))
+    profile.phase("read")
+    time.sleep(0.01)
+    profile.phase("write")
+    profile.phase("read")
+    profile.save()
+
+    saved = json.loads((tmp_path / "profile.json").read_text())
+    assert saved["script"] == "track_masks"
+    assert saved["input_files"] == 3
+    assert saved["input_bytes"] == 130
+    assert saved["sizes"] == {"frames": 2, "spots": 7}
+    assert saved["workers"] == 3
+    # Time in a repeated phase is added onto the first
+    assert list(saved["phases"]) == ["read", "write"]
+    assert saved["phases"]["read"] >= 0.01
+    assert saved["wall_seconds"] >= sum(saved["phases"].values())
+    assert task_memory_mb(saved) == saved["peak_rss_mb"] + 3 * saved["peak_worker_rss_mb"]
+
+def test_frame_refs_count_their_page(tmp_path):
+    rng = np.random.default_rng(0)
+    tifffile.imwrite(tmp_path / "timelapse.ome.tif", rng.integers(0, 1000, (3, 64, 64), dtype=np.uint16), compression="zlib")
+    frames = [("timelapse.ome.tif", ifd) for ifd in range(3)]
+    page_bytes = read_page_bytes(frames, str(tmp_path))
+    with tifffile.TiffFile(tmp_path / "timelapse.ome.tif") as tif:
+        assert page_bytes == [sum(page.databytecounts) for page in tif.pages]
+    ref_fns = write_frame_refs(frames, str(tmp_path), page_bytes)
+
+    profile = Profile(None)
+    profile.add_inputs(ref_fns)
+    assert profile.input_files == 3
+    assert profile.input_bytes == sum(page_bytes)
+    # Nothing is saved without a path
+    profile.save()
@@ -0,0 +1,70 @@
+import sys
+import time
+import numpy as np
+import pytest
+from scripts import BIN_DIR, load_script
+
+torch = pytest.importorskip("torch")
+models = pytest.importorskip("cellpose.models")
+segment_image_batch = load_script("segment_image_batch")
+sys.path.insert(0, str(BIN_DIR.parent / "benchmarks"))
+from synthetic import render_frame, simulate
+
+@pytest.mark.parametrize(
+    "image_size,n_cells,eval_args",
+    [
+        # Images of few enough tiles that several images share every batch
+        # of tiles through the network
+        (112, 8, {"channels": [0, 0]}),
+        (256, 25, {"channels": [0, 0], "batch_size": 32}),
+        # Images of more tiles than a batch, so each is run on its own
+        (256, 25, {"channels": [0, 0]}),
+    ],
+)
+def test_stacked_matches_per_image(image_size, n_cells, eval_args):
+    try:
+        model = models.CellposeModel(gpu=torch.cuda.is_available(), model_type="cyto3")
+    except OSError as ex:
+        pytest.skip(f"The cyto3 model couldn't be loaded: {ex}")
+    timelapse = simulate(n_frames=8, n_cells=n_cells, image_size=image_size, seed=2)
+    images = [render_frame(timelapse, frame)[0] for frame in range(timelapse.n_frames)]
+    stack_args = segment_image_batch.stack_eval_args(eval_args)
+    # So the first timing doesn't include Cellpose's setup
+    segment_image_batch.segment_batch(model, images[:1], eval_args, stack_args)
+
+    start = time.perf_counter()
+    expected = [segment_image_batch.segment_batch(model, [image], eval_args, stack_args)[0] for image in images]
+    per_image_time = time.perf_counter() - start
+    start = time.perf_counter()
+    masks = segment_image_batch.segment_batch(model, images, eval_args, stack_args)
+    stacked_time = time.perf_counter() - start
+    print(f"{len(images)} images per image in {per_image_time:.2f}s, stacked in {stacked_time:.2f}s ({per_image_time / stacked_time:.2f}x)")
+
+    assert all(image_masks.max() > 0 for image_masks in expected)
+    assert len(masks) == len(expected)
+    for image_masks, image_expected in zip(masks, expected):
+        np.testing.assert_array_equal(image_masks, image_expected)
+
+def test_tiled_matches_untiled():
+    try:
+        model = models.CellposeModel(gpu=torch.cuda.is_available(), model_type="cyto3")
+    except OSError as ex:
+        pytest.skip(f"The cyto3 model couldn't be loaded: {ex}")
+    timelapse = simulate(n_frames=1, n_cells=40, image_size=384, seed=3)
+    image = render_frame(timelapse, 0)[0]
+    eval_args = {"channels": [0, 0]}
+
+    expected = model.eval(image, **eval_args)[0]
+    masks = segment_image_batch.segment_tiled_image(model, image, eval_args, 192, 48)
+
+    # The network sees different surroundings at the edges of each tile, so
+    # the cell boundaries can differ by a few pixels but every cell is found
+    assert expected.max() > 0
+    assert masks.max() == expected.max()
+    for label in range(1, expected.max() + 1):
+        cell = expected == label
+        tiled_labels, counts = np.unique(masks[cell], return_counts=True)
+        match = tiled_labels[np.argmax(counts)]
+        assert match > 0
+        iou = counts.max() / np.logical_or(cell, masks == match).sum()
+        assert iou > 0.9
@@ -0,0 +1,110 @@
+import subprocess
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+from scripts import BIN_DIR, load_script
+
+time_series_features = load_script("time_series_features")
+
+def frame_features(seed: int, n_cells: int = 40) -> pd.DataFrame:
+    """
+    Generates frame features with dropped frames and runs of missing values.
+
+    Every feature column has runs of consecutive cells that are missing all
+    of their values, so they're interpolated from the neighbouring cells,
+    along with cells missing their first or last values.
+
+    :param seed: Seed for the random number generator.
+    :param n_cells: Number of cells.
+    :return: A frame features DataFrame sorted by CellID and FrameID.
+    """
+    rng = np.random.default_rng(seed)
+    rows = []
+    for cell_id in range(1, n_cells + 1):
+        n_obs = int(rng.integers(4, 12))
+        # Cells skip frames, which are interpolated
+        frame_ids = np.sort(rng.choice(np.arange(1, 30), size=n_obs, replace=False))
+        for frame_id in frame_ids:
+            rows.append({
+                "CellID": cell_id,
+                "FrameID": frame_id,
+                "x": rng.random() * 100,
+                "y": rng.random() * 100,
+                "ROI_filename": f"{frame_id}-{cell_id}",
+            })
+    df = pd.DataFrame(rows)
+    features = ["area", "perimeter", "intensity"]
+    for feature in features:
+        df[feature] = rng.random(df.shape[0]) * 10
+    for feature in features:
+        # Runs of up to 4 cells with no values
+        for start in rng.choice(np.arange(2, n_cells), size=4, replace=False):
+            df.loc[df["CellID"].between(start, start + rng.integers(0, 4)), feature] = np.nan
+        # Cells missing their first or last values
+        firsts = df.groupby("CellID").head(1).sample(frac=0.2, random_state=seed).index
+        lasts = df.groupby("CellID").tail(1).sample(frac=0.2, random_state=seed).index
+        df.loc[firsts.union(lasts), feature] = np.nan
+    return df
+
+@pytest.mark.parametrize("seed", range(5))
+def test_sharded_matches_single_process(seed):
+    df = frame_features(seed)
+    expected = time_series_features.time_series_features(df)
+    # Make sure the shards need the neighbouring cells to interpolate
+    shards = time_series_features.shard_cells(df, 4)
+    assert any(shard_df["CellID"].nunique() > cell_ids.size for cell_ids, shard_df in shards)
+
+    result = time_series_features.calculate(df, 4)
+    pd.testing.assert_frame_equal(result, expected.reset_index(drop=True), check_exact=True)
+
+def test_sharding_falls_back_when_padded_to_whole_table(monkeypatch):
+    df = frame_features(0)
+    # Only the first and last cells have areas, so every cell in between
+    # interpolates from both
+    df.loc[~df["CellID"].isin([1, 40]), "area"] = np.nan
+    shards = time_series_features.shard_cells(df, 4)
+    assert all(shard_df.shape[0] == df.shape[0] for _, shard_df in shards)
+    monkeypatch.setattr(time_series_features, "parallel_map", None)
+
+    result = time_series_features.calculate(df, 4)
+    expected = time_series_features.time_series_features(df)
+    pd.testing.assert_frame_equal(result, expected.reset_index(drop=True), check_exact=True)
+
+@pytest.mark.parametrize("seed", range(3))
+def test_incremental_matches_full_run(tmp_path, seed):
+    df = frame_features(seed)
+    expected = time_series_features.time_series_features(df).reset_index(drop=True)
+    # The previous run saw a cell with fewer frames, with a later cell that
+    # has no values for a feature so is interpolated from it, and was
+    # missing the last cell
+    cell_ids, valid, _ = time_series_features.feature_validity(df)
+    interpolated = int(np.flatnonzero(~valid.all(axis=1))[0])
+    changed = cell_ids[interpolated - 1]
+    previous = df.loc[(df["CellID"] != cell_ids[-1]) & ~((df["CellID"] == changed) & (df["FrameID"] == df.loc[df["CellID"] == changed, "FrameID"].max()))]
+    previous_ts = time_series_features.time_series_features(previous)
+    # So reusing the interpolated cell's previous features would be wrong
+    previous_interpolated = previous_ts.loc[previous_ts["CellID"] == cell_ids[interpolated]].reset_index(drop=True)
+    assert not previous_interpolated.equals(expected.loc[expected["CellID"] == cell_ids[interpolated]].reset_index(drop=True))
+
+    recalculate = time_series_features.cells_to_recalculate(df, time_series_features.changed_cells(df, previous))
+    assert changed in recalculate and cell_ids[interpolated] in recalculate
+    assert recalculate.size < cell_ids.size
+
+    df.to_csv(tmp_path / "frame_features.csv", index=False)
+    previous.to_csv(tmp_path / "previous_frame_features.csv", index=False)
+    previous_ts.to_csv(tmp_path / "previous.csv", index=False)
+    subprocess.run(
+        [
+            sys.executable, BIN_DIR / "time_series_features.py",
+            "--previous", tmp_path / "previous.csv",
+            "--previous-frame-features", tmp_path / "previous_frame_features.csv",
+            tmp_path / "frame_features.csv", tmp_path / "incremental.csv",
+        ],
+        check=True,
+    )
+    incremental = pd.read_csv(tmp_path / "incremental.csv", float_precision="round_trip")
+    expected.to_csv(tmp_path / "expected.csv", index=False)
+    # Interpolating within the recalculated cells' context rather than the
+    # whole table can differ in the last bit
+    pd.testing.assert_frame_equal(incremental, pd.read_csv(tmp_path / "expected.csv", float_precision="round_trip"), rtol=1e-12)
@@ -0,0 +1,154 @@
+import numpy as np
+from PIL import Image
+from scripts import load_script
+
+track_masks = load_script("track_masks")
+SETTINGS = {**track_masks.DEFAULT_SETTINGS, "ALLOW_TRACK_MERGING": True, "ALLOW_TRACK_SPLITTING": True}
+
+def spot_features(frames: list[int], xs: list[float], ys: list[float], **extra) -> dict:
+    """
+    Creates the feature arrays of some Spots, with only their positions and
+    frames set.
+
+    :param frames: Each Spot's frame.
+    :param xs: Each Spot's x position.
+    :param ys: Each Spot's y position.
+    :param extra: Any other features to set.
+    :return: A dict of Spot feature arrays.
+    """
+    features = {key: np.zeros(len(frames)) for key in track_masks.SPOT_FEATURES}
+    features["FRAME"] = np.array(frames, dtype="float64")
+    features["POSITION_X"] = np.array(xs, dtype="float64")
+    features["POSITION_Y"] = np.array(ys, dtype="float64")
+    for key, values in extra.items():
+        features[key] = np.array(values, dtype="float64")
+    return features
+
+def links(sources: np.ndarray, targets: np.ndarray) -> set[tuple[int, int]]:
+    return set(zip(sources.tolist(), targets.tolist()))
+
+def test_detect_spots(tmp_path):
+    mask = np.zeros((40, 50), dtype="uint16")
+    mask[5:15, 10:30] = 3
+    mask[20:40, 40:50] = 7
+    Image.fromarray(mask).save(tmp_path / "mask.tiff")
+
+    features, rois = track_masks.detect_spots(str(tmp_path / "mask.tiff"), 4)
+
+    assert len(rois) == 2
+    np.testing.assert_array_equal(features["MEAN_INTENSITY_CH1"], [3, 7])
+    np.testing.assert_array_equal(features["QUALITY"], [200, 200])
+    np.testing.assert_array_equal(features["FRAME"], [4, 4])
+    # The outlines run between the label's edge pixels and the background
+    np.testing.assert_allclose(features["POSITION_X"], [19.5, 44.5], atol=0.5)
+    np.testing.assert_allclose(features["POSITION_Y"], [9.5, 29.5], atol=0.5)
+    assert ((features["AREA"] > 9 * 19) & (features["AREA"] < 10 * 20)).all()
+    np.testing.assert_allclose(features["RADIUS"], np.sqrt(features["AREA"] / np.pi))
+    np.testing.assert_allclose(features["TOTAL_INTENSITY_CH1"], [600, 1400])
+    for roi, x, y, (left, top, right, bottom) in zip(rois, features["POSITION_X"], features["POSITION_Y"], [(10, 5, 29, 14), (40, 20, 49, 39)]):
+        coords = roi + [x, y]
+        assert (coords.min(axis=0) >= [left - 0.5, top - 0.5]).all()
+        assert (coords.max(axis=0) <= [right + 0.5, bottom + 0.5]).all()
+    # Both are surrounded by background only, and have a uniform intensity
+    np.testing.assert_allclose(features["CONTRAST_CH1"], [1, 1])
+    assert np.isposinf(features["SNR_CH1"]).all()
+
+def test_link_costs():
+    features = spot_features([0, 0, 1, 1, 1], [0, 10, 3, 10, 30], [0, 0, 4, 1, 0], AREA=[10, 10, 30, 10, 10])
+    rows, cols, costs = track_masks.link_costs(features, np.array([0, 1]), np.array([2, 3, 4]), 8.0, {})
+    found = {(row, col): cost for row, col, cost in zip(rows, cols, costs)}
+    # Spot 4 is too far from either, and 1 -> 2 just too far
+    assert found == {(0, 0): 25.0, (1, 1): 1.0}
+
+    # A penalty of 1 on the area triples the difference's relative size, so
+    # 0 -> 2 costs 25 * (1 + 3 * 20 / 40)^2, which is too far
+    rows, cols, costs = track_masks.link_costs(features, np.array([0, 1]), np.array([2, 3, 4]), 8.0, {"AREA": 1.0})
+    found = {(row, col): cost for row, col, cost in zip(rows, cols, costs)}
+    assert found == {(1, 1): 1.0}
+
+def test_solve_lap():
+    # Row 0 would take column 0 on its own, but row 1 can only take column 0
+    rows = np.array([0, 0, 1])
+    cols = np.array([0, 1, 0])
+    costs = np.array([1.0, 2.0, 1.0])
+    assert links(*track_masks.solve_lap(rows, cols, costs, 2, 2, 10.0)) == {(0, 1), (1, 0)}
+    # Unless leaving row 0 unassigned is cheaper than the detour
+    assert links(*track_masks.solve_lap(rows, cols, np.array([2.0, 50.0, 1.0]), 2, 2, 10.0)) == {(1, 0)}
+    # Nothing to assign
+    empty = np.zeros(0, dtype=int)
+    assert links(*track_masks.solve_lap(empty, empty, np.zeros(0), 3, 3, 1.0)) == set()
+
+def test_link_frames():
+    # Two cells crossing paths slowly enough to be told apart, and a third
+    # that appears in frame 1
+    features = spot_features(
+        [0, 0, 1, 1, 1, 2, 2, 2],
+        [0, 20, 5, 15, 50, 8, 12, 52],
+        [0, 0, 0, 0, 0, 3, -3, 0],
+    )
+    sources, targets = track_masks.link_frames(features, SETTINGS)
+    assert links(sources, targets) == {(0, 2), (1, 3), (2, 5), (3, 6), (4, 7)}
+    # Only the links into frame 2 and later
+    sources, targets = track_masks.link_frames(features, SETTINGS, first_frame=2)
+    assert links(sources, targets) == {(2, 5), (3, 6), (4, 7)}
+
+def test_link_segments():
+    # Spot indices by track:
+    #   A: 0 (f0) - 1 (f1) - 2 (f2) - 3 (f3)
+    #   B: 4 (f0), missing in f1, 5 (f2)      -> gap closing 4 -> 5
+    #   C: 6 (f0) - 7 (f1), ends next to A    -> merges into 2
+    #   D: 8 (f3) starts next to A's 2        -> splits from 2
+    # C's end is too far from D's start to close the gap between them
+    features = spot_features(
+        [0, 1, 2, 3, 0, 2, 0, 1, 3],
+        [0, 1, 2, 3, 100, 102, 2, 2, 2],
+        [0, 0, 0, 0, 100, 100, 8, 4, -5],
+    )
+    link_sources = np.array([0, 1, 2, 6])
+    link_targets = np.array([1, 2, 3, 7])
+    settings = {**SETTINGS, "GAP_CLOSING_MAX_DISTANCE": 5.0}
+    sources, targets = track_masks.link_segments(features, link_sources, link_targets, settings)
+    assert links(sources, targets) == {(4, 5), (7, 2), (2, 8)}
+
+    # Without merging and splitting, only the gap is closed
+    settings = {**settings, "ALLOW_TRACK_MERGING": False, "ALLOW_TRACK_SPLITTING": False}
+    sources, targets = track_masks.link_segments(features, link_sources, link_targets, settings)
+    assert links(sources, targets) == {(4, 5)}
+    # And the gap must be short enough
+    settings = {**settings, "MAX_FRAME_GAP": 1}
+    sources, targets = track_masks.link_segments(features, link_sources, link_targets, settings)
+    assert links(sources, targets) == set()
+
+def test_track_synthetic_masks(tmp_path):
+    # Three squares moving in straight lines, one of which isn't segmented
+    # in a frame
+    velocities = [(3, 0), (0, 2), (-2, -2)]
+    starts = [(5, 5), (40, 10), (60, 60)]
+    n_frames = 6
+    spot_frames = []
+    expected_tracks = {label: [] for label in range(1, 4)}
+    features = []
+    for frame in range(n_frames):
+        mask = np.zeros((80, 80), dtype="uint16")
+        for label, ((x, y), (dx, dy)) in enumerate(zip(starts, velocities), start=1):
+            if label == 2 and frame == 3:
+                continue
+            left, top = x + dx * frame, y + dy * frame
+            mask[top:top + 6, left:left + 6] = label
+        Image.fromarray(mask).save(tmp_path / f"frame_{frame}.tiff")
+        frame_features, _ = track_masks.detect_spots(str(tmp_path / f"frame_{frame}.tiff"), frame)
+        features.append(frame_features)
+        spot_frames.append(frame_features["MEAN_INTENSITY_CH1"].astype(int))
+    features = {key: np.concatenate([frame[key] for frame in features]) for key in track_masks.SPOT_FEATURES}
+    labels = np.concatenate(spot_frames)
+    for spot, label in enumerate(labels):
+        expected_tracks[label].append(spot)
+
+    sources, targets, n_frame_links = track_masks.track(features, "SparseLAP", None)
+
+    # Every link is between consecutive Spots of the same square, with the
+    # missing frame closed as a gap
+    expected = {(track[i], track[i + 1]) for track in expected_tracks.values() for i in range(len(track) - 1)}
+    assert links(sources, targets) == expected
+    assert n_frame_links == len(expected) - 1
+    assert (labels[sources[n_frame_links:]] == 2).all()